@@ -1,3 +1,8 @@
 from django.contrib import admin
+from .models import ConversationAnalytics, AnalyticsCacheEntry, AnalyticsSnapshot, AnalyticsDailyRollup
 
 # Register your models here.
+admin.site.register(ConversationAnalytics)
+admin.site.register(AnalyticsCacheEntry)
+admin.site.register(AnalyticsSnapshot)
+admin.site.register(AnalyticsDailyRollup)
@@ -0,0 +1,138 @@
+# cache in front of the LLM calls for analytics
+# tier 1 - in process LRU with TTL, tier 2 - AnalyticsCacheEntry table shared by all workers
+# key is the hash of normalized transcript, so same chat analysed again returns without calling the LLM
+
+import json
+import hashlib
+import threading
+from datetime import timedelta
+from cachetools import TTLCache
+from django.conf import settings
+from django.db import IntegrityError
+from django.utils import timezone
+from .models import AnalyticsCacheEntry
+from .metrics import Counters
+
+
+MEMORY_MAX_ENTRIES = getattr(settings, 'ANALYTICS_CACHE_MEMORY_MAX_ENTRIES', 512)
+DB_MAX_ENTRIES = getattr(settings, 'ANALYTICS_CACHE_DB_MAX_ENTRIES', 10000)
+TTL_SECONDS = getattr(settings, 'ANALYTICS_CACHE_TTL_SECONDS', 24 * 60 * 60)
+# pruning the table on every write is wasteful, so it runs once every N writes
+DB_PRUNE_EVERY = getattr(settings, 'ANALYTICS_CACHE_DB_PRUNE_EVERY', 100)
+
+
+# TTLCache already evicts least recently used entries when full
+# popitem is overridden only to count those evictions
+class _MemoryCache(TTLCache):
+    def popitem(self):
+        item = super().popitem()
+        stats.increment('memory_evictions')
+        return item
+
+
+class CacheStats(Counters):
+    def __init__(self):
+        super().__init__(['memory_hits', 'db_hits', 'misses', 'memory_evictions', 'db_evictions'])
+
+    def snapshot(self):
+        counters = super().snapshot()
+        lookups = counters['memory_hits'] + counters['db_hits'] + counters['misses']
+        counters['hit_rate'] = round((counters['memory_hits'] + counters['db_hits']) / lookups, 4) if lookups else 0.0
+        return counters
+
+
+stats = CacheStats()
+_memory = _MemoryCache(maxsize=MEMORY_MAX_ENTRIES, ttl=TTL_SECONDS)
+_memory_lock = threading.Lock()
+_db_writes = 0
+
+
+# whitespace differences and client only fields (timestamps, ids) should not change the key
+def _normalize_text(text):
+    return ' '.join(str(text or '').split())
+
+
+def _normalize_message(message):
+    if isinstance(message, dict):
+        return [message.get('sender'), _normalize_text(message.get('text'))]
+    return [None, _normalize_text(message)]
+
+
+def make_cache_key(messages, previous=None):
+    payload = {
+        'previous': previous,
+        'messages': [_normalize_message(message) for message in messages],
+    }
+    encoded = json.dumps(payload, sort_keys=True, default=str).encode('utf-8')
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def lookup(key):
+    with _memory_lock:
+        result = _memory.get(key)
+    if result is not None:
+        stats.increment('memory_hits')
+        return result
+
+    cutoff = timezone.now() - timedelta(seconds=TTL_SECONDS)
+    entry = AnalyticsCacheEntry.objects.filter(key=key, created_at__gte=cutoff).only('result').first()
+    if entry is not None:
+        stats.increment('db_hits')
+        # promote to memory so next lookup in this worker skips the DB
+        with _memory_lock:
+            _memory[key] = entry.result
+        return entry.result
+
+    stats.increment('misses')
+    return None
+
+
+def store(key, result):
+    global _db_writes
+
+    with _memory_lock:
+        _memory[key] = result
+
+    try:
+        AnalyticsCacheEntry.objects.update_or_create(key=key, defaults={'result': result, 'created_at': timezone.now()})
+    except IntegrityError:
+        # another worker stored the same key at the same time
+        pass
+
+    _db_writes += 1
+    if _db_writes % DB_PRUNE_EVERY == 0:
+        prune()
+
+
+# deleting expired rows and the oldest rows above DB_MAX_ENTRIES
+def prune():
+    cutoff = timezone.now() - timedelta(seconds=TTL_SECONDS)
+    deleted, _ = AnalyticsCacheEntry.objects.filter(created_at__lt=cutoff).delete()
+
+    # created_at of the first row which is above the size limit, it and everything older is removed
+    over_limit = list(AnalyticsCacheEntry.objects.order_by('-created_at').values_list('created_at', flat=True)[DB_MAX_ENTRIES:DB_MAX_ENTRIES + 1])
+    if over_limit:
+        extra, _ = AnalyticsCacheEntry.objects.filter(created_at__lte=over_limit[0]).delete()
+        deleted += extra
+
+    if deleted:
+        stats.increment('db_evictions', deleted)
+    return deleted
+
+
+# returns cached result for the key, else computes it and stores it in both tiers
+def get_or_compute(key, compute):
+    result = lookup(key)
+    if result is not None:
+        return result
+
+    result = compute()
+    store(key, result)
+    return result
+
+
+def clear():
+    with _memory_lock:
+        _memory.clear()
+    AnalyticsCacheEntry.objects.all().delete()
+    stats.reset()
@@ -0,0 +1,112 @@
+# cheap in process classifier for the fields which can often be decided from keywords
+# sentiment - lexicon of positive / negative words (with simple negation) over customer messages
+# loan_type - keywords of each loan category
+# fully deterministic and CPU only, used before deciding if the LLM call is needed at all
+
+import re
+
+
+POSITIVE_WORDS = {
+    'good': 1.0, 'great': 1.5, 'thanks': 1.0, 'thank': 1.0, 'happy': 1.5, 'interested': 1.5,
+    'perfect': 1.5, 'excellent': 2.0, 'helpful': 1.0, 'nice': 1.0, 'sure': 0.5, 'yes': 0.5,
+    'okay': 0.5, 'ok': 0.5, 'awesome': 2.0, 'love': 1.5, 'glad': 1.0, 'appreciate': 1.5,
+    'ready': 1.0, 'apply': 1.0, 'proceed': 1.5, 'definitely': 1.5,
+}
+NEGATIVE_WORDS = {
+    'bad': 1.0, 'poor': 1.5, 'angry': 2.0, 'frustrated': 2.0, 'disappointed': 2.0, 'worst': 2.5,
+    'terrible': 2.5, 'slow': 1.0, 'problem': 1.0, 'issue': 1.0, 'complaint': 1.5, 'expensive': 1.0,
+    'high': 0.5, 'no': 0.5, 'never': 1.0, 'cancel': 1.5, 'waste': 2.0, 'useless': 2.0,
+    'annoyed': 1.5, 'unhappy': 2.0, 'rejected': 1.5,
+}
+NEGATIONS = {'not', "don't", 'dont', "didn't", 'didnt', 'never', 'no', "isn't", 'isnt', "wasn't", 'wasnt'}
+
+LOAN_KEYWORDS = {
+    'Home Loan': ['home loan', 'housing loan', 'mortgage', 'house', 'flat', 'apartment', 'property'],
+    'Car Loan': ['car loan', 'auto loan', 'vehicle loan', 'car', 'vehicle', 'bike'],
+    'Personal Loan': ['personal loan', 'personal', 'wedding', 'medical', 'emergency'],
+    'Education Loan': ['education loan', 'student loan', 'education', 'study', 'studies', 'college', 'university', 'tuition'],
+    'Business Loan': ['business loan', 'business', 'startup', 'shop', 'working capital', 'msme'],
+    'Gold Loan': ['gold loan', 'gold', 'jewellery', 'jewelry'],
+}
+
+_TOKEN_RE = re.compile(r"[a-z']+")
+
+
+def _tokens(text):
+    return _TOKEN_RE.findall(str(text or '').lower())
+
+
+# returns (sentiment, confidence) or None when the messages have no sentiment words
+def classify_sentiment(texts):
+    positive = negative = 0.0
+
+    for text in texts:
+        tokens = _tokens(text)
+        for index, token in enumerate(tokens):
+            negated = index > 0 and tokens[index - 1] in NEGATIONS
+            if token in POSITIVE_WORDS:
+                # "not happy" counts as negative
+                if negated:
+                    negative += POSITIVE_WORDS[token]
+                else:
+                    positive += POSITIVE_WORDS[token]
+            elif token in NEGATIVE_WORDS:
+                if negated:
+                    positive += NEGATIVE_WORDS[token] / 2
+                else:
+                    negative += NEGATIVE_WORDS[token]
+
+    total = positive + negative
+    if total == 0:
+        return None
+
+    # confidence grows with the margin between both sides and with the amount of evidence
+    margin = abs(positive - negative) / total
+    evidence = min(1.0, total / 3.0)
+    if margin < 0.2:
+        return 'neutral', round(evidence * (1 - margin), 3)
+    label = 'positive' if positive > negative else 'negative'
+    return label, round(margin * evidence, 3)
+
+
+# returns (loan_type, confidence) or None when no loan category is mentioned
+def classify_loan_type(texts):
+    text = ' '.join(str(text or '').lower() for text in texts)
+    scores = {}
+
+    for loan_type, keywords in LOAN_KEYWORDS.items():
+        for keyword in keywords:
+            hits = len(re.findall(r'\b' + re.escape(keyword) + r'\b', text))
+            if hits:
+                # explicit "xyz loan" phrases are stronger than related words
+                weight = 2.0 if keyword.endswith('loan') else 1.0
+                scores[loan_type] = scores.get(loan_type, 0.0) + hits * weight
+
+    if not scores:
+        return None
+
+    loan_type, best = max(scores.items(), key=lambda item: (item[1], item[0]))
+    confidence = (best / sum(scores.values())) * min(1.0, best / 2.0)
+    return loan_type, round(confidence, 3)
+
+
+# messages are the serialized messages ({'sender': role, 'text': text})
+# sentiment is about the customer, so only their messages are used for it
+def classify(messages):
+    customer_texts = [message['text'] for message in messages if message.get('sender') != 'representative']
+    all_texts = [message['text'] for message in messages]
+
+    return {
+        'sentiment': classify_sentiment(customer_texts),
+        'loan_type': classify_loan_type(all_texts),
+    }
+
+
+# lead type guess used only when there are no LLM analytics at all (ANALYTICS_LOCAL_ONLY)
+def guess_lead_type(local):
+    sentiment = local['sentiment'][0] if local['sentiment'] else 'neutral'
+    if local['loan_type'] and sentiment == 'positive':
+        return 'hot'
+    if local['loan_type'] and sentiment != 'negative':
+        return 'warm'
+    return 'cold'
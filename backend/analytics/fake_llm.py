@@ -0,0 +1,87 @@
+# local stand-in for the LLM (ANALYTICS_LLM_BACKEND = 'fake')
+# no network, same output for the same prompt, sentiment / loan_type come from the local classifier
+# latency and errors can be injected to try out the timeout / retry / circuit breaker handling
+
+import time
+import random
+import asyncio
+import hashlib
+from django.conf import settings
+from .classifier import classify, guess_lead_type
+from .services import AnaltyicsModel, STREAM_FIELD_ORDER
+
+
+LATENCY_SECONDS = getattr(settings, 'ANALYTICS_FAKE_LLM_LATENCY_SECONDS', 0.0)
+LATENCY_JITTER_SECONDS = getattr(settings, 'ANALYTICS_FAKE_LLM_LATENCY_JITTER_SECONDS', 0.0)
+ERROR_RATE = getattr(settings, 'ANALYTICS_FAKE_LLM_ERROR_RATE', 0.0)
+
+
+class FakeLLMError(Exception):
+    pass
+
+
+def latency():
+    return LATENCY_SECONDS + random.uniform(0, LATENCY_JITTER_SECONDS)
+
+
+def maybe_fail():
+    if ERROR_RATE and random.random() < ERROR_RATE:
+        raise FakeLLMError("Injected fake LLM error.")
+
+
+def fake_analytics(prompt):
+    prompt = str(prompt)
+    local = classify([{'sender': 'customer', 'text': prompt}])
+    digest = hashlib.sha256(prompt.encode('utf-8')).hexdigest()[:8]
+
+    return AnaltyicsModel(
+        summary=f'Fake summary {digest} of a prompt with {len(prompt)} characters',
+        sentiment=local['sentiment'][0] if local['sentiment'] else 'neutral',
+        loan_type=local['loan_type'][0] if local['loan_type'] else 'No details',
+        lead_type=guess_lead_type(local),
+        rationale='Generated by the fake LLM backend',
+    )
+
+
+class FakeStructuredLLM:
+    def invoke(self, prompt, config=None):
+        time.sleep(latency())
+        maybe_fail()
+        return fake_analytics(prompt)
+
+    async def ainvoke(self, prompt, config=None):
+        await asyncio.sleep(latency())
+        maybe_fail()
+        return fake_analytics(prompt)
+
+    def batch(self, prompts, config=None, return_exceptions=False):
+        results = []
+        for prompt in prompts:
+            try:
+                results.append(self.invoke(prompt, config))
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                results.append(e)
+        return results
+
+
+class FakeStreamingLLM:
+    # yields growing partial dicts like JsonOutputParser does, text fields word by word
+    # latency and errors are applied before the first chunk
+    async def astream(self, prompt, config=None):
+        await asyncio.sleep(latency())
+        maybe_fail()
+        output = fake_analytics(prompt).model_dump()
+        partial = {}
+        for field in STREAM_FIELD_ORDER:
+            words = str(output[field]).split(' ')
+            for count in range(1, len(words) + 1):
+                partial = {**partial, field: ' '.join(words[:count])}
+                yield partial
+
+
+class FakeBackend:
+    def __init__(self):
+        self.structured = FakeStructuredLLM()
+        self.streaming = FakeStreamingLLM()
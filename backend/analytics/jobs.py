@@ -0,0 +1,139 @@
+# background jobs for analytics
+# LLM call runs on a bounded thread pool so the HTTP request returns immediately with a job id
+# when the job finishes the result is pushed to the chat group of the conversation (analytics.update event)
+
+import uuid
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import close_old_connections
+from chat.consumers import get_group_name
+from .pipeline import analyze_conversation
+
+
+MAX_WORKERS = getattr(settings, 'ANALYTICS_MAX_WORKERS', 4)
+# queued + running jobs, new jobs are rejected above this
+MAX_QUEUED_JOBS = getattr(settings, 'ANALYTICS_MAX_QUEUED_JOBS', 100)
+# finished jobs kept in memory so their status can still be fetched
+JOB_HISTORY_LIMIT = getattr(settings, 'ANALYTICS_JOB_HISTORY_LIMIT', 1000)
+
+
+class QueueFull(Exception):
+    pass
+
+
+class AnalyticsJob:
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    # finished, but newer messages came in while it was running so a newer job replaces it
+    SUPERSEDED = 'superseded'
+
+    def __init__(self, conversation_id):
+        self.id = uuid.uuid4()
+        self.conversation_id = conversation_id
+        self.status = self.QUEUED
+        self.result = None
+        self.error = None
+
+    @property
+    def finished(self):
+        return self.status in (self.DONE, self.FAILED, self.SUPERSEDED)
+
+    def as_dict(self):
+        return {
+            'job_id': str(self.id),
+            'conversation_id': str(self.conversation_id),
+            'status': self.status,
+            'analytics': self.result,
+            'error': self.error,
+        }
+
+
+_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='analytics')
+_jobs = OrderedDict()
+_lock = threading.Lock()
+_active = 0
+
+
+def get_job(job_id):
+    with _lock:
+        return _jobs.get(job_id)
+
+
+# registering a job without starting it, counts against the queue limit
+def create(conversation_id):
+    global _active
+
+    job = AnalyticsJob(conversation_id)
+    with _lock:
+        if _active >= MAX_QUEUED_JOBS:
+            raise QueueFull("Analytics queue is full, try again later.")
+        _active += 1
+        _jobs[job.id] = job
+        _forget_finished_jobs()
+    return job
+
+
+# on_finish(job) is called before the result is published, it can mark the job superseded to skip the push
+def start(job, on_finish=None):
+    _executor.submit(_run, job, on_finish)
+    return job
+
+
+# removing oldest finished jobs above the history limit
+def _forget_finished_jobs():
+    extra = len(_jobs) - JOB_HISTORY_LIMIT
+    for job_id in list(_jobs):
+        if extra <= 0:
+            break
+        if _jobs[job_id].finished:
+            del _jobs[job_id]
+            extra -= 1
+
+
+def _run(job, on_finish=None):
+    global _active
+
+    job.status = AnalyticsJob.RUNNING
+    try:
+        job.result = analyze_conversation(job.conversation_id)
+        job.status = AnalyticsJob.DONE
+    except Exception as e:
+        print(f"Analytics job {job.id} failed: {e}")
+        job.error = str(e)
+        job.status = AnalyticsJob.FAILED
+    finally:
+        # worker threads are long lived, so stale DB connections need to be closed like at the end of a request
+        close_old_connections()
+        with _lock:
+            _active -= 1
+
+    if on_finish:
+        on_finish(job)
+
+    if job.status != AnalyticsJob.SUPERSEDED:
+        publish(job)
+
+
+# sending the result to every socket connected to the conversation
+def publish(job):
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+
+    try:
+        async_to_sync(channel_layer.group_send)(
+            get_group_name(job.conversation_id),
+            {
+                # handled by ChatConsumer.analytics_update
+                'type': 'analytics_update',
+                'analytics_data': {'type': 'analytics.update', **job.as_dict()},
+            }
+        )
+    except Exception as e:
+        print(f"Could not push analytics of job {job.id}: {e}")
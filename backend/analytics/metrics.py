@@ -0,0 +1,39 @@
+# counters kept in this worker, exposed by the stats endpoints
+
+import threading
+
+
+class Counters:
+    def __init__(self, names):
+        self._names = list(names)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def reset(self):
+        with self._lock:
+            self._counters = {name: 0 for name in self._names}
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counters)
+
+
+# size of the transcripts sent to the LLM
+# raw_tokens = estimate for the old format (python repr of the messages), transcript_tokens = what was actually sent
+class PromptStats(Counters):
+    def __init__(self):
+        super().__init__(['prompts', 'messages', 'folded_messages', 'dropped_messages', 'raw_tokens', 'transcript_tokens'])
+
+    def snapshot(self):
+        counters = super().snapshot()
+        prompts = counters['prompts']
+        counters['avg_transcript_tokens'] = round(counters['transcript_tokens'] / prompts, 1) if prompts else 0.0
+        counters['token_reduction'] = round(1 - counters['transcript_tokens'] / counters['raw_tokens'], 4) if counters['raw_tokens'] else 0.0
+        return counters
+
+
+prompt_stats = PromptStats()
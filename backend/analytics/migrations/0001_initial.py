@@ -0,0 +1,30 @@
+# Generated by Django 5.2.7 on 2026-10-18 19:09
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('chat', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConversationAnalytics',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('summary', models.TextField()),
+                ('sentiment', models.CharField(max_length=20)),
+                ('loan_type', models.CharField(max_length=255)),
+                ('lead_type', models.CharField(max_length=20)),
+                ('rationale', models.TextField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('conversation', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='analytics', to='chat.conversation')),
+                ('last_message', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chat.messages')),
+            ],
+        ),
+    ]
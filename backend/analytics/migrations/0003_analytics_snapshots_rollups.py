@@ -0,0 +1,93 @@
+# Generated by Django 5.2.7 on 2026-10-18 19:50
+
+import django.db.models.deletion
+import django.utils.timezone
+import uuid
+from django.conf import settings
+from collections import Counter
+from django.db import migrations, models
+
+
+# existing latest analytics become the first snapshot of their conversation and are counted
+# in the rollup of the day they were last updated
+def backfill_snapshots(apps, schema_editor):
+    ConversationAnalytics = apps.get_model('analytics', 'ConversationAnalytics')
+    AnalyticsSnapshot = apps.get_model('analytics', 'AnalyticsSnapshot')
+    AnalyticsDailyRollup = apps.get_model('analytics', 'AnalyticsDailyRollup')
+    MyUser = apps.get_model(*settings.AUTH_USER_MODEL.split('.'))
+
+    representatives = set(MyUser.objects.filter(user_type='representative').values_list('id', flat=True))
+    buckets = Counter()
+    snapshots = []
+    for state in ConversationAnalytics.objects.select_related('conversation').iterator(chunk_size=500):
+        conversation = state.conversation
+        representative_id = next((user_id for user_id in (conversation.user1_id, conversation.user2_id) if user_id in representatives), None)
+        snapshots.append(AnalyticsSnapshot(
+            conversation_id=conversation.id,
+            representative_id=representative_id,
+            summary=state.summary,
+            sentiment=state.sentiment,
+            loan_type=state.loan_type,
+            lead_type=state.lead_type,
+            rationale=state.rationale,
+            created_at=state.updated_at,
+        ))
+        if representative_id is not None:
+            day = django.utils.timezone.localdate(state.updated_at)
+            buckets[(representative_id, day, state.lead_type, state.sentiment, state.loan_type)] += 1
+        if len(snapshots) >= 1000:
+            AnalyticsSnapshot.objects.bulk_create(snapshots)
+            snapshots = []
+
+    AnalyticsSnapshot.objects.bulk_create(snapshots)
+    AnalyticsDailyRollup.objects.bulk_create([
+        AnalyticsDailyRollup(representative_id=representative_id, day=day, lead_type=lead_type, sentiment=sentiment, loan_type=loan_type, count=count)
+        for (representative_id, day, lead_type, sentiment, loan_type), count in buckets.items()
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analytics', '0002_analyticscacheentry'),
+        ('chat', '0008_message_text_search_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnalyticsDailyRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('lead_type', models.CharField(max_length=20)),
+                ('sentiment', models.CharField(max_length=20)),
+                ('loan_type', models.CharField(max_length=255)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('representative', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['day'], name='analytics_rollup_day_idx')],
+                'constraints': [models.UniqueConstraint(fields=('representative', 'day', 'lead_type', 'sentiment', 'loan_type'), name='analytics_rollup_unique_bucket')],
+            },
+        ),
+        migrations.CreateModel(
+            name='AnalyticsSnapshot',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('summary', models.TextField()),
+                ('sentiment', models.CharField(max_length=20)),
+                ('loan_type', models.CharField(max_length=255)),
+                ('lead_type', models.CharField(max_length=20)),
+                ('rationale', models.TextField()),
+                ('message_count', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('conversation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='analytics_snapshots', to='chat.conversation')),
+                ('representative', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['conversation', '-created_at', '-id'], name='analytics_snap_conv_idx')],
+            },
+        ),
+        migrations.RunPython(backfill_snapshots, migrations.RunPython.noop),
+    ]
@@ -1,3 +1,93 @@
+import uuid
 from django.db import models
+from django.utils import timezone
+from authapp.models import MyUser
+from chat.models import Conversation, Messages
 
 # Create your models here.
+
+# latest analytics of a conversation along with the last message it covered
+# so on the next refresh only the messages after last_message are sent to the LLM
+class ConversationAnalytics(models.Model):
+    conversation = models.OneToOneField(Conversation, on_delete=models.CASCADE, related_name='analytics')
+    summary = models.TextField()
+    sentiment = models.CharField(max_length=20)
+    loan_type = models.CharField(max_length=255)
+    lead_type = models.CharField(max_length=20)
+    rationale = models.TextField()
+    # if the message gets deleted, the next refresh falls back to the full transcript
+    last_message = models.ForeignKey(Messages, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def as_dict(self):
+        return {
+            'summary': self.summary,
+            'sentiment': self.sentiment,
+            'loan_type': self.loan_type,
+            'lead_type': self.lead_type,
+            'rationale': self.rationale,
+        }
+
+    def __str__(self):
+        return f"Analytics for Conversation ID : {self.conversation_id}"
+
+
+# persisted tier of the analytics cache
+# key is the hash of the normalized transcript sent to the LLM
+class AnalyticsCacheEntry(models.Model):
+    key = models.CharField(max_length=64, unique=True)
+    result = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return f"Analytics Cache Entry : {self.key}"
+
+
+# every analytics result saved for a conversation, kept for reporting / history
+# (ConversationAnalytics only has the latest one)
+class AnalyticsSnapshot(models.Model):
+    id = models.UUIDField(default=uuid.uuid4, primary_key=True, editable=False)
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='analytics_snapshots')
+    # representative of the conversation when the snapshot was taken
+    representative = models.ForeignKey(MyUser, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    summary = models.TextField()
+    sentiment = models.CharField(max_length=20)
+    loan_type = models.CharField(max_length=255)
+    lead_type = models.CharField(max_length=20)
+    rationale = models.TextField()
+    # messages analysed for this snapshot (new messages of an incremental refresh)
+    message_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            # history of a conversation is read newest first with (created_at, id) as the cursor
+            models.Index(fields=['conversation', '-created_at', '-id'], name='analytics_snap_conv_idx'),
+        ]
+
+    def __str__(self):
+        return f"Analytics Snapshot of Conversation ID : {self.conversation_id} at {self.created_at}"
+
+
+# number of conversations of a representative whose analytics on that day ended with these values
+# kept up to date when results are saved (analytics.reporting.record_result), so reports sum a few
+# of these rows instead of going through the snapshots
+class AnalyticsDailyRollup(models.Model):
+    representative = models.ForeignKey(MyUser, on_delete=models.CASCADE, related_name='+')
+    day = models.DateField()
+    lead_type = models.CharField(max_length=20)
+    sentiment = models.CharField(max_length=20)
+    loan_type = models.CharField(max_length=255)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['representative', 'day', 'lead_type', 'sentiment', 'loan_type'], name='analytics_rollup_unique_bucket'),
+        ]
+        indexes = [
+            # reports over all representatives for a date range
+            models.Index(fields=['day'], name='analytics_rollup_day_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.day} {self.representative_id} {self.lead_type}/{self.sentiment}/{self.loan_type}: {self.count}"
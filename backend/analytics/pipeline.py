@@ -0,0 +1,275 @@
+# incremental analytics for a conversation stored on the server
+# keeps the last result in ConversationAnalytics and only sends the new messages to the LLM
+
+from collections import defaultdict
+from django.conf import settings
+from django.db.models import Q
+from chat.models import Conversation, Messages
+from .models import ConversationAnalytics
+from .reporting import record_result
+from . import cache
+from .classifier import classify, guess_lead_type
+from .transcript import build_transcript
+from channels.db import database_sync_to_async
+from . import resilience
+from .resilience import LLMUnavailable
+from .services import AnaltyicsModel, STREAM_FIELD_ORDER, invoke_analytics, batch_analytics, astream_analytics, build_prompt, build_incremental_prompt, build_stream_prompt
+
+
+# number of LLM calls running at the same time for the batch endpoint
+BATCH_CONCURRENCY = getattr(settings, 'ANALYTICS_BATCH_CONCURRENCY', 5)
+# local classifier answer is used only if its confidence is at least this much
+LOCAL_CONFIDENCE = getattr(settings, 'ANALYTICS_LOCAL_CONFIDENCE', 0.6)
+# LLM still runs once this many messages are not covered by its last result
+LLM_EVERY_N_MESSAGES = getattr(settings, 'ANALYTICS_LLM_EVERY_N_MESSAGES', 5)
+# never call the LLM, only the local classifier (offline / tests)
+LOCAL_ONLY = getattr(settings, 'ANALYTICS_LOCAL_ONLY', False)
+
+
+# converting the message rows to the format used in the prompt
+# sender is the role (customer / representative) so LLM knows who said what
+def serialize_messages(messages):
+    return [{'sender': message.sender.user_type, 'text': message.text} for message in messages]
+
+
+# filter for the messages which came after the last message covered by the stored analytics
+def new_messages_filter(conversation_id, state):
+    condition = Q(conversation_id=conversation_id)
+
+    if state and state.last_message:
+        last = state.last_message
+        condition &= (
+            Q(created_at__gt=last.created_at) |
+            Q(created_at=last.created_at, id__gt=last.id)
+        )
+
+    return condition
+
+
+def get_new_messages(conversation_id, state):
+    messages = Messages.objects.filter(new_messages_filter(conversation_id, state)).select_related('sender').order_by('created_at', 'id')
+    return list(messages)
+
+
+# cache key for the new messages and a function building their prompt
+# same previous analytics + same new messages => same result, so LLM is skipped on a cache hit
+# the prompt is only built on a miss, building it counts it in prompt_stats as sent to the LLM
+def prepare_request(state, new_messages):
+    serialized = serialize_messages(new_messages)
+    previous = state.as_dict() if state and state.last_message else None
+
+    def get_prompt():
+        transcript = build_transcript(serialized)
+        if previous is not None:
+            return build_incremental_prompt(previous, transcript)
+        return build_prompt(transcript)
+
+    return cache.make_cache_key(serialized, previous), get_prompt
+
+
+# latest analytics of the conversation, kept along with a snapshot and the daily rollups for reporting
+def save_result(conversation_id, output, new_messages):
+    record_result(conversation_id, output, new_messages)
+
+
+# first tier - answers sentiment and loan_type from the local classifier on top of the stored analytics
+# returns None when the LLM is needed (no LLM result yet, low confidence or LLM_EVERY_N_MESSAGES reached)
+# the stored state is not updated, so the next LLM call still gets all the messages it has not seen
+def local_analytics(state, new_messages):
+    local = classify(serialize_messages(new_messages))
+
+    if not LOCAL_ONLY:
+        # summary, lead_type and rationale only come from the LLM, so it has to run at least once
+        if not state or not state.last_message:
+            return None
+        if len(new_messages) >= LLM_EVERY_N_MESSAGES:
+            return None
+        # no prediction means the new messages say nothing about the field, previous value is kept
+        for prediction in local.values():
+            if prediction is not None and prediction[1] < LOCAL_CONFIDENCE:
+                return None
+
+    if state:
+        result = state.as_dict()
+    else:
+        result = {
+            'summary': 'No details',
+            'sentiment': 'neutral',
+            'loan_type': 'No details',
+            'lead_type': guess_lead_type(local),
+            'rationale': 'No details',
+        }
+
+    for field, prediction in local.items():
+        if prediction is not None:
+            result[field] = prediction[0]
+    return result
+
+
+# last stored analytics marked as stale, served when the LLM is unavailable
+# None if the conversation was never analysed
+def stale_result(state):
+    if not state:
+        return None
+    resilience.stats.increment('stale_served')
+    return {**state.as_dict(), 'stale': True}
+
+
+# loading everything needed before the LLM call, returns (state, new_messages)
+# raises Conversation.DoesNotExist if the conversation is not present
+def load_conversation(conversation_id):
+    if not Conversation.objects.filter(id=conversation_id).exists():
+        raise Conversation.DoesNotExist(f"Conversation with id {conversation_id} does not exist.")
+
+    state = ConversationAnalytics.objects.filter(conversation_id=conversation_id).select_related('last_message').first()
+    return state, get_new_messages(conversation_id, state)
+
+
+# returns the analytics dict for the conversation or None if it has no messages yet
+# raises Conversation.DoesNotExist if the conversation is not present
+def analyze_conversation(conversation_id):
+    state, new_messages = load_conversation(conversation_id)
+
+    # nothing new since last refresh - stored result is still up to date
+    if not new_messages:
+        return state.as_dict() if state else None
+
+    local = local_analytics(state, new_messages)
+    if local is not None:
+        return local
+
+    key, get_prompt = prepare_request(state, new_messages)
+    try:
+        output = cache.get_or_compute(key, lambda: invoke_analytics(get_prompt()).model_dump())
+    except LLMUnavailable:
+        stale = stale_result(state)
+        if stale is None:
+            raise
+        return stale
+
+    save_result(conversation_id, output, new_messages)
+    return output
+
+
+# streaming version of analyze_conversation, yields (event, data) tuples
+# field - sentiment / lead_type / loan_type as soon as their value is complete
+# delta - newly generated part of summary / rationale
+# done - complete analytics (also sent alone when the result comes from the stored state or cache)
+async def stream_conversation(conversation_id):
+    state, new_messages = await database_sync_to_async(load_conversation)(conversation_id)
+
+    if not new_messages:
+        yield 'done', state.as_dict() if state else None
+        return
+
+    local = local_analytics(state, new_messages)
+    if local is not None:
+        yield 'done', local
+        return
+
+    key, get_prompt = prepare_request(state, new_messages)
+    cached = await database_sync_to_async(cache.lookup)(key)
+    if cached is not None:
+        await database_sync_to_async(save_result)(conversation_id, cached, new_messages)
+        yield 'done', cached
+        return
+
+    sent_fields = set()
+    sent_text = {'summary': '', 'rationale': ''}
+    partial = {}
+    try:
+        async for partial in astream_analytics(build_stream_prompt(get_prompt())):
+            if not isinstance(partial, dict):
+                continue
+
+            # keys appear in the order the model writes them
+            keys = list(partial)
+            for position, field in enumerate(keys):
+                if field in sent_text:
+                    text = str(partial[field] or '')
+                    if len(text) > len(sent_text[field]):
+                        yield 'delta', {'field': field, 'text': text[len(sent_text[field]):]}
+                        sent_text[field] = text
+                # value is complete once the model moved to the next key
+                elif field in STREAM_FIELD_ORDER and field not in sent_fields and position < len(keys) - 1:
+                    sent_fields.add(field)
+                    yield 'field', {field: partial[field]}
+    except LLMUnavailable:
+        # once part of the answer is out the client has to handle the error
+        if sent_fields or any(sent_text.values()):
+            raise
+        stale = stale_result(state)
+        if stale is None:
+            raise
+        yield 'done', stale
+        return
+
+    output = AnaltyicsModel.model_validate(partial).model_dump()
+    await database_sync_to_async(cache.store)(key, output)
+    await database_sync_to_async(save_result)(conversation_id, output, new_messages)
+    yield 'done', output
+
+
+# analytics for many conversations at once
+# new messages of all conversations are loaded in one query and the LLM calls which are not cached
+# go through a single batch call, returns {conversation_id: {"analytics": ...} or {"error": ...}}
+def analyze_conversations(conversation_ids, max_concurrency=None):
+    results = {}
+
+    existing = set(Conversation.objects.filter(id__in=conversation_ids).values_list('id', flat=True))
+    for conversation_id in conversation_ids:
+        if conversation_id not in existing:
+            results[conversation_id] = {'error': 'Conversation not found'}
+
+    if not existing:
+        return results
+
+    states = {
+        state.conversation_id: state
+        for state in ConversationAnalytics.objects.filter(conversation_id__in=existing).select_related('last_message')
+    }
+
+    condition = Q()
+    for conversation_id in existing:
+        condition |= new_messages_filter(conversation_id, states.get(conversation_id))
+
+    new_messages = defaultdict(list)
+    for message in Messages.objects.filter(condition).select_related('sender').order_by('created_at', 'id'):
+        new_messages[message.conversation_id].append(message)
+
+    # conversations which need an LLM call - (conversation_id, key, prompt)
+    pending = []
+    for conversation_id in existing:
+        state = states.get(conversation_id)
+        if not new_messages[conversation_id]:
+            results[conversation_id] = {'analytics': state.as_dict() if state else None}
+            continue
+
+        local = local_analytics(state, new_messages[conversation_id])
+        if local is not None:
+            results[conversation_id] = {'analytics': local}
+            continue
+
+        key, get_prompt = prepare_request(state, new_messages[conversation_id])
+        output = cache.lookup(key)
+        if output is not None:
+            save_result(conversation_id, output, new_messages[conversation_id])
+            results[conversation_id] = {'analytics': output}
+        else:
+            pending.append((conversation_id, key, get_prompt()))
+
+    if pending:
+        outputs = batch_analytics([prompt for _, _, prompt in pending], max_concurrency or BATCH_CONCURRENCY)
+        for (conversation_id, key, _), output in zip(pending, outputs):
+            # one failed conversation should not fail the whole batch
+            if isinstance(output, Exception):
+                stale = stale_result(states.get(conversation_id)) if isinstance(output, LLMUnavailable) else None
+                results[conversation_id] = {'analytics': stale} if stale else {'error': str(output)}
+                continue
+
+            output = output.model_dump()
+            cache.store(key, output)
+            save_result(conversation_id, output, new_messages[conversation_id])
+            results[conversation_id] = {'analytics': output}
+
+    return results
@@ -0,0 +1,105 @@
+# reporting on the saved analytics results
+# every saved result is kept as an AnalyticsSnapshot and moves its conversation between the
+# AnalyticsDailyRollup buckets of the representative for the day, so a bucket counts the conversations
+# whose last result of that day had its lead_type / sentiment / loan_type
+# a result costs a few small writes, reports only sum the bucket rows of the date range
+
+from django.db import transaction, IntegrityError
+from django.db.models import F, Sum
+from django.utils import timezone
+from authapp.models import MyUser
+from chat.models import Conversation
+from .models import ConversationAnalytics, AnalyticsSnapshot, AnalyticsDailyRollup
+
+
+ROLLUP_FIELDS = ('lead_type', 'sentiment', 'loan_type')
+# what a report can be grouped by
+REPORT_DIMENSIONS = ('representative', 'day') + ROLLUP_FIELDS
+
+
+def get_representative_id(conversation):
+    return MyUser.objects.filter(
+        id__in=[conversation.user1_id, conversation.user2_id],
+        user_type='representative'
+    ).values_list('id', flat=True).first()
+
+
+# adds change (+1 / -1) to the count of a bucket, the bucket row is created on its first conversation
+def change_bucket(representative_id, day, values, change):
+    bucket = AnalyticsDailyRollup.objects.filter(representative_id=representative_id, day=day, **values)
+    if change < 0:
+        bucket.filter(count__gte=-change).update(count=F('count') + change)
+        return
+
+    if bucket.update(count=F('count') + change):
+        return
+    try:
+        with transaction.atomic():
+            AnalyticsDailyRollup.objects.create(representative_id=representative_id, day=day, count=change, **values)
+    except IntegrityError:
+        # created by a parallel save of another conversation
+        bucket.update(count=F('count') + change)
+
+
+# saves the result as the latest analytics of the conversation, as a snapshot and in the rollups, in one transaction
+# conversation row is locked so two saves of the same conversation do not move it between buckets at the same time
+def record_result(conversation_id, output, new_messages):
+    with transaction.atomic():
+        conversation = Conversation.objects.select_for_update().filter(id=conversation_id).only('user1_id', 'user2_id').first()
+        if conversation is None:
+            return
+
+        previous = ConversationAnalytics.objects.filter(conversation_id=conversation_id).values(*ROLLUP_FIELDS, 'updated_at').first()
+        ConversationAnalytics.objects.update_or_create(
+            conversation_id=conversation_id,
+            defaults={**output, 'last_message': new_messages[-1]}
+        )
+
+        now = timezone.now()
+        representative_id = get_representative_id(conversation)
+        AnalyticsSnapshot.objects.create(
+            conversation_id=conversation_id,
+            representative_id=representative_id,
+            summary=output['summary'],
+            sentiment=output['sentiment'],
+            loan_type=output['loan_type'],
+            lead_type=output['lead_type'],
+            rationale=output['rationale'],
+            message_count=len(new_messages),
+            created_at=now,
+        )
+
+        if representative_id is None:
+            return
+
+        # conversation already counted today - it leaves the bucket of its earlier result
+        # (earlier days keep the result the conversation had at their end)
+        day = timezone.localdate(now)
+        values = {field: output[field] for field in ROLLUP_FIELDS}
+        if previous and timezone.localdate(previous['updated_at']) == day:
+            previous_values = {field: previous[field] for field in ROLLUP_FIELDS}
+            if previous_values == values:
+                return
+            change_bucket(representative_id, day, previous_values, -1)
+        change_bucket(representative_id, day, values, 1)
+
+
+# conversation counts of the rollups between date_from and date_to (both included), grouped by group_by
+def build_report(date_from, date_to, group_by, representative_id=None):
+    rows = AnalyticsDailyRollup.objects.filter(day__gte=date_from, day__lte=date_to, count__gt=0)
+    if representative_id is not None:
+        rows = rows.filter(representative_id=representative_id)
+
+    if not group_by:
+        return [{'conversations': rows.aggregate(conversations=Sum('count'))['conversations'] or 0}]
+
+    fields = ['representative_id' if dimension == 'representative' else dimension for dimension in group_by]
+    rows = rows.values(*fields).annotate(conversations=Sum('count')).order_by(*fields)
+
+    return [
+        {
+            **{dimension: row[field] for dimension, field in zip(group_by, fields)},
+            'conversations': row['conversations'],
+        }
+        for row in rows
+    ]
@@ -0,0 +1,234 @@
+# failure handling around the LLM calls
+# every attempt has a deadline, failed attempts are retried with jittered backoff and
+# a circuit breaker stops calling the LLM for a while when it keeps failing
+# optionally a second (hedged) request is sent when the first one is slow, whichever finishes first wins
+
+import time
+import random
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from django.conf import settings
+from .metrics import Counters
+
+
+# seconds one attempt may take
+TIMEOUT_SECONDS = getattr(settings, 'ANALYTICS_LLM_TIMEOUT_SECONDS', 30)
+# extra attempts after the first one fails
+MAX_RETRIES = getattr(settings, 'ANALYTICS_LLM_MAX_RETRIES', 2)
+BACKOFF_BASE_SECONDS = getattr(settings, 'ANALYTICS_LLM_BACKOFF_BASE_SECONDS', 0.5)
+BACKOFF_MAX_SECONDS = getattr(settings, 'ANALYTICS_LLM_BACKOFF_MAX_SECONDS', 8)
+# failed attempts in a row which open the circuit, and how long it stays open
+BREAKER_FAILURE_THRESHOLD = getattr(settings, 'ANALYTICS_LLM_BREAKER_FAILURE_THRESHOLD', 5)
+BREAKER_RESET_SECONDS = getattr(settings, 'ANALYTICS_LLM_BREAKER_RESET_SECONDS', 30)
+# send a duplicate request if the first has not answered after this many seconds, None = never
+HEDGE_AFTER_SECONDS = getattr(settings, 'ANALYTICS_LLM_HEDGE_AFTER_SECONDS', None)
+# threads running the LLM calls, an attempt past its deadline keeps its thread until the call returns
+CALL_WORKERS = getattr(settings, 'ANALYTICS_LLM_CALL_WORKERS', 16)
+
+
+class LLMUnavailable(Exception):
+    pass
+
+
+# raised without calling the LLM while the circuit is open
+class CircuitOpen(LLMUnavailable):
+    pass
+
+
+class LLMTimeout(Exception):
+    pass
+
+
+class CircuitBreaker:
+    CLOSED = 'closed'
+    OPEN = 'open'
+    # reset time passed, one trial call is let through to check if the LLM is back
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold, reset_seconds):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.opened_at = None
+            self._trial_running = False
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < self.reset_seconds:
+                    return False
+                self.state = self.HALF_OPEN
+                self._trial_running = False
+
+            if self._trial_running:
+                return False
+            self._trial_running = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    stats.increment('circuit_opened')
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self._trial_running = False
+
+    # trial call ended without a result (e.g. cancelled), next caller may try again
+    def release(self):
+        with self._lock:
+            self._trial_running = False
+
+    def as_dict(self):
+        with self._lock:
+            return {'state': self.state, 'failures': self.failures}
+
+
+stats = Counters([
+    'calls', 'attempts', 'successes', 'failures', 'timeouts', 'retries',
+    'hedged', 'hedge_wins', 'short_circuited', 'circuit_opened', 'stale_served',
+])
+breaker = CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_SECONDS)
+_executor = ThreadPoolExecutor(max_workers=CALL_WORKERS, thread_name_prefix='analytics-llm')
+
+
+# full jitter - random wait between 0 and the exponential backoff, so retries of many workers do not line up
+def backoff_seconds(attempt):
+    return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+
+# one attempt with a deadline, plus the hedged duplicate if the first request is slow
+def _attempt(fn, timeout, hedge_after):
+    deadline = time.monotonic() + timeout
+    primary = _executor.submit(fn)
+    running = [primary]
+
+    if hedge_after is not None and hedge_after < timeout:
+        done, _ = wait(running, timeout=hedge_after)
+        if not done:
+            stats.increment('hedged')
+            running.append(_executor.submit(fn))
+
+    error = None
+    while running:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        done, _ = wait(running, timeout=remaining, return_when=FIRST_COMPLETED)
+        if not done:
+            break
+
+        for future in done:
+            running.remove(future)
+            if future.exception() is None:
+                if future is not primary:
+                    stats.increment('hedge_wins')
+                for other in running:
+                    other.cancel()
+                return future.result()
+            error = future.exception()
+
+    # all requests failed before the deadline
+    if not running:
+        raise error
+
+    for future in running:
+        future.cancel()
+    stats.increment('timeouts')
+    raise LLMTimeout(f"LLM did not answer within {timeout} seconds.")
+
+
+# default of call(hedge_after=...), None is a valid value there (no hedging)
+_SETTING = object()
+
+
+# calls fn() with deadline, retries and circuit breaker, raises LLMUnavailable when no result could be had
+# hedging sends the same request twice, so only use it for calls which are safe to repeat
+# hedge_after defaults to HEDGE_AFTER_SECONDS, None turns hedging off for this call
+def call(fn, timeout=None, retries=None, hedge_after=_SETTING):
+    timeout = TIMEOUT_SECONDS if timeout is None else timeout
+    retries = MAX_RETRIES if retries is None else retries
+    hedge_after = HEDGE_AFTER_SECONDS if hedge_after is _SETTING else hedge_after
+
+    stats.increment('calls')
+    error = None
+    for attempt in range(retries + 1):
+        if not breaker.allow():
+            stats.increment('short_circuited')
+            raise CircuitOpen("LLM is unavailable, circuit is open.") from error
+
+        if attempt:
+            stats.increment('retries')
+        stats.increment('attempts')
+        try:
+            result = _attempt(fn, timeout, hedge_after)
+        except Exception as e:
+            error = e
+            stats.increment('failures')
+            breaker.record_failure()
+            print(f"LLM attempt {attempt + 1} failed: {e!r}")
+            if attempt < retries:
+                time.sleep(backoff_seconds(attempt))
+            continue
+
+        stats.increment('successes')
+        breaker.record_success()
+        return result
+
+    raise LLMUnavailable(f"LLM call failed after {retries + 1} attempts: {error}") from error
+
+
+# async iterator version for streaming - circuit breaker and a deadline for every chunk
+# no retries, part of the answer may already be sent to the client
+async def stream(make_iterator, timeout=None):
+    timeout = TIMEOUT_SECONDS if timeout is None else timeout
+
+    stats.increment('calls')
+    if not breaker.allow():
+        stats.increment('short_circuited')
+        raise CircuitOpen("LLM is unavailable, circuit is open.")
+
+    stats.increment('attempts')
+    iterator = make_iterator().__aiter__()
+    try:
+        while True:
+            try:
+                chunk = await asyncio.wait_for(iterator.__anext__(), timeout)
+            except StopAsyncIteration:
+                break
+            except asyncio.TimeoutError:
+                stats.increment('timeouts')
+                raise LLMTimeout(f"LLM did not answer within {timeout} seconds.")
+            yield chunk
+    except Exception as e:
+        stats.increment('failures')
+        breaker.record_failure()
+        raise LLMUnavailable(f"LLM stream failed: {e}") from e
+    finally:
+        # also reached when the client goes away mid stream, that says nothing about the LLM
+        breaker.release()
+
+    stats.increment('successes')
+    breaker.record_success()
+
+
+def snapshot():
+    return {**stats.snapshot(), 'circuit': breaker.as_dict()}
@@ -0,0 +1,89 @@
+# per conversation scheduler for the background analytics jobs
+# requests coming within the debounce window are merged into one job and
+# at most one LLM call per conversation runs at a time, if messages arrive while it runs
+# its result is marked superseded and one more job runs after it with the latest messages
+
+import threading
+import time
+from django.conf import settings
+from . import jobs
+
+
+DEBOUNCE_SECONDS = getattr(settings, 'ANALYTICS_DEBOUNCE_SECONDS', 2.0)
+# continuous stream of requests should not postpone the analytics forever
+DEBOUNCE_MAX_WAIT_SECONDS = getattr(settings, 'ANALYTICS_DEBOUNCE_MAX_WAIT_SECONDS', 10.0)
+
+
+class _ConversationState:
+    def __init__(self):
+        # job which will start once the debounce window is over, returned to all merged requests
+        self.pending_job = None
+        self.first_request_at = None
+        self.timer = None
+        # job whose LLM call is currently running
+        self.running_job = None
+
+
+_states = {}
+_lock = threading.Lock()
+
+
+# returns the job which will cover this request
+def request(conversation_id):
+    with _lock:
+        state = _states.setdefault(conversation_id, _ConversationState())
+
+        if state.pending_job is None:
+            state.pending_job = jobs.create(conversation_id)
+            state.first_request_at = time.monotonic()
+
+        if state.timer:
+            state.timer.cancel()
+
+        waited = time.monotonic() - state.first_request_at
+        delay = max(0.0, min(DEBOUNCE_SECONDS, DEBOUNCE_MAX_WAIT_SECONDS - waited))
+        state.timer = threading.Timer(delay, _fire, args=(conversation_id,))
+        state.timer.daemon = True
+        state.timer.start()
+
+        return state.pending_job
+
+
+def _fire(conversation_id):
+    with _lock:
+        state = _states.get(conversation_id)
+        if state is None or state.pending_job is None:
+            return
+        state.timer = None
+
+        # one LLM call per conversation - pending job starts when the running one finishes
+        if state.running_job is not None:
+            return
+
+        job = state.pending_job
+        state.pending_job = None
+        state.first_request_at = None
+        state.running_job = job
+
+    jobs.start(job, on_finish=lambda finished_job: _finished(conversation_id, finished_job))
+
+
+def _finished(conversation_id, job):
+    start_next = False
+    with _lock:
+        state = _states.get(conversation_id)
+        if state is None:
+            return
+        state.running_job = None
+
+        if state.pending_job is not None:
+            # newer messages are waiting, so this result is already stale
+            if job.status == jobs.AnalyticsJob.DONE:
+                job.status = jobs.AnalyticsJob.SUPERSEDED
+            # debounce window of the pending job is already over, it was only waiting for this job
+            start_next = state.timer is None
+        else:
+            del _states[conversation_id]
+
+    if start_next:
+        _fire(conversation_id)
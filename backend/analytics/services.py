@@ -1,12 +1,21 @@
 # contains the LLM for analytics with structured output enabled
+# LLM client is created on first use (not on import), so migrate / tests / worker startup
+# do not load the LangChain + Google stack, one client per process is reused for every call
 
-from langchain_google_genai import ChatGoogleGenerativeAI
+import threading
+from django.conf import settings
+from django.utils.module_loading import import_string
 from pydantic import BaseModel, Field
 from typing import Literal
+from . import resilience
 # from dotenv import load_dotenv
 # load_dotenv()
 
-llm = ChatGoogleGenerativeAI(model='gemini-2.5-flash')
+
+# 'gemini', 'fake' (local deterministic LLM for tests) or dotted path of a backend class
+LLM_BACKEND = getattr(settings, 'ANALYTICS_LLM_BACKEND', 'gemini')
+LLM_MODEL = getattr(settings, 'ANALYTICS_LLM_MODEL', 'gemini-2.5-flash')
+
 
 class AnaltyicsModel(BaseModel):
     summary: str = Field(description='Give the summary of the entire conversation that happened so far in 5 to 10 lines')
@@ -15,4 +24,112 @@ class AnaltyicsModel(BaseModel):
     lead_type: Literal["hot", "warm", "cold"] = Field(description='Categorize customer to determine their suitability and potential for becoming a customer. Hot = high potential, Warm=medium potential, Cold=minimal potential')
     rationale: str = Field(description='The reason behing classifying this use of a particular lead_type')
 
-structured_llm = llm.with_structured_output(AnaltyicsModel)
\ No newline at end of file
+
+# streaming mode - model writes plain JSON which is parsed while it is being generated
+# short fields are asked first, so they are known before the long summary / rationale text
+STREAM_FIELD_ORDER = ['sentiment', 'lead_type', 'loan_type', 'summary', 'rationale']
+
+
+# backend = object with
+# structured - runnable returning AnaltyicsModel (invoke / batch)
+# streaming - runnable yielding partial dicts of the JSON output (astream)
+class GeminiBackend:
+    def __init__(self):
+        from langchain_google_genai import ChatGoogleGenerativeAI
+        from langchain_core.output_parsers import JsonOutputParser
+
+        # the chat model keeps its own HTTP / gRPC client, reusing the instance reuses its connections
+        self.llm = ChatGoogleGenerativeAI(model=LLM_MODEL)
+        self.structured = self.llm.with_structured_output(AnaltyicsModel)
+        self.streaming = self.llm | JsonOutputParser(pydantic_object=AnaltyicsModel)
+
+
+BACKENDS = {
+    'gemini': 'analytics.services.GeminiBackend',
+    'fake': 'analytics.fake_llm.FakeBackend',
+}
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    global _backend
+
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = import_string(BACKENDS.get(LLM_BACKEND, LLM_BACKEND))()
+    return _backend
+
+
+def get_structured_llm():
+    return get_backend().structured
+
+
+def get_streaming_llm():
+    return get_backend().streaming
+
+
+# LLM calls used by the analytics code, all go through the deadline / retry / circuit breaker layer
+# they raise resilience.LLMUnavailable when no answer could be had
+def invoke_analytics(prompt):
+    return resilience.call(lambda: get_structured_llm().invoke(prompt))
+
+
+# one result per prompt, failed prompts give the exception instead of failing the whole batch
+def batch_analytics(prompts, max_concurrency):
+    from langchain_core.runnables import RunnableLambda
+
+    return RunnableLambda(invoke_analytics).batch(prompts, config={'max_concurrency': max_concurrency}, return_exceptions=True)
+
+
+# yields partial dicts of the answer
+def astream_analytics(prompt):
+    return resilience.stream(lambda: get_streaming_llm().astream(prompt))
+
+
+# prompt used when analysing a conversation from the start
+# transcript is the compact text built by analytics.transcript
+def build_prompt(transcript):
+    return f'''
+        Based on following chat conversation between an bank customer and bank representative you need to provide me with these analytics. And only answer based on context if have no details simply return :- No details
+        1. Provide summary of the conversation happened so far
+        2. Sentiment of the user
+        3. If there is some chats related to loan, tell what type of loan does the user is asking for
+        4. Based on conversation tell the customer lead type
+        5. Also give the rationale behind classifying the user with the particular lead type
+        \n
+        context:
+        {transcript}
+    '''
+
+
+# prompt used when analytics were already generated for the earlier part of the conversation
+# only the previous analytics and the messages after it are sent, so the prompt size stays roughly constant
+def build_incremental_prompt(previous, transcript):
+    previous = '\n'.join(f'{field}: {value}' for field, value in previous.items())
+    return f'''
+        You already analysed the earlier part of a chat conversation between an bank customer and bank representative, those analytics are given below as previous analytics.
+        Update them using the new messages of the conversation and provide me with these analytics. And only answer based on context if have no details simply return :- No details
+        1. Provide summary of the whole conversation happened so far (merge the previous summary with the new messages)
+        2. Sentiment of the user
+        3. If there is some chats related to loan, tell what type of loan does the user is asking for
+        4. Based on conversation tell the customer lead type
+        5. Also give the rationale behind classifying the user with the particular lead type
+        \n
+        previous analytics:
+        {previous}
+        \n
+        new messages:
+        {transcript}
+    '''
+
+
+# same analytics prompt, but asking for raw JSON in STREAM_FIELD_ORDER
+def build_stream_prompt(prompt):
+    fields = ', '.join(STREAM_FIELD_ORDER)
+    return f'''{prompt}
+        Answer only with a JSON object having exactly these keys in this order: {fields}
+        sentiment is one of positive, negative, neutral and lead_type is one of hot, warm, cold
+    '''
@@ -1,3 +1,908 @@
-from django.test import TestCase
+import time
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+from asgiref.sync import sync_to_async
+from django.test import SimpleTestCase, TestCase
+from rest_framework.test import APITestCase, APITransactionTestCase
+from authapp.models import MyUser
+from chat.models import Conversation, Messages
+from datetime import timedelta
+from django.utils import timezone
+from .models import ConversationAnalytics, AnalyticsSnapshot, AnalyticsDailyRollup, AnalyticsCacheEntry
+from .services import AnaltyicsModel
+from .classifier import classify, classify_sentiment, classify_loan_type, guess_lead_type
+from . import services, cache, jobs, scheduler, pipeline, resilience, reporting, fake_llm as fake
+from .resilience import CircuitBreaker, CircuitOpen, LLMTimeout, LLMUnavailable
+from .metrics import prompt_stats
+from .transcript import build_transcript, estimate_tokens
+from . import transcript
 
-# Create your tests here.
+
+def create_user(email, user_type='customer', **extra_fields):
+    return MyUser.objects.create_user(email, 'password', first_name='Test', last_name='User', user_type=user_type, **extra_fields)
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("Condition not met in time")
+        time.sleep(0.01)
+
+
+# tests never call Gemini - services picks the fake backend, the cached backend is dropped so it is built again
+def fake_llm():
+    return mock.patch.multiple(services, LLM_BACKEND='fake', _backend=None)
+
+
+class AnalyticsFixtures:
+    def setUp(self):
+        cache.clear()
+        self.customer = create_user('customer@example.com')
+        self.representative = create_user('representative@example.com', 'representative')
+        self.conversation, _ = Conversation.objects.get_or_create_for_pair(self.customer.id, self.representative.id)
+
+    def add_messages(self, *texts, sender=None):
+        return [
+            Messages.objects.create(conversation=self.conversation, sender=sender or self.customer, text=text)
+            for text in texts
+        ]
+
+
+class AnalyticsTestCase(AnalyticsFixtures, APITestCase):
+    pass
+
+
+# database_sync_to_async closes the connection when it is inside a transaction,
+# so code going through it is tested without the transaction of TestCase
+class AsyncAnalyticsTestCase(AnalyticsFixtures, APITransactionTestCase):
+    pass
+
+
+class GetAnalyticsTests(AnalyticsTestCase):
+    def test_requires_authentication(self):
+        response = self.client.post('/analytics/', {'conversation_id': str(self.conversation.id)}, format='json')
+        self.assertEqual(response.status_code, 401)
+
+    def test_other_users_get_not_found(self):
+        self.add_messages('I need a home loan')
+        self.client.force_authenticate(create_user('other@example.com'))
+        response = self.client.post('/analytics/', {'conversation_id': str(self.conversation.id)}, format='json')
+        self.assertEqual(response.status_code, 404)
+
+    def test_participant_gets_analytics(self):
+        self.add_messages('I need a home loan')
+        self.client.force_authenticate(self.representative)
+        with fake_llm():
+            response = self.client.post('/analytics/', {'conversation_id': str(self.conversation.id)}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('summary', response.data)
+
+    def test_staff_gets_analytics(self):
+        self.add_messages('I need a home loan')
+        self.client.force_authenticate(create_user('staff@example.com', 'representative', is_staff=True))
+        with fake_llm():
+            response = self.client.post('/analytics/', {'conversation_id': str(self.conversation.id)}, format='json')
+        self.assertEqual(response.status_code, 200)
+
+
+class GetBatchAnalyticsTests(AnalyticsTestCase):
+    def test_requires_authentication(self):
+        response = self.client.post('/analytics/batch/', {'conversation_ids': [str(self.conversation.id)]}, format='json')
+        self.assertEqual(response.status_code, 401)
+
+    def test_only_own_conversations_are_analysed(self):
+        self.add_messages('I need a home loan')
+        other = create_user('other@example.com')
+        other_conversation, _ = Conversation.objects.get_or_create_for_pair(other.id, self.representative.id)
+        Messages.objects.create(conversation=other_conversation, sender=other, text='I need a car loan')
+
+        self.client.force_authenticate(self.customer)
+        with fake_llm():
+            response = self.client.post('/analytics/batch/', {'conversation_ids': [str(self.conversation.id), str(other_conversation.id)]}, format='json')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('analytics', response.data[str(self.conversation.id)])
+        self.assertEqual(response.data[str(other_conversation.id)], {'error': 'Conversation not found'})
+        self.assertFalse(ConversationAnalytics.objects.filter(conversation=other_conversation).exists())
+
+
+class GetAnalyticsJobTests(AnalyticsTestCase):
+    def setUp(self):
+        super().setUp()
+        self.job = jobs.AnalyticsJob(self.conversation.id)
+        self.job.status, self.job.result = jobs.AnalyticsJob.DONE, {'lead_type': 'hot'}
+        patch = mock.patch.dict(jobs._jobs, {self.job.id: self.job})
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_requires_authentication(self):
+        self.assertEqual(self.client.get(f'/analytics/jobs/{self.job.id}/').status_code, 401)
+
+    def test_participant_gets_job(self):
+        self.client.force_authenticate(self.representative)
+        response = self.client.get(f'/analytics/jobs/{self.job.id}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['analytics'], {'lead_type': 'hot'})
+
+    def test_other_user_gets_not_found(self):
+        self.client.force_authenticate(create_user('other@example.com'))
+        self.assertEqual(self.client.get(f'/analytics/jobs/{self.job.id}/').status_code, 404)
+
+    def test_unknown_job(self):
+        self.client.force_authenticate(self.customer)
+        self.assertEqual(self.client.get(f'/analytics/jobs/{uuid.uuid4()}/').status_code, 404)
+
+
+class StreamAnalyticsTests(AsyncAnalyticsTestCase):
+    def get_token(self, user):
+        self.client.force_authenticate(user)
+        response = self.client.post(f'/analytics/stream/{self.conversation.id}/ticket/')
+        self.client.force_authenticate(None)
+        return response
+
+    def test_token_requires_participant(self):
+        self.assertEqual(self.client.post(f'/analytics/stream/{self.conversation.id}/ticket/').status_code, 401)
+        self.assertEqual(self.get_token(create_user('other@example.com')).status_code, 404)
+        self.assertEqual(self.get_token(self.representative).status_code, 200)
+
+    async def test_stream_requires_token(self):
+        response = await self.async_client.get(f'/analytics/stream/{self.conversation.id}/')
+        self.assertEqual(response.status_code, 401)
+
+        response = await self.async_client.get(f'/analytics/stream/{self.conversation.id}/', {'token': 'forged'})
+        self.assertEqual(response.status_code, 401)
+
+    async def test_token_is_bound_to_the_conversation(self):
+        token = (await sync_to_async(self.get_token)(self.representative)).data['token']
+        response = await self.async_client.get(f'/analytics/stream/{uuid.uuid4()}/', {'token': token})
+        self.assertEqual(response.status_code, 404)
+
+    async def test_stream_with_token(self):
+        await sync_to_async(self.add_messages)('I need a home loan')
+        token = (await sync_to_async(self.get_token)(self.representative)).data['token']
+
+        with fake_llm():
+            response = await self.async_client.get(f'/analytics/stream/{self.conversation.id}/', {'token': token})
+            body = b''.join([chunk async for chunk in response.streaming_content]).decode()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('event: done', body)
+
+    async def test_stream_conversation(self):
+        await sync_to_async(self.add_messages)('I need a home loan')
+
+        with fake_llm():
+            events = [event async for event in pipeline.stream_conversation(self.conversation.id)]
+        names = [name for name, _ in events]
+        self.assertIn('field', names)
+        self.assertIn('delta', names)
+        self.assertEqual(names[-1], 'done')
+
+        # deltas put together give the final text
+        summary = ''.join(data['text'] for name, data in events if name == 'delta' and data['field'] == 'summary')
+        self.assertEqual(summary, events[-1][1]['summary'])
+
+
+# whole pipeline against ANALYTICS_LLM_BACKEND = 'fake'
+@mock.patch.object(pipeline, 'LOCAL_ONLY', False)
+class FakeBackendTests(AnalyticsTestCase):
+    def setUp(self):
+        super().setUp()
+        patch = fake_llm()
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_fake_backend_is_used(self):
+        self.assertIsInstance(services.get_backend(), fake.FakeBackend)
+
+    def test_same_prompt_same_result(self):
+        self.assertEqual(fake.fake_analytics('I need a home loan'), fake.fake_analytics('I need a home loan'))
+        self.assertNotEqual(fake.fake_analytics('I need a home loan').summary, fake.fake_analytics('I need a car loan').summary)
+
+    def test_analyze_conversation(self):
+        messages = self.add_messages('Great, thanks! I need a home loan')
+
+        result = pipeline.analyze_conversation(self.conversation.id)
+        self.assertTrue(result['summary'].startswith('Fake summary'))
+        self.assertEqual(result['loan_type'], 'Home Loan')
+
+        state = ConversationAnalytics.objects.get(conversation=self.conversation)
+        self.assertEqual(state.last_message_id, messages[-1].id)
+        # nothing new - stored result without another LLM call
+        with mock.patch.object(fake.FakeStructuredLLM, 'invoke', side_effect=AssertionError("LLM called")):
+            self.assertEqual(pipeline.analyze_conversation(self.conversation.id), state.as_dict())
+
+    def test_only_new_messages_are_sent(self):
+        self.add_messages('I need a home loan')
+        pipeline.analyze_conversation(self.conversation.id)
+        self.add_messages(*['ok'] * 5, 'What about a car loan?')
+
+        with mock.patch.object(pipeline, 'build_incremental_prompt', wraps=pipeline.build_incremental_prompt) as build:
+            pipeline.analyze_conversation(self.conversation.id)
+        transcript = build.call_args.args[1]
+        self.assertIn('car loan', transcript)
+        self.assertNotIn('home loan', transcript)
+
+    def test_result_is_cached(self):
+        self.add_messages('I need a home loan')
+        pipeline.analyze_conversation(self.conversation.id)
+        self.assertEqual(cache.stats.snapshot()['misses'], 1)
+
+        # same messages in another conversation - answered from the cache
+        other = create_user('other@example.com')
+        other_conversation, _ = Conversation.objects.get_or_create_for_pair(other.id, self.representative.id)
+        Messages.objects.create(conversation=other_conversation, sender=other, text='I need a home loan')
+        with mock.patch.object(fake.FakeStructuredLLM, 'invoke', side_effect=AssertionError("LLM called")):
+            pipeline.analyze_conversation(other_conversation.id)
+
+    def test_analyze_conversations(self):
+        self.add_messages('I need a home loan')
+        other = create_user('other@example.com')
+        other_conversation, _ = Conversation.objects.get_or_create_for_pair(other.id, self.representative.id)
+        Messages.objects.create(conversation=other_conversation, sender=other, text='I need a car loan')
+        missing = uuid.uuid4()
+
+        results = pipeline.analyze_conversations([self.conversation.id, other_conversation.id, missing])
+        self.assertEqual(results[self.conversation.id]['analytics']['loan_type'], 'Home Loan')
+        self.assertEqual(results[other_conversation.id]['analytics']['loan_type'], 'Car Loan')
+        self.assertEqual(results[missing], {'error': 'Conversation not found'})
+        self.assertEqual(ConversationAnalytics.objects.count(), 2)
+
+    # prompt_stats count what was sent to the LLM, answers from the cache are not counted
+    def test_cache_hit_is_not_counted_as_prompt(self):
+        self.add_messages('I need a home loan')
+        prompt_stats.reset()
+        pipeline.analyze_conversation(self.conversation.id)
+        self.assertEqual(prompt_stats.snapshot()['prompts'], 1)
+
+        other = create_user('other@example.com')
+        other_conversation, _ = Conversation.objects.get_or_create_for_pair(other.id, self.representative.id)
+        Messages.objects.create(conversation=other_conversation, sender=other, text='I need a home loan')
+        before = prompt_stats.snapshot()
+        pipeline.analyze_conversation(other_conversation.id)
+        pipeline.analyze_conversations([other_conversation.id])
+        self.assertEqual(prompt_stats.snapshot(), before)
+
+    def test_cache_hit_of_client_transcript_is_not_counted_as_prompt(self):
+        self.client.force_authenticate(self.customer)
+        messages = [{'sender': 'customer', 'text': 'I need a home loan'}]
+        prompt_stats.reset()
+        self.assertEqual(self.client.post('/analytics/', {'messages': messages}, format='json').status_code, 200)
+        self.assertEqual(self.client.post('/analytics/', {'messages': messages}, format='json').status_code, 200)
+        self.assertEqual(prompt_stats.snapshot()['prompts'], 1)
+
+
+# memory tier with a timer the tests move, like UserCacheTests
+class CacheTests(AnalyticsTestCase):
+    def setUp(self):
+        super().setUp()
+        self.now = 0
+        self.use_memory(maxsize=10)
+
+    def use_memory(self, maxsize):
+        patch = mock.patch.object(cache, '_memory', cache._MemoryCache(maxsize=maxsize, ttl=cache.TTL_SECONDS, timer=lambda: self.now))
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def age_rows(self, seconds, **filters):
+        AnalyticsCacheEntry.objects.filter(**filters).update(created_at=timezone.now() - timedelta(seconds=seconds))
+
+    def test_get_or_compute(self):
+        compute = mock.Mock(return_value={'lead_type': 'hot'})
+        self.assertEqual(cache.get_or_compute('key', compute), {'lead_type': 'hot'})
+        self.assertEqual(cache.get_or_compute('key', compute), {'lead_type': 'hot'})
+        compute.assert_called_once()
+
+        stats = cache.stats.snapshot()
+        self.assertEqual((stats['misses'], stats['memory_hits'], stats['db_hits']), (1, 1, 0))
+        self.assertEqual(stats['hit_rate'], 0.5)
+
+    def test_cache_key_ignores_whitespace_and_client_fields(self):
+        key = cache.make_cache_key([{'sender': 'a', 'text': 'Hello  there', 'timestamp': 1}])
+        self.assertEqual(key, cache.make_cache_key([{'sender': 'a', 'text': ' Hello there\n', 'id': 'x'}]))
+        self.assertNotEqual(key, cache.make_cache_key([{'sender': 'b', 'text': 'Hello there'}]))
+        self.assertNotEqual(key, cache.make_cache_key([{'sender': 'a', 'text': 'Hello there'}], previous={'lead_type': 'hot'}))
+
+    def test_memory_entry_expires_and_db_entry_is_promoted(self):
+        cache.store('key', {'lead_type': 'hot'})
+        self.now += cache.TTL_SECONDS + 1
+        self.assertNotIn('key', cache._memory)
+
+        # still fresh in the table (written just now), read from there and put back in memory
+        self.assertEqual(cache.lookup('key'), {'lead_type': 'hot'})
+        self.assertIn('key', cache._memory)
+        AnalyticsCacheEntry.objects.all().delete()
+        self.assertEqual(cache.lookup('key'), {'lead_type': 'hot'})
+
+        stats = cache.stats.snapshot()
+        self.assertEqual((stats['db_hits'], stats['memory_hits']), (1, 1))
+
+    def test_memory_evicts_least_recently_used(self):
+        self.use_memory(maxsize=2)
+        cache.store('a', {'n': 1})
+        cache.store('b', {'n': 2})
+        cache.lookup('a')
+        cache.store('c', {'n': 3})
+
+        self.assertEqual(set(cache._memory), {'a', 'c'})
+        self.assertEqual(cache.stats.snapshot()['memory_evictions'], 1)
+
+    def test_expired_db_entry_is_a_miss(self):
+        cache.store('key', {'lead_type': 'hot'})
+        cache._memory.clear()
+        self.age_rows(cache.TTL_SECONDS + 1)
+
+        self.assertIsNone(cache.lookup('key'))
+        self.assertEqual(cache.stats.snapshot()['misses'], 1)
+
+    @mock.patch.object(cache, 'DB_MAX_ENTRIES', 2)
+    def test_prune(self):
+        for number, key in enumerate(['expired', 'old', 'newer', 'newest']):
+            cache.store(key, {'n': number})
+            self.age_rows(100 - number, key=key)
+        self.age_rows(cache.TTL_SECONDS + 1, key='expired')
+
+        self.assertEqual(cache.prune(), 2)
+        self.assertEqual(set(AnalyticsCacheEntry.objects.values_list('key', flat=True)), {'newer', 'newest'})
+        self.assertEqual(cache.stats.snapshot()['db_evictions'], 2)
+
+    @mock.patch.object(cache, 'DB_PRUNE_EVERY', 2)
+    @mock.patch.object(cache, '_db_writes', 0)
+    def test_store_prunes_every_n_writes(self):
+        with mock.patch.object(cache, 'prune') as prune:
+            cache.store('a', {'n': 1})
+            prune.assert_not_called()
+            cache.store('b', {'n': 2})
+            prune.assert_called_once()
+
+    def test_stats_need_staff(self):
+        for url in ('/analytics/cache/stats/', '/analytics/stats/'):
+            self.assertEqual(self.client.get(url).status_code, 401)
+            self.client.force_authenticate(self.representative)
+            self.assertEqual(self.client.get(url).status_code, 403)
+            self.client.force_authenticate(create_user(f'staff{len(url)}@example.com', 'representative', is_staff=True))
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.client.force_authenticate(None)
+        self.assertIn('hit_rate', response.data['cache'])
+
+# fresh breaker (opens after 3 failures, half open after 0.1 s) and no backoff waits
+@mock.patch.object(resilience, 'BACKOFF_BASE_SECONDS', 0)
+@mock.patch.object(resilience, 'HEDGE_AFTER_SECONDS', None)
+class ResilienceTests(SimpleTestCase):
+    def setUp(self):
+        patches = [
+            mock.patch.object(resilience, 'breaker', CircuitBreaker(3, 0.1)),
+            mock.patch.object(resilience, 'stats', resilience.Counters(list(resilience.stats.snapshot()))),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    # fn failing the first `failures` calls, sleeping `delays[n]` seconds on call n
+    def flaky(self, failures=0, delays=()):
+        calls = []
+
+        def fn():
+            calls.append(len(calls))
+            if len(calls) <= len(delays):
+                time.sleep(delays[len(calls) - 1])
+            if len(calls) <= failures:
+                raise RuntimeError(f"failure {len(calls)}")
+            return f"result {len(calls)}"
+
+        return fn, calls
+
+    def test_failed_attempts_are_retried(self):
+        fn, calls = self.flaky(failures=2)
+        self.assertEqual(resilience.call(fn, timeout=1, retries=2), 'result 3')
+        self.assertEqual(resilience.stats.snapshot()['retries'], 2)
+        self.assertEqual(resilience.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_unavailable_after_last_retry(self):
+        fn, calls = self.flaky(failures=10)
+        with self.assertRaises(LLMUnavailable) as raised:
+            resilience.call(fn, timeout=1, retries=1)
+        self.assertEqual(len(calls), 2)
+        self.assertIsInstance(raised.exception.__cause__, RuntimeError)
+
+    def test_timeout(self):
+        fn, calls = self.flaky(delays=[0.5])
+        with self.assertRaises(LLMUnavailable) as raised:
+            resilience.call(fn, timeout=0.05, retries=0)
+        self.assertIsInstance(raised.exception.__cause__, LLMTimeout)
+        self.assertEqual(resilience.stats.snapshot()['timeouts'], 1)
+
+    def test_breaker_opens_and_short_circuits(self):
+        fn, calls = self.flaky(failures=10)
+        with self.assertRaises(LLMUnavailable):
+            resilience.call(fn, timeout=1, retries=2)
+        self.assertEqual(resilience.breaker.state, CircuitBreaker.OPEN)
+
+        with self.assertRaises(CircuitOpen):
+            resilience.call(fn, timeout=1, retries=2)
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(resilience.stats.snapshot()['short_circuited'], 1)
+
+    def test_half_open_trial_closes_breaker(self):
+        for _ in range(3):
+            resilience.breaker.record_failure()
+        self.assertFalse(resilience.breaker.allow())
+
+        time.sleep(0.15)
+        # one trial call at a time while half open
+        self.assertTrue(resilience.breaker.allow())
+        self.assertEqual(resilience.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertFalse(resilience.breaker.allow())
+
+        resilience.breaker.record_success()
+        self.assertEqual(resilience.breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(resilience.breaker.allow())
+
+    def test_failed_trial_opens_breaker_again(self):
+        for _ in range(3):
+            resilience.breaker.record_failure()
+        time.sleep(0.15)
+
+        fn, calls = self.flaky(failures=1)
+        with self.assertRaises(CircuitOpen):
+            resilience.call(fn, timeout=1, retries=1)
+        # trial failed, the retry is short circuited
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(resilience.breaker.state, CircuitBreaker.OPEN)
+
+    def test_hedged_request_wins(self):
+        fn, calls = self.flaky(delays=[1.0])
+        self.assertEqual(resilience.call(fn, timeout=2, retries=0, hedge_after=0.05), 'result 2')
+        self.assertEqual(resilience.stats.snapshot()['hedged'], 1)
+        self.assertEqual(resilience.stats.snapshot()['hedge_wins'], 1)
+
+    def test_fast_answer_is_not_hedged(self):
+        fn, calls = self.flaky()
+        resilience.call(fn, timeout=2, retries=0, hedge_after=0.5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(resilience.stats.snapshot()['hedged'], 0)
+
+    def test_none_disables_hedging(self):
+        fn, calls = self.flaky(delays=[0.2])
+        with mock.patch.object(resilience, 'HEDGE_AFTER_SECONDS', 0.01):
+            resilience.call(fn, timeout=2, retries=0, hedge_after=None)
+        self.assertEqual(len(calls), 1)
+
+        fn, calls = self.flaky(delays=[0.2])
+        with mock.patch.object(resilience, 'HEDGE_AFTER_SECONDS', 0.01):
+            resilience.call(fn, timeout=2, retries=0)
+        self.assertEqual(len(calls), 2)
+
+    # whole analytics call against the fake LLM with injected errors and latency
+    def test_fake_llm_errors(self):
+        with fake_llm(), mock.patch.object(fake, 'ERROR_RATE', 1.0):
+            with self.assertRaises(LLMUnavailable):
+                services.invoke_analytics('I need a home loan')
+            with self.assertRaises(CircuitOpen):
+                services.invoke_analytics('I need a home loan')
+
+    def test_fake_llm_latency(self):
+        with fake_llm(), mock.patch.object(fake, 'LATENCY_SECONDS', 0.5), mock.patch.object(resilience, 'TIMEOUT_SECONDS', 0.05):
+            with self.assertRaises(LLMUnavailable) as raised:
+                services.invoke_analytics('I need a home loan')
+        self.assertIsInstance(raised.exception.__cause__, LLMTimeout)
+
+class TranscriptTests(SimpleTestCase):
+    def setUp(self):
+        prompt_stats.reset()
+
+    def messages(self, count, length=200):
+        return [{'sender': 'customer' if number % 2 == 0 else 'representative', 'text': f'message {number} ' + 'a' * length} for number in range(count)]
+
+    def test_within_budget(self):
+        text = build_transcript([{'sender': 'customer', 'text': 'I need  a\nhome loan'}, {'sender': 'representative', 'text': 'Sure'}])
+        self.assertEqual(text, 'Customer: I need a home loan\nRepresentative: Sure')
+
+        stats = prompt_stats.snapshot()
+        self.assertEqual((stats['prompts'], stats['messages'], stats['folded_messages'], stats['dropped_messages']), (1, 2, 0, 0))
+        self.assertEqual(stats['transcript_tokens'], estimate_tokens(text))
+
+    def test_client_senders_are_numbered(self):
+        transcript = build_transcript([{'sender': 'id-1', 'text': 'a'}, {'sender': 'id-2', 'text': 'b'}, {'sender': 'id-1', 'text': 'c'}, 'd'])
+        self.assertEqual(transcript.splitlines(), ['User 1: a', 'User 2: b', 'User 1: c', 'User: d'])
+
+    # every line is 57 tokens, folded ones 22 - with a budget of 120 the latest message fills
+    # the recent share (90), two older ones fit folded in the rest and the other two are dropped
+    def test_older_messages_are_folded_and_dropped(self):
+        messages = self.messages(5)
+        lines = build_transcript(messages, budget=120).splitlines()
+
+        self.assertEqual(lines[0], 'Earlier in the chat (shortened):')
+        self.assertEqual(lines[1], '(2 earlier messages omitted)')
+        # newest of the older messages are the ones kept
+        self.assertTrue(lines[2].startswith('Customer: message 2 '))
+        self.assertTrue(lines[3].startswith('Representative: message 3 '))
+        for line in lines[2:4]:
+            self.assertEqual(len(line), transcript.FOLDED_MESSAGE_CHARS + 3)
+            self.assertTrue(line.endswith('...'))
+        self.assertEqual(lines[4], 'Latest messages:')
+        self.assertEqual(lines[5], 'Customer: message 4 ' + 'a' * 200)
+
+        stats = prompt_stats.snapshot()
+        self.assertEqual((stats['messages'], stats['folded_messages'], stats['dropped_messages']), (5, 2, 2))
+        self.assertLess(stats['transcript_tokens'], stats['raw_tokens'])
+
+    def test_short_older_messages_are_not_cut(self):
+        messages = [{'sender': 'customer', 'text': 'hi'}] + self.messages(2)
+        lines = build_transcript(messages, budget=120).splitlines()
+        self.assertEqual(lines[:2], ['Earlier in the chat (shortened):', 'Customer: hi'])
+
+    def test_latest_message_is_kept_above_budget(self):
+        messages = self.messages(3, length=2000)
+        lines = build_transcript(messages, budget=100).splitlines()
+        self.assertEqual(lines, ['Earlier in the chat (shortened):', '(2 earlier messages omitted)', 'Latest messages:', 'Customer: message 2 ' + 'a' * 2000])
+
+
+class ClassifierTests(SimpleTestCase):
+    def test_sentiment(self):
+        self.assertEqual(classify_sentiment(['Great, thanks! I am happy with this']), ('positive', 1.0))
+        self.assertEqual(classify_sentiment(['This is terrible, I am frustrated']), ('negative', 1.0))
+        self.assertIsNone(classify_sentiment(['What documents do you need?']))
+
+    def test_negation_flips_sentiment(self):
+        self.assertEqual(classify_sentiment(['I am not happy']), ('negative', 0.5))
+
+    def test_mixed_sentiment_is_neutral(self):
+        sentiment, confidence = classify_sentiment(['good but slow'])
+        self.assertEqual(sentiment, 'neutral')
+        self.assertLess(confidence, 1.0)
+
+    def test_little_evidence_lowers_confidence(self):
+        self.assertEqual(classify_sentiment(['ok']), ('positive', 0.167))
+
+    def test_loan_type(self):
+        self.assertEqual(classify_loan_type(['I want a home loan for my house']), ('Home Loan', 1.0))
+        self.assertIsNone(classify_loan_type(['Hello']))
+
+        # a second category in the messages lowers the confidence
+        loan_type, confidence = classify_loan_type(['home loan, or maybe a car'])
+        self.assertEqual(loan_type, 'Home Loan')
+        self.assertLess(confidence, 1.0)
+
+    def test_sentiment_only_from_customer_messages(self):
+        local = classify([
+            {'sender': 'customer', 'text': 'I need a car loan'},
+            {'sender': 'representative', 'text': 'Great, happy to help, excellent choice'},
+        ])
+        self.assertIsNone(local['sentiment'])
+        self.assertEqual(local['loan_type'][0], 'Car Loan')
+
+    def test_guess_lead_type(self):
+        self.assertEqual(guess_lead_type({'sentiment': ('positive', 1.0), 'loan_type': ('Home Loan', 1.0)}), 'hot')
+        self.assertEqual(guess_lead_type({'sentiment': None, 'loan_type': ('Home Loan', 1.0)}), 'warm')
+        self.assertEqual(guess_lead_type({'sentiment': ('negative', 1.0), 'loan_type': ('Home Loan', 1.0)}), 'cold')
+
+
+# pipeline reads its settings on import, so the module constants are patched instead of override_settings
+@mock.patch.object(pipeline, 'LOCAL_CONFIDENCE', 0.6)
+@mock.patch.object(pipeline, 'LLM_EVERY_N_MESSAGES', 5)
+@mock.patch.object(pipeline, 'LOCAL_ONLY', False)
+class LocalTierTests(AnalyticsTestCase):
+    LLM_OUTPUT = AnaltyicsModel(summary='LLM summary', sentiment='neutral', loan_type='Car Loan', lead_type='warm', rationale='LLM rationale')
+
+    def setUp(self):
+        super().setUp()
+        self.llm = mock.Mock(return_value=self.LLM_OUTPUT)
+        patch = mock.patch.object(pipeline, 'invoke_analytics', self.llm)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    # stored LLM result covering the messages so far
+    def analysed(self, *texts):
+        messages = self.add_messages(*texts)
+        ConversationAnalytics.objects.create(
+            conversation=self.conversation, summary='Stored summary', sentiment='neutral', loan_type='Home Loan',
+            lead_type='warm', rationale='Stored rationale', last_message=messages[-1],
+        )
+
+    def test_llm_runs_first_time(self):
+        self.add_messages('Great, thanks! I want a home loan')
+        self.assertEqual(pipeline.analyze_conversation(self.conversation.id)['summary'], 'LLM summary')
+        self.assertEqual(self.llm.call_count, 1)
+
+    def test_confident_classifier_skips_llm(self):
+        self.analysed('I want a home loan')
+        self.add_messages('Great, thanks! I am happy with this')
+
+        result = pipeline.analyze_conversation(self.conversation.id)
+        self.llm.assert_not_called()
+        self.assertEqual(result['sentiment'], 'positive')
+        self.assertEqual(result['summary'], 'Stored summary')
+        # stored state still points at the messages the LLM has seen
+        self.assertEqual(ConversationAnalytics.objects.get().sentiment, 'neutral')
+
+    def test_low_confidence_calls_llm(self):
+        self.analysed('I want a home loan')
+        self.add_messages('ok')
+
+        self.assertEqual(pipeline.analyze_conversation(self.conversation.id)['summary'], 'LLM summary')
+        self.assertEqual(self.llm.call_count, 1)
+
+    def test_confidence_threshold(self):
+        self.analysed('I want a home loan')
+        self.add_messages('Great, thanks! I am happy with this')
+
+        with mock.patch.object(pipeline, 'LOCAL_CONFIDENCE', 1.01):
+            pipeline.analyze_conversation(self.conversation.id)
+        self.assertEqual(self.llm.call_count, 1)
+
+    def test_llm_every_n_messages(self):
+        self.analysed('I want a home loan')
+        self.add_messages('Great, thanks!', 'I am happy with this')
+
+        with mock.patch.object(pipeline, 'LLM_EVERY_N_MESSAGES', 2):
+            result = pipeline.analyze_conversation(self.conversation.id)
+        self.assertEqual(self.llm.call_count, 1)
+        self.assertEqual(result['summary'], 'LLM summary')
+        self.assertEqual(ConversationAnalytics.objects.get().summary, 'LLM summary')
+
+    def test_local_only_never_calls_llm(self):
+        self.add_messages('Great, thanks! I want a home loan')
+
+        with mock.patch.object(pipeline, 'LOCAL_ONLY', True):
+            result = pipeline.analyze_conversation(self.conversation.id)
+        self.llm.assert_not_called()
+        self.assertEqual(result['sentiment'], 'positive')
+        self.assertEqual(result['loan_type'], 'Home Loan')
+        self.assertEqual(result['lead_type'], 'hot')
+
+    def test_local_only_keeps_fields_without_prediction(self):
+        self.analysed('I want a home loan')
+        self.add_messages('ok', 'ok', 'ok', 'ok', 'ok', 'What documents do you need?')
+
+        with mock.patch.object(pipeline, 'LOCAL_ONLY', True):
+            result = pipeline.analyze_conversation(self.conversation.id)
+        self.llm.assert_not_called()
+        self.assertEqual(result['loan_type'], 'Home Loan')
+        self.assertEqual(result['sentiment'], 'positive')
+        self.assertEqual(result['summary'], 'Stored summary')
+
+
+class ReportingTests(AnalyticsTestCase):
+    def output(self, lead_type='hot', sentiment='positive', loan_type='Home Loan'):
+        return {'summary': 'Summary', 'sentiment': sentiment, 'loan_type': loan_type, 'lead_type': lead_type, 'rationale': 'Rationale'}
+
+    def record(self, **values):
+        reporting.record_result(self.conversation.id, self.output(**values), self.add_messages('Hello'))
+
+    def buckets(self):
+        return {
+            (row.day, row.lead_type, row.sentiment, row.loan_type): row.count
+            for row in AnalyticsDailyRollup.objects.filter(representative=self.representative)
+        }
+
+    def test_first_result_is_counted(self):
+        self.record()
+        today = timezone.localdate()
+        self.assertEqual(self.buckets(), {(today, 'hot', 'positive', 'Home Loan'): 1})
+        snapshot = AnalyticsSnapshot.objects.get()
+        self.assertEqual((snapshot.representative_id, snapshot.lead_type, snapshot.message_count), (self.representative.id, 'hot', 1))
+
+    def test_reanalysis_moves_conversation_to_new_bucket(self):
+        self.record()
+        self.record(lead_type='cold', sentiment='negative')
+        today = timezone.localdate()
+        self.assertEqual(self.buckets(), {
+            (today, 'hot', 'positive', 'Home Loan'): 0,
+            (today, 'cold', 'negative', 'Home Loan'): 1,
+        })
+        # and back again
+        self.record()
+        self.assertEqual(self.buckets()[(today, 'hot', 'positive', 'Home Loan')], 1)
+        self.assertEqual(self.buckets()[(today, 'cold', 'negative', 'Home Loan')], 0)
+        self.assertEqual(AnalyticsSnapshot.objects.count(), 3)
+
+    def test_same_result_is_counted_once(self):
+        self.record()
+        self.record()
+        self.assertEqual(list(self.buckets().values()), [1])
+        self.assertEqual(AnalyticsSnapshot.objects.count(), 2)
+
+    def test_earlier_day_keeps_its_result(self):
+        self.record()
+        yesterday = timezone.localdate() - timedelta(days=1)
+        AnalyticsDailyRollup.objects.update(day=yesterday)
+        ConversationAnalytics.objects.update(updated_at=timezone.now() - timedelta(days=1))
+
+        self.record(lead_type='cold')
+        today = timezone.localdate()
+        self.assertEqual(self.buckets(), {
+            (yesterday, 'hot', 'positive', 'Home Loan'): 1,
+            (today, 'cold', 'positive', 'Home Loan'): 1,
+        })
+
+    def test_conversation_without_representative(self):
+        other = create_user('other@example.com')
+        self.conversation, _ = Conversation.objects.get_or_create_for_pair(self.customer.id, other.id)
+        self.record()
+        self.assertFalse(AnalyticsDailyRollup.objects.exists())
+        self.assertIsNone(AnalyticsSnapshot.objects.get().representative_id)
+
+    def test_build_report(self):
+        self.record()
+        self.record(lead_type='cold')
+        self.conversation, _ = Conversation.objects.get_or_create_for_pair(create_user('second@example.com').id, self.representative.id)
+        self.record()
+        self.conversation, _ = Conversation.objects.get_or_create_for_pair(create_user('third@example.com').id, self.representative.id)
+        self.record(loan_type='Car Loan')
+
+        today = timezone.localdate()
+        self.assertEqual(reporting.build_report(today, today, []), [{'conversations': 3}])
+        self.assertEqual(reporting.build_report(today, today, ['lead_type']), [
+            {'lead_type': 'cold', 'conversations': 1},
+            {'lead_type': 'hot', 'conversations': 2},
+        ])
+        self.assertEqual(reporting.build_report(today, today, ['representative', 'loan_type'], self.representative.id), [
+            {'representative': self.representative.id, 'loan_type': 'Car Loan', 'conversations': 1},
+            {'representative': self.representative.id, 'loan_type': 'Home Loan', 'conversations': 2},
+        ])
+        self.assertEqual(reporting.build_report(today - timedelta(days=2), today - timedelta(days=1), []), [{'conversations': 0}])
+
+    def test_report_api(self):
+        self.record()
+        self.client.force_authenticate(self.representative)
+        response = self.client.get('/analytics/report/', {'group_by': 'lead_type'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['results'], [{'lead_type': 'hot', 'conversations': 1}])
+
+        # representatives only see their own numbers
+        response = self.client.get('/analytics/report/', {'representative': str(create_user('rep2@example.com', 'representative').id)})
+        self.assertEqual(response.status_code, 403)
+        response = self.client.get('/analytics/report/', {'group_by': 'unknown'})
+        self.assertEqual(response.status_code, 400)
+
+
+class GetAnalyticsHistoryTests(AnalyticsTestCase):
+    def setUp(self):
+        super().setUp()
+        # two snapshots on every timestamp, so pages end between equal created_at
+        now = timezone.now()
+        AnalyticsSnapshot.objects.bulk_create([
+            AnalyticsSnapshot(
+                conversation=self.conversation, representative=self.representative, summary=f'Summary {number}',
+                sentiment='neutral', loan_type='Home Loan', lead_type='warm', rationale='Rationale',
+                message_count=number, created_at=now + timedelta(seconds=number // 2),
+            )
+            for number in range(5)
+        ])
+        other_conversation, _ = Conversation.objects.get_or_create_for_pair(create_user('other@example.com').id, self.representative.id)
+        AnalyticsSnapshot.objects.create(conversation=other_conversation, summary='Other', sentiment='neutral', loan_type='Home Loan', lead_type='warm', rationale='Rationale')
+        self.url = f'/analytics/history/{self.conversation.id}/'
+
+    def expected(self):
+        return [
+            str(snapshot_id) for snapshot_id in
+            AnalyticsSnapshot.objects.filter(conversation=self.conversation).order_by('-created_at', '-id').values_list('id', flat=True)
+        ]
+
+    def test_newest_first(self):
+        for user in (self.customer, self.representative):
+            self.client.force_authenticate(user)
+            response = self.client.get(self.url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual([snapshot['id'] for snapshot in response.data['results']], self.expected())
+            self.assertEqual(response.data['results'][0]['summary'], 'Summary 4')
+            self.assertIsNone(response.data['next_cursor'])
+
+    def test_pages(self):
+        self.client.force_authenticate(self.customer)
+        for limit in (1, 2, 3):
+            ids, cursor = [], None
+            while True:
+                response = self.client.get(self.url, {'limit': limit, **({'before': cursor} if cursor else {})})
+                self.assertLessEqual(len(response.data['results']), limit)
+                ids.extend(snapshot['id'] for snapshot in response.data['results'])
+                cursor = response.data['next_cursor']
+                if not cursor:
+                    break
+            self.assertEqual(ids, self.expected())
+
+    def test_limit_is_bounded(self):
+        self.client.force_authenticate(self.customer)
+        self.assertEqual(len(self.client.get(self.url, {'limit': 0}).data['results']), 1)
+        self.assertEqual(len(self.client.get(self.url, {'limit': 1000}).data['results']), 5)
+        self.assertEqual(self.client.get(self.url, {'before': 'invalid'}).status_code, 400)
+
+    def test_non_participant_gets_not_found(self):
+        self.assertEqual(self.client.get(self.url).status_code, 401)
+        self.client.force_authenticate(create_user('outsider@example.com', 'representative'))
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+        self.client.force_authenticate(create_user('staff@example.com', 'representative', is_staff=True))
+        self.assertEqual(len(self.client.get(self.url).data['results']), 5)
+
+
+# LLM call of the jobs is replaced by analyze(), which waits for self.release when self.block is set
+@mock.patch.object(scheduler, 'DEBOUNCE_SECONDS', 0.05)
+@mock.patch.object(scheduler, 'DEBOUNCE_MAX_WAIT_SECONDS', 1.0)
+class SchedulerTests(SimpleTestCase):
+    def setUp(self):
+        self.calls = []
+        self.published = []
+        self.block = False
+        self.release = threading.Event()
+        self.fail = False
+        patches = [
+            mock.patch.object(jobs, 'analyze_conversation', self.analyze),
+            mock.patch.object(jobs, 'publish', self.published.append),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def analyze(self, conversation_id):
+        self.calls.append(conversation_id)
+        if self.block:
+            self.release.wait(5)
+        if self.fail:
+            raise RuntimeError("LLM failed")
+        return {'summary': f'call {len(self.calls)}'}
+
+    def test_requests_in_debounce_window_are_merged(self):
+        first = scheduler.request('conversation')
+        second = scheduler.request('conversation')
+        third = scheduler.request('conversation')
+
+        self.assertIs(first, second)
+        self.assertIs(first, third)
+        # status is set before the job is published, so waiting for the push
+        wait_until(lambda: self.published)
+        self.assertEqual(self.calls, ['conversation'])
+        self.assertEqual(self.published, [first])
+
+    def test_concurrent_requests_create_one_job(self):
+        with ThreadPoolExecutor(max_workers=20) as executor:
+            requested = list(executor.map(lambda _: scheduler.request('conversation'), range(50)))
+
+        self.assertEqual(len({job.id for job in requested}), 1)
+        wait_until(lambda: self.published)
+        self.assertEqual(self.calls, ['conversation'])
+
+    def test_status_transitions(self):
+        self.block = True
+        job = scheduler.request('conversation')
+        self.assertEqual(job.status, jobs.AnalyticsJob.QUEUED)
+
+        wait_until(lambda: job.status == jobs.AnalyticsJob.RUNNING)
+        self.release.set()
+        wait_until(lambda: job.finished)
+        self.assertEqual(job.status, jobs.AnalyticsJob.DONE)
+        self.assertEqual(job.result, {'summary': 'call 1'})
+        self.assertIs(jobs.get_job(job.id), job)
+
+    def test_failed_job(self):
+        self.fail = True
+        job = scheduler.request('conversation')
+        wait_until(lambda: self.published)
+        self.assertEqual(job.status, jobs.AnalyticsJob.FAILED)
+        self.assertEqual(job.error, 'LLM failed')
+        self.assertEqual(self.published, [job])
+
+    def test_request_while_running_supersedes_the_running_job(self):
+        self.block = True
+        first = scheduler.request('conversation')
+        wait_until(lambda: first.status == jobs.AnalyticsJob.RUNNING)
+
+        second = scheduler.request('conversation')
+        self.assertIsNot(first, second)
+        # only one LLM call per conversation at a time
+        time.sleep(0.2)
+        self.assertEqual(len(self.calls), 1)
+
+        self.release.set()
+        wait_until(lambda: self.published)
+        self.assertEqual(first.status, jobs.AnalyticsJob.SUPERSEDED)
+        self.assertEqual(second.status, jobs.AnalyticsJob.DONE)
+        self.assertEqual(len(self.calls), 2)
+        # result of the superseded job is not pushed
+        self.assertEqual(self.published, [second])
+        self.assertNotIn('conversation', scheduler._states)
@@ -0,0 +1,99 @@
+# compact transcript of the chat for the LLM prompt
+# one line per message "Customer: text", recent messages kept word for word and when the
+# token budget is exceeded the older ones are folded into a short "earlier in the chat" section
+
+from django.conf import settings
+from .metrics import prompt_stats
+
+
+TOKEN_BUDGET = getattr(settings, 'ANALYTICS_PROMPT_TOKEN_BUDGET', 2000)
+# part of the budget reserved for the recent messages, rest is for the folded older ones
+RECENT_SHARE = getattr(settings, 'ANALYTICS_PROMPT_RECENT_SHARE', 0.75)
+# older messages are cut to this many characters when folded
+FOLDED_MESSAGE_CHARS = getattr(settings, 'ANALYTICS_PROMPT_FOLDED_MESSAGE_CHARS', 80)
+
+ROLE_LABELS = {'customer': 'Customer', 'representative': 'Representative'}
+
+
+# rough estimate, around 4 characters per token for english text
+def estimate_tokens(text):
+    return (len(text) + 3) // 4
+
+
+def _speaker(sender, speakers):
+    if sender in ROLE_LABELS:
+        return ROLE_LABELS[sender]
+    # messages sent by the client have user ids as sender, numbered in order of appearance
+    if sender not in speakers:
+        speakers[sender] = f'User {len(speakers) + 1}'
+    return speakers[sender]
+
+
+def render_lines(messages):
+    speakers = {}
+    lines = []
+    for message in messages:
+        if isinstance(message, dict):
+            speaker = _speaker(message.get('sender'), speakers)
+            text = message.get('text')
+        else:
+            speaker, text = 'User', message
+        lines.append(f"{speaker}: {' '.join(str(text or '').split())}")
+    return lines
+
+
+def _fold(line):
+    if len(line) <= FOLDED_MESSAGE_CHARS:
+        return line
+    return line[:FOLDED_MESSAGE_CHARS].rstrip() + '...'
+
+
+# called right before the LLM request, the transcript is counted in prompt_stats as sent
+def build_transcript(messages, budget=None):
+    budget = budget or TOKEN_BUDGET
+    lines = render_lines(messages)
+
+    # newest messages first until the recent share of the budget is used
+    recent_budget = int(budget * RECENT_SHARE)
+    used = 0
+    cut = len(lines)
+    while cut > 0:
+        tokens = estimate_tokens(lines[cut - 1]) + 1
+        # latest message is always kept, even if it alone is above the budget
+        if used + tokens > recent_budget and cut < len(lines):
+            break
+        used += tokens
+        cut -= 1
+
+    recent = lines[cut:]
+    older = [_fold(line) for line in lines[:cut]]
+
+    # older messages, newest of them first, until the whole budget is used
+    folded = []
+    remaining = budget - used
+    for line in reversed(older):
+        tokens = estimate_tokens(line) + 1
+        if tokens > remaining:
+            break
+        folded.insert(0, line)
+        remaining -= tokens
+    dropped = len(older) - len(folded)
+
+    parts = []
+    if older:
+        parts.append('Earlier in the chat (shortened):')
+        if dropped:
+            parts.append(f'({dropped} earlier messages omitted)')
+        parts.extend(folded)
+        parts.append('Latest messages:')
+    parts.extend(recent)
+    transcript = '\n'.join(parts)
+
+    prompt_stats.increment('prompts')
+    prompt_stats.increment('messages', len(lines))
+    prompt_stats.increment('folded_messages', len(folded))
+    prompt_stats.increment('dropped_messages', dropped)
+    prompt_stats.increment('raw_tokens', estimate_tokens(str(messages)))
+    prompt_stats.increment('transcript_tokens', estimate_tokens(transcript))
+
+    return transcript
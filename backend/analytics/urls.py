@@ -1,6 +1,14 @@
 from django.urls import path
-from .views import GetAnalytics
+from .views import GetAnalytics, GetBatchAnalytics, GetAnalyticsCacheStats, GetAnalyticsStats, GetAnalyticsJob, GetAnalyticsReport, GetAnalyticsHistory, GetAnalyticsStreamToken, stream_analytics
 
 urlpatterns = [
-    path('', GetAnalytics.as_view())
+    path('', GetAnalytics.as_view()),
+    path('batch/', GetBatchAnalytics.as_view()),
+    path('stream/<uuid:conversation_id>/', stream_analytics),
+    path('stream/<uuid:conversation_id>/ticket/', GetAnalyticsStreamToken.as_view()),
+    path('cache/stats/', GetAnalyticsCacheStats.as_view()),
+    path('stats/', GetAnalyticsStats.as_view()),
+    path('jobs/<uuid:job_id>/', GetAnalyticsJob.as_view()),
+    path('report/', GetAnalyticsReport.as_view()),
+    path('history/<uuid:conversation_id>/', GetAnalyticsHistory.as_view()),
 ]
\ No newline at end of file
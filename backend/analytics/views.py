@@ -1,28 +1,313 @@
+import uuid
+import json
+from django.http import StreamingHttpResponse, JsonResponse
 from rest_framework import status
 from rest_framework.response import Response
 from rest_framework.views import APIView
-from .services import structured_llm
+from datetime import timedelta
+from django.conf import settings
+from django.core import signing
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from channels.db import database_sync_to_async
+from rest_framework.permissions import IsAuthenticated, IsAdminUser
+from authapp.models import MyUser
+from chat.models import Conversation
+from chat.pagination import encode_cursor, decode_cursor, get_page_size, InvalidCursor
+from .models import AnalyticsSnapshot
+from .services import invoke_analytics, build_prompt
+from .pipeline import analyze_conversation, analyze_conversations, stream_conversation
+from . import cache
+from . import resilience
+from .resilience import LLMUnavailable
+from .metrics import prompt_stats
+from .transcript import build_transcript
+from . import jobs
+from . import scheduler
+from . import reporting
+
+
+BATCH_MAX_CONVERSATIONS = getattr(settings, 'ANALYTICS_BATCH_MAX_CONVERSATIONS', 50)
+# days in a report when no range is given and the longest range allowed
+REPORT_DEFAULT_DAYS = getattr(settings, 'ANALYTICS_REPORT_DEFAULT_DAYS', 30)
+REPORT_MAX_DAYS = getattr(settings, 'ANALYTICS_REPORT_MAX_DAYS', 366)
+# seconds a stream token can be used to open the analytics stream
+STREAM_TOKEN_MAX_AGE = getattr(settings, 'ANALYTICS_STREAM_TOKEN_MAX_AGE', 60)
+STREAM_TOKEN_SALT = 'analytics.stream'
+
+
+# YYYY-MM-DD query param of the report, default when not given
+def parse_report_date(value, default):
+    if not value:
+        return default
+    day = parse_date(value)
+    if day is None:
+        raise ValueError(f"Invalid date {value}")
+    return day
+
+
+# conversations whose analytics the user can read - the ones they are part of, every conversation for staff
+def readable_conversations(user):
+    conversations = Conversation.objects.all()
+    if not user.is_staff:
+        conversations = conversations.filter(Q(user1=user) | Q(user2=user))
+    return conversations
 
 
 class GetAnalytics(APIView):
+    permission_classes = [IsAuthenticated]
+
     def post(self, request):
+        conversation_id = request.data.get("conversation_id")
+
+        # incremental mode - messages are loaded on the server using the conversation id
+        if conversation_id:
+            try:
+                conversation_id = uuid.UUID(str(conversation_id))
+            except ValueError:
+                return Response({"error": "Invalid conversation id"}, status=status.HTTP_400_BAD_REQUEST)
+
+            # only participants (and staff) get the analytics of the transcript
+            if not readable_conversations(request.user).filter(id=conversation_id).exists():
+                return Response({"error": "Conversation not found"}, status=status.HTTP_404_NOT_FOUND)
+
+            # async mode - LLM call runs in background and result is pushed on the chat socket
+            # requests within the debounce window get the same job
+            if request.data.get("async"):
+                try:
+                    job = scheduler.request(conversation_id)
+                except jobs.QueueFull as e:
+                    return Response({"error": str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+                return Response(job.as_dict(), status=status.HTTP_202_ACCEPTED)
+
+            try:
+                output = analyze_conversation(conversation_id)
+            except Conversation.DoesNotExist:
+                return Response({"error": "Conversation not found"}, status=status.HTTP_404_NOT_FOUND)
+            # LLM down / too slow and no earlier analytics to fall back to
+            except LLMUnavailable as e:
+                return Response({"error": str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+            except Exception as e:
+                return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+            if output is None:
+                return Response({"error": "No messages in the conversation"}, status=status.HTTP_400_BAD_REQUEST)
+            return Response(output, status=status.HTTP_200_OK)
+
+        # full transcript sent by the client
         messages = request.data.get("messages", [])
 
         if not messages:
             return Response({"error": "Messages are required"}, status=status.HTTP_400_BAD_REQUEST)
 
-        prompt = f'''
-            Based on following chat conversation between an bank customer and bank representative you need to provide me with these analytics. And only answer based on context if have no details simply return :- No details
-            1. Provide summary of the conversation happened so far
-            2. Sentiment of the user
-            3. If there is some chats related to loan, tell what type of loan does the user is asking for
-            4. Based on conversation tell the customer lead type
-            5. Also give the rationale behind classifying the user with the particular lead type
-            \n
-            context: {messages}
-        '''
         try:
-            output = structured_llm.invoke(prompt)
-            return Response(output.model_dump(), status=status.HTTP_200_OK)
+            key = cache.make_cache_key(messages)
+            # prompt is only built (and counted in prompt_stats) when the LLM is called
+            output = cache.get_or_compute(key, lambda: invoke_analytics(build_prompt(build_transcript(messages))).model_dump())
+            return Response(output, status=status.HTTP_200_OK)
+        except LLMUnavailable as e:
+            return Response({"error": str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        except Exception as e:
+            return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+# analytics of many conversations in one request (e.g. whole queue of a representative)
+class GetBatchAnalytics(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        conversation_ids = request.data.get("conversation_ids", [])
+
+        if not conversation_ids or not isinstance(conversation_ids, list):
+            return Response({"error": "conversation_ids are required"}, status=status.HTTP_400_BAD_REQUEST)
+
+        if len(conversation_ids) > BATCH_MAX_CONVERSATIONS:
+            return Response({"error": f"At most {BATCH_MAX_CONVERSATIONS} conversations are allowed"}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            conversation_ids = list(dict.fromkeys(uuid.UUID(str(conversation_id)) for conversation_id in conversation_ids))
+        except ValueError:
+            return Response({"error": "Invalid conversation id"}, status=status.HTTP_400_BAD_REQUEST)
+
+        # conversations of other users are reported like missing ones
+        readable = set(readable_conversations(request.user).filter(id__in=conversation_ids).values_list('id', flat=True))
+
+        try:
+            results = analyze_conversations([conversation_id for conversation_id in conversation_ids if conversation_id in readable])
+        except Exception as e:
+            return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        return Response({
+            str(conversation_id): results.get(conversation_id, {'error': 'Conversation not found'})
+            for conversation_id in conversation_ids
+        }, status=status.HTTP_200_OK)
+
+
+# token for opening the analytics stream of one conversation
+# EventSource cannot send the Authorization header, so the stream gets this in the query string (?token=)
+# instead of the access token - it is signed, bound to the user and the conversation and expires after STREAM_TOKEN_MAX_AGE
+class GetAnalyticsStreamToken(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, conversation_id):
+        if not readable_conversations(request.user).filter(id=conversation_id).exists():
+            return Response({"error": "Conversation not found"}, status=status.HTTP_404_NOT_FOUND)
+
+        token = signing.dumps({'user_id': str(request.user.id), 'conversation_id': str(conversation_id)}, salt=STREAM_TOKEN_SALT)
+        return Response({"token": token, "expires_in": STREAM_TOKEN_MAX_AGE}, status=status.HTTP_200_OK)
+
+
+# user the stream token was issued to can still read the conversation
+@database_sync_to_async
+def can_stream(user_id, conversation_id):
+    user = MyUser.objects.filter(id=user_id, is_active=True).first()
+    return user is not None and readable_conversations(user).filter(id=conversation_id).exists()
+
+
+# streaming analytics as server sent events (needs the ASGI server)
+# sentiment / lead_type / loan_type are sent as soon as they are decided and
+# summary / rationale are sent piece by piece while the LLM is generating them
+async def stream_analytics(request, conversation_id):
+    if request.method != 'GET':
+        return JsonResponse({"error": "Method not allowed"}, status=status.HTTP_405_METHOD_NOT_ALLOWED)
+
+    try:
+        claims = signing.loads(request.GET.get('token', ''), salt=STREAM_TOKEN_SALT, max_age=STREAM_TOKEN_MAX_AGE)
+    except signing.BadSignature:
+        # also raised for expired tokens (SignatureExpired)
+        return JsonResponse({"error": "Invalid or expired stream token"}, status=status.HTTP_401_UNAUTHORIZED)
+
+    if claims.get('conversation_id') != str(conversation_id) or not await can_stream(claims.get('user_id'), conversation_id):
+        return JsonResponse({"error": "Conversation not found"}, status=status.HTTP_404_NOT_FOUND)
+
+    async def events():
+        try:
+            async for event, data in stream_conversation(conversation_id):
+                yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+        except Conversation.DoesNotExist:
+            yield f"event: error\ndata: {json.dumps({'error': 'Conversation not found'})}\n\n"
         except Exception as e:
-            return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
\ No newline at end of file
+            yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n"
+
+    response = StreamingHttpResponse(events(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # stops proxies (nginx) from buffering the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+# hit / miss / eviction counters of the analytics cache for this worker (staff only)
+class GetAnalyticsCacheStats(APIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response(cache.stats.snapshot(), status=status.HTTP_200_OK)
+
+
+# all analytics counters of this worker (cache + prompt size + LLM calls), staff only
+class GetAnalyticsStats(APIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response({
+            "cache": cache.stats.snapshot(),
+            "prompts": prompt_stats.snapshot(),
+            "llm": resilience.snapshot(),
+        }, status=status.HTTP_200_OK)
+
+
+# status of an analytics job started in async mode
+# jobs of conversations the user cannot read are reported like missing ones
+class GetAnalyticsJob(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, job_id):
+        job = jobs.get_job(job_id)
+        if not job or not readable_conversations(request.user).filter(id=job.conversation_id).exists():
+            return Response({"error": "Job not found"}, status=status.HTTP_404_NOT_FOUND)
+        return Response(job.as_dict(), status=status.HTTP_200_OK)
+
+
+# conversation counts by lead_type / sentiment / loan_type from the daily rollups (dashboard)
+# ?from=2026-10-01&to=2026-10-31 (default last 30 days, both included), ?group_by=day,lead_type (default day)
+# ?representative=<id> for one representative, representatives only get their own numbers
+# a conversation is counted once for every day its analytics were refreshed
+class GetAnalyticsReport(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        today = timezone.localdate()
+        try:
+            date_to = parse_report_date(request.query_params.get('to'), today)
+            date_from = parse_report_date(request.query_params.get('from'), date_to - timedelta(days=REPORT_DEFAULT_DAYS - 1))
+            representative = request.query_params.get('representative')
+            representative_id = uuid.UUID(representative) if representative else None
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        if date_from > date_to:
+            return Response({"error": "from must not be after to"}, status=status.HTTP_400_BAD_REQUEST)
+        if (date_to - date_from).days >= REPORT_MAX_DAYS:
+            return Response({"error": f"At most {REPORT_MAX_DAYS} days are allowed"}, status=status.HTTP_400_BAD_REQUEST)
+
+        group_by = [dimension for dimension in request.query_params.get('group_by', 'day').split(',') if dimension]
+        unknown = [dimension for dimension in group_by if dimension not in reporting.REPORT_DIMENSIONS]
+        if unknown:
+            return Response({"error": f"Unknown group_by {', '.join(unknown)}, allowed {', '.join(reporting.REPORT_DIMENSIONS)}"}, status=status.HTTP_400_BAD_REQUEST)
+
+        if not request.user.is_staff:
+            if representative_id not in (None, request.user.id):
+                return Response({"error": "Not allowed"}, status=status.HTTP_403_FORBIDDEN)
+            representative_id = request.user.id
+
+        rows = reporting.build_report(date_from, date_to, list(dict.fromkeys(group_by)), representative_id)
+        return Response({
+            "from": date_from.isoformat(),
+            "to": date_to.isoformat(),
+            "group_by": group_by,
+            "results": rows,
+        }, status=status.HTTP_200_OK)
+
+
+# earlier analytics results of a conversation, newest first, ?before=<cursor> for the next page
+class GetAnalyticsHistory(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, conversation_id):
+        # participants of the conversation and staff
+        if not readable_conversations(request.user).filter(id=conversation_id).exists():
+            return Response({"error": "Conversation not found"}, status=status.HTTP_404_NOT_FOUND)
+
+        limit = get_page_size(request, default=20, maximum=100)
+        snapshots = AnalyticsSnapshot.objects.filter(conversation_id=conversation_id)
+
+        before = request.query_params.get('before')
+        if before:
+            try:
+                created_at, snapshot_id = decode_cursor(before)
+                snapshot_id = uuid.UUID(snapshot_id)
+            except (InvalidCursor, ValueError):
+                return Response({"error": "Invalid cursor"}, status=status.HTTP_400_BAD_REQUEST)
+            snapshots = snapshots.filter(
+                Q(created_at__lt=created_at) |
+                Q(created_at=created_at, id__lt=snapshot_id)
+            )
+
+        page = list(
+            snapshots.order_by('-created_at', '-id')
+            .values('id', 'summary', 'sentiment', 'loan_type', 'lead_type', 'rationale', 'message_count', 'created_at')[:limit + 1]
+        )
+        has_more = len(page) > limit
+        page = page[:limit]
+        next_cursor = encode_cursor(page[-1]['created_at'], page[-1]['id']) if has_more else None
+
+        results = [
+            {
+                **snapshot,
+                "id": str(snapshot['id']),
+                "created_at": snapshot['created_at'].isoformat(),
+            }
+            for snapshot in page
+        ]
+        return Response({"results": results, "next_cursor": next_cursor}, status=status.HTTP_200_OK)
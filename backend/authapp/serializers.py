@@ -8,6 +8,14 @@ class MyTokenObtainPairSerializer(TokenObtainPairSerializer):
     # using email for auth
     username_field = 'email'
 
+    # user_type added as a claim, so the websocket middleware can build the user
+    # from the token without a DB lookup (CHAT_WS_TRUST_TOKEN_CLAIMS)
+    @classmethod
+    def get_token(cls, user):
+        token = super().get_token(user)
+        token['user_type'] = user.user_type
+        return token
+
     # in django self.user => current logged in user or None
     # hence when we validate user, if correctly validated self.user is set to current new user
     # and then tokens are added to the data dict
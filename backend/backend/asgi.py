@@ -8,17 +8,23 @@ https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 """
 
 import os
-from django.core.asgi import get_asgi_application
-from channels.routing import ProtocolTypeRouter, URLRouter
-from django.core.asgi import get_asgi_application
-from chat.routing import websocket_urlpatterns
-from chat.security import JWTAuthMiddleware
+import time
 
+# time taken to import + set up the app, printed once per worker
+startup_started = time.perf_counter()
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 
+from django.core.asgi import get_asgi_application
+
+# apps must be set up before importing anything using the models
 django_asgi_app = get_asgi_application()
 
+from channels.routing import ProtocolTypeRouter, URLRouter
+from chat.routing import websocket_urlpatterns
+from chat.security import JWTAuthMiddleware
+
+
 # In postman - need to manually pass the origin header with the origin in order to connect to the socket
 # if we are using AllowedHostsOriginValidator here
 application = ProtocolTypeRouter(
@@ -28,4 +34,6 @@ application = ProtocolTypeRouter(
             URLRouter(websocket_urlpatterns)
         )
     }
-)
\ No newline at end of file
+)
+
+print(f'ASGI application loaded in {(time.perf_counter() - startup_started) * 1000:.0f} ms')
@@ -180,4 +180,108 @@ CHANNEL_LAYERS = {
             "hosts": [("127.0.0.1", 6379)],
         },
     },
-}
\ No newline at end of file
+}
+
+# when True, chat messages are broadcast first and saved later in batches (chat.persistence.MessageBatcher)
+CHAT_WRITE_BEHIND = False
+CHAT_WRITE_BEHIND_BATCH_SIZE = 100
+CHAT_WRITE_BEHIND_FLUSH_INTERVAL = 0.5
+CHAT_WRITE_BEHIND_QUEUE_SIZE = 1000
+# DB errors other than bad rows retry the batch, waiting 0.5, 1, 2 s, after the last attempt the messages are dropped (ids logged)
+CHAT_WRITE_BEHIND_STORE_ATTEMPTS = 4
+CHAT_WRITE_BEHIND_RETRY_BACKOFF_SECONDS = 0.5
+
+# users authenticated on websocket handshake are cached for this long (seconds) in every worker
+# a user deactivated in one worker can still connect through the others until their entry expires
+CHAT_WS_USER_CACHE_TTL = 30
+CHAT_WS_USER_CACHE_SIZE = 10000
+# when True the websocket user is built from the token claims, without any DB lookup
+CHAT_WS_TRUST_TOKEN_CLAIMS = False
+
+# where representative availability and load is kept for assigning customers
+# 'memory' works for a single worker, use 'redis' when running more than one
+CHAT_PRESENCE_BACKEND = 'memory'
+CHAT_PRESENCE_REDIS_URL = 'redis://127.0.0.1:6379/0'
+# redis - connections expire unless their worker refreshes them (heartbeat), so a crashed worker's sockets stop counting
+CHAT_PRESENCE_CONNECTION_TTL = 60
+CHAT_PRESENCE_HEARTBEAT_SECONDS = 20
+
+# max conversations one multiplexed socket (ws/chat/) can be subscribed to
+CHAT_MULTIPLEX_MAX_SUBSCRIPTIONS = 100
+
+# token bucket limits of the chat messages (messages per second, burst), per socket and per user
+CHAT_RATE_LIMIT_SOCKET_RATE = 5
+CHAT_RATE_LIMIT_SOCKET_BURST = 20
+CHAT_RATE_LIMIT_USER_RATE = 10
+CHAT_RATE_LIMIT_USER_BURST = 40
+# messages allowed in one batched frame {"messages": [...]}
+CHAT_MAX_BATCH_MESSAGES = 20
+
+# resuming a socket with ?last_seq= - recent messages kept per conversation (and conversations kept) in every worker,
+# older gaps are read from the DB, gaps larger than CHAT_REPLAY_MAX_MESSAGES get a chat.resync frame instead
+CHAT_REPLAY_BUFFER_SIZE = 100
+CHAT_REPLAY_BUFFER_CONVERSATIONS = 1000
+CHAT_REPLAY_MAX_MESSAGES = 500
+
+# conversations without messages for this many days are moved to the compressed archive
+# by the archive_conversations command (chat.archive), and restored when opened again
+CHAT_ARCHIVE_IDLE_DAYS = 30
+CHAT_ARCHIVE_COMPRESSION_LEVEL = 10
+
+# message search (chat.search) - 'postgres' (GIN full text index) or 'memory' (in process inverted index)
+# None picks postgres on PostgreSQL and memory on other databases
+CHAT_SEARCH_BACKEND = None
+
+
+# Analytics Configuration
+# in process LRU tier + AnalyticsCacheEntry table tier in front of the LLM
+ANALYTICS_CACHE_MEMORY_MAX_ENTRIES = 512
+ANALYTICS_CACHE_DB_MAX_ENTRIES = 10000
+ANALYTICS_CACHE_TTL_SECONDS = 24 * 60 * 60
+
+# background analytics jobs (async mode of GetAnalytics)
+ANALYTICS_MAX_WORKERS = 4
+ANALYTICS_MAX_QUEUED_JOBS = 100
+# requests of a conversation within this window are merged into one LLM call
+ANALYTICS_DEBOUNCE_SECONDS = 2.0
+ANALYTICS_DEBOUNCE_MAX_WAIT_SECONDS = 10.0
+
+# batch endpoint - max conversations per request and LLM calls running at the same time
+ANALYTICS_BATCH_MAX_CONVERSATIONS = 50
+ANALYTICS_BATCH_CONCURRENCY = 5
+
+# analytics report (analytics/report/) - days shown when no range is given and the longest range allowed
+ANALYTICS_REPORT_DEFAULT_DAYS = 30
+ANALYTICS_REPORT_MAX_DAYS = 366
+
+# seconds the token from analytics/stream/<id>/token/ can be used to open the stream (EventSource has no auth header)
+ANALYTICS_STREAM_TOKEN_MAX_AGE = 60
+
+# local classifier tier - sentiment / loan_type answered without the LLM when confident enough
+ANALYTICS_LOCAL_CONFIDENCE = 0.6
+ANALYTICS_LLM_EVERY_N_MESSAGES = 5
+# True = never call the LLM (offline mode, deterministic results for tests)
+ANALYTICS_LOCAL_ONLY = False
+
+# transcript sent to the LLM - estimated token budget and share kept for the latest messages word for word
+ANALYTICS_PROMPT_TOKEN_BUDGET = 2000
+ANALYTICS_PROMPT_RECENT_SHARE = 0.75
+
+# LLM used for analytics, created on first use - 'gemini', 'fake' (local, no network) or dotted path of a backend class
+ANALYTICS_LLM_BACKEND = 'gemini'
+ANALYTICS_LLM_MODEL = 'gemini-2.5-flash'
+
+# LLM call failure handling - deadline per attempt, retries with jittered backoff, circuit breaker
+ANALYTICS_LLM_TIMEOUT_SECONDS = 30
+ANALYTICS_LLM_MAX_RETRIES = 2
+ANALYTICS_LLM_BACKOFF_BASE_SECONDS = 0.5
+ANALYTICS_LLM_BACKOFF_MAX_SECONDS = 8
+ANALYTICS_LLM_BREAKER_FAILURE_THRESHOLD = 5
+ANALYTICS_LLM_BREAKER_RESET_SECONDS = 30
+# duplicate request when the first is slower than this (seconds), None = disabled
+ANALYTICS_LLM_HEDGE_AFTER_SECONDS = None
+
+# fake LLM backend only - added latency (seconds) and share of calls which fail
+ANALYTICS_FAKE_LLM_LATENCY_SECONDS = 0.0
+ANALYTICS_FAKE_LLM_LATENCY_JITTER_SECONDS = 0.0
+ANALYTICS_FAKE_LLM_ERROR_RATE = 0.0
@@ -3,4 +3,5 @@ from .models import *
 
 # Register your models here.
 admin.site.register(Conversation)
-admin.site.register(Messages)
\ No newline at end of file
+admin.site.register(Messages)
+admin.site.register(ArchivedConversation)
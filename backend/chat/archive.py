@@ -0,0 +1,177 @@
+# cold tier of the message storage
+# Messages only keeps the conversations which are in use, the messages of a conversation idle for
+# CHAT_ARCHIVE_IDLE_DAYS are moved to one ArchivedConversation row (zstd compressed msgpack)
+# by the archive_conversations command, and put back when the conversation is opened again
+# (socket connect / subscribe and the history api), so the rest of the code only reads Messages
+
+import uuid
+from datetime import datetime, timedelta, timezone as dt_timezone
+import msgpack
+import zstandard
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+from authapp.models import MyUser
+from .models import Conversation, Messages, ArchivedConversation
+from . import search, presence
+
+
+IDLE_DAYS = getattr(settings, 'CHAT_ARCHIVE_IDLE_DAYS', 30)
+COMPRESSION_LEVEL = getattr(settings, 'CHAT_ARCHIVE_COMPRESSION_LEVEL', 10)
+
+# format of the payload, bumped if the packed fields change
+PAYLOAD_VERSION = 1
+# Messages fields of the packed rows, in order
+PACKED_FIELDS = ('id', 'seq', 'sender_id', 'text', 'created_at')
+
+
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+
+# created_at as integer microseconds, exact unlike float timestamps
+def _to_micros(value):
+    return (value - EPOCH) // timedelta(microseconds=1)
+
+
+def _from_micros(value):
+    return EPOCH + timedelta(microseconds=value)
+
+
+# message rows (dicts of PACKED_FIELDS) -> (compressed payload, raw size)
+def pack(rows):
+    packed = msgpack.packb({
+        'v': PAYLOAD_VERSION,
+        'messages': [
+            [row['id'].bytes, row['seq'], row['sender_id'].bytes, row['text'], _to_micros(row['created_at'])]
+            for row in rows
+        ],
+    }, use_bin_type=True)
+    return zstandard.ZstdCompressor(level=COMPRESSION_LEVEL).compress(packed), len(packed)
+
+
+def unpack(payload):
+    data = msgpack.unpackb(zstandard.ZstdDecompressor().decompress(bytes(payload)), raw=False)
+    if data.get('v') != PAYLOAD_VERSION:
+        raise ValueError(f"Unknown archive payload version {data.get('v')}")
+
+    return [
+        {
+            'id': uuid.UUID(bytes=message_id),
+            'seq': seq,
+            'sender_id': uuid.UUID(bytes=sender_id),
+            'text': text,
+            'created_at': _from_micros(created_at),
+        }
+        for message_id, seq, sender_id, text, created_at in data['messages']
+    ]
+
+
+# conversations whose last message is older than the cutoff, uses the (conversation, created_at, id) index
+def find_idle_conversations(cutoff, limit=None):
+    conversation_ids = (
+        Messages.objects.values('conversation_id')
+        .annotate(last_message_at=Max('created_at'))
+        .filter(last_message_at__lt=cutoff)
+        .order_by('last_message_at')
+        .values_list('conversation_id', flat=True)
+    )
+    return list(conversation_ids[:limit] if limit else conversation_ids)
+
+
+def idle_cutoff(idle_days=IDLE_DAYS):
+    return timezone.now() - timedelta(days=idle_days)
+
+
+def _get_representative_id(conversation_id):
+    conversation = Conversation.objects.filter(id=conversation_id).values('user1_id', 'user2_id').first()
+    if conversation is None:
+        return None
+    return MyUser.objects.filter(
+        id__in=[conversation['user1_id'], conversation['user2_id']],
+        user_type='representative'
+    ).values_list('id', flat=True).first()
+
+
+# moves the messages of the conversation to its archive, returns the number of messages moved
+# the conversation row is locked like when messages are stored (chat.persistence), so a message
+# arriving meanwhile either comes before (conversation is not idle anymore, nothing is archived) or after
+def archive_conversation(conversation_id, cutoff):
+    with transaction.atomic():
+        conversation = Conversation.objects.select_for_update().filter(id=conversation_id).first()
+        if conversation is None:
+            return 0
+        newly_archived = conversation.archived_at is None
+
+        rows = list(
+            Messages.objects.filter(conversation_id=conversation_id)
+            .order_by('created_at', 'id')
+            .values(*PACKED_FIELDS)
+        )
+        if not rows or rows[-1]['created_at'] >= cutoff:
+            return 0
+
+        # conversation archived before and some messages came later (archived again before being opened)
+        previous = ArchivedConversation.objects.filter(conversation_id=conversation_id).first()
+        if previous:
+            rows = sorted(unpack(previous.payload) + rows, key=lambda row: (row['created_at'], row['id']))
+
+        payload, raw_size = pack(rows)
+        ArchivedConversation.objects.update_or_create(
+            conversation_id=conversation_id,
+            defaults={
+                'payload': payload,
+                'message_count': len(rows),
+                'first_message_at': rows[0]['created_at'],
+                'last_message_at': rows[-1]['created_at'],
+                'raw_size': raw_size,
+                'compressed_size': len(payload),
+                'archived_at': timezone.now(),
+            },
+        )
+        Messages.objects.filter(conversation_id=conversation_id, created_at__lt=cutoff).delete()
+        Conversation.objects.filter(id=conversation_id).update(archived_at=timezone.now())
+
+    # archived messages are not searchable until the conversation is restored
+    search.forget_messages([row['id'] for row in rows])
+    # no longer counts in the load of its representative (chat.presence)
+    if newly_archived:
+        representative_id = _get_representative_id(conversation_id)
+        if representative_id:
+            presence.conversation_released(representative_id)
+    return len(rows)
+
+
+# puts the archived messages back in Messages (same ids and seq), returns the number of messages restored
+# analytics of the conversation lost their last_message on archiving (SET_NULL), so the next
+# refresh after a restore uses the full transcript
+def restore_conversation(conversation_id):
+    with transaction.atomic():
+        Conversation.objects.select_for_update().filter(id=conversation_id).first()
+        archive = ArchivedConversation.objects.filter(conversation_id=conversation_id).first()
+        if archive is None:
+            Conversation.objects.filter(id=conversation_id, archived_at__isnull=False).update(archived_at=None)
+            return 0
+
+        rows = unpack(archive.payload)
+        Messages.objects.bulk_create(
+            [Messages(conversation_id=conversation_id, **row) for row in rows],
+            batch_size=1000,
+            ignore_conflicts=True,
+        )
+        archive.delete()
+        Conversation.objects.filter(id=conversation_id).update(archived_at=None)
+
+    search.index_messages([{**row, 'conversation_id': conversation_id} for row in rows])
+    representative_id = _get_representative_id(conversation_id)
+    if representative_id:
+        presence.conversation_assigned(representative_id)
+    return len(rows)
+
+
+# read through - called with a conversation already loaded, costs nothing unless it is archived
+def ensure_restored(conversation):
+    if conversation is not None and conversation.archived_at is not None:
+        restore_conversation(conversation.id)
+        conversation.archived_at = None
+    return conversation
@@ -1,29 +1,147 @@
-import json
-from authapp.models import MyUser
-from datetime import datetime, timezone
-from .models import Messages, Conversation
+import uuid
+from urllib.parse import parse_qs
+from datetime import datetime, timedelta, timezone
+from django.conf import settings
+from django.db.models import Q
+from .models import Conversation
+from . import protocol
+from . import ratelimit
+from . import replay
+from . import archive
+from .persistence import WRITE_BEHIND, batcher, store_messages
+from .presence import representative_connected, representative_disconnected
 from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
 
-# saving the message to the DB
+# conversations one multiplexed socket can be subscribed to at the same time
+MULTIPLEX_MAX_SUBSCRIPTIONS = getattr(settings, 'CHAT_MULTIPLEX_MAX_SUBSCRIPTIONS', 100)
+
+
+# channel layer group of a conversation, all sockets of the conversation are added to it
+def get_group_name(conversation_id):
+    return f'chat_{conversation_id}'
+
+
+# canonical text of a conversation id (lowercase with hyphens), None if it is not a UUID
+# subscriptions and group names use it, so "ABC..." / "abc..." / no hyphens are the same conversation
+def normalize_conversation_id(value):
+    try:
+        return str(uuid.UUID(str(value)))
+    except ValueError:
+        return None
+
+
+# getting the conversation of the socket, only if the user is one of its participants
+# done once on connect, so the messages afterwards need no lookups
+# archived conversation is opened again here, its messages are moved back to Messages
 @database_sync_to_async
-def save_message(conversation_id, sender_id, text):
+def get_conversation(conversation_id, user_id):
     try:
-        conversation = Conversation.objects.get(id=conversation_id)
-        sender = MyUser.objects.get(id=sender_id)
+        conversation_id = uuid.UUID(str(conversation_id))
+    except ValueError:
+        return None
 
-        Messages.objects.create(
-            conversation=conversation,
-            sender=sender,
-            text=text
-        )
+    return archive.ensure_restored(Conversation.objects.filter(
+        Q(user1_id=user_id) | Q(user2_id=user_id),
+        id=conversation_id
+    ).first())
+
+
+# ids (as str) of the given conversations which the user is part of, one query for all of them
+# (archived ones are restored like on connect)
+@database_sync_to_async
+def get_allowed_conversations(conversation_ids, user_id):
+    valid_ids = [conversation_id for conversation_id in map(normalize_conversation_id, conversation_ids) if conversation_id]
+    if not valid_ids:
+        return set()
 
-    except Conversation.DoesNotExist:
-        print(f"Conversation with id {conversation_id} does not exist.")
-    except MyUser.DoesNotExist:
-        print(f"User with id {sender_id} does not exist.")
+    allowed = Conversation.objects.filter(
+        Q(user1_id=user_id) | Q(user2_id=user_id),
+        id__in=valid_ids
+    ).values_list('id', 'archived_at')
+
+    for conversation_id, archived_at in allowed:
+        if archived_at is not None:
+            archive.restore_conversation(conversation_id)
+    return {str(conversation_id) for conversation_id, _ in allowed}
+
+
+# saving the message to the DB
+# conversation and sender are already validated on connect, so it is a single INSERT using the ids
+# (plus the seq of the conversation and the UPDATE of its inbox entries)
+# returns the stored rows (with their seq)
+@database_sync_to_async
+def save_messages(rows):
+    try:
+        return store_messages(rows)
     except Exception as e:
         print(f"An unexpected error occurred: {e}")
+        return []
+
+
+# message texts of a frame - {"text": "..."} or batched {"messages": [{"text": "..."}, ...]}
+def get_texts(data):
+    if isinstance(data.get('messages'), list):
+        texts = [message.get('text') for message in data['messages'] if isinstance(message, dict)]
+    else:
+        texts = [data.get('text')]
+    return [text for text in texts if text and isinstance(text, str)]
+
+
+# saving + broadcasting messages of the user to every socket of the conversation
+# used by the per conversation socket and the multiplexed socket
+# a batch costs one INSERT and one group_send however many messages it has
+async def publish_messages(channel_layer, conversation_id, sender_id, texts):
+    utc_time = datetime.now(timezone.utc)
+    # messages of one batch are 1 microsecond apart, so their order is kept
+    # id is set here, so a message broadcast before it is stored (write behind) has its final id
+    rows = [
+        {
+            'id': uuid.uuid4(),
+            'conversation_id': conversation_id,
+            'sender_id': sender_id,
+            'text': text,
+            'created_at': utc_time + timedelta(microseconds=position),
+        }
+        for position, text in enumerate(texts)
+    ]
+
+    # saving message to the DB before broadcasting, this also gives the messages their seq
+    # in write behind mode it is queued after the broadcast instead
+    if not WRITE_BEHIND:
+        rows = await save_messages(rows)
+        if not rows:
+            return
+
+    # Create the final message objects on the backend (see replay.build_message for the format)
+    final_messages = [replay.build_message(row) for row in rows]
+
+    # Broadcast the new, complete message objects
+    # This is not socket send, it tells channel layer to take this dict and deliver it to every consumer currently subscribed to the group
+    # messages are encoded once here (JSON text + msgpack bytes), not again for every socket of the group
+    if len(final_messages) == 1:
+        # Looks for the chat_message handler on the consumer with this name
+        # if type: chat.message would also converted to chat_message
+        event = {'type': 'chat_message', 'frames': protocol.encode_frames(final_messages[0])}
+    else:
+        # whole batch in one event, every socket still gets one chat.message frame per message
+        event = {'type': 'chat_messages', 'frames': [protocol.encode_frames(message) for message in final_messages]}
+    await channel_layer.group_send(get_group_name(conversation_id), event)
+
+    # write behind - waits here only when the queue is full
+    if WRITE_BEHIND:
+        for row in rows:
+            await batcher.add(row)
+
+
+# last seq the client has, from ?last_seq=<seq> of the socket url, None when not given
+def get_last_seq(scope):
+    query = parse_qs(scope.get('query_string', b'').decode('utf-8', errors='ignore'))
+    try:
+        last_seq = int(query.get('last_seq', [''])[0])
+    except ValueError:
+        return None
+    return last_seq if last_seq >= 0 else None
 
 
 # Actually consumer used to communicate between users
@@ -39,8 +157,19 @@ class ChatConsumer(AsyncWebsocketConsumer):
         # Get the room_name from the URL route using the room_name parameter from the websocket_routing
         # on which request made by user
         self.room_name = self.scope['url_route']['kwargs']['room_name']
-        # then we create the channel layer group name using room_name in socket url
-        self.room_group_name = f'chat_{self.room_name}'
+
+        # room_name is the conversation id, user can only join the conversations they are part of
+        self.conversation = await get_conversation(self.room_name, self.scope['user'].id)
+        if not self.conversation:
+            await self.close()
+            return
+
+        # ids used for every message of this socket, client payload is not trusted for them
+        self.conversation_id = str(self.conversation.id)
+        self.sender_id = str(self.scope['user'].id)
+
+        # then we create the channel layer group name using the conversation id from socket url
+        self.room_group_name = get_group_name(self.conversation_id)
 
         # If authenticated, proceed to join to the channel layer using
         # the group name in the channels and the channel_name (unique name for each of the websocket object (or user))
@@ -49,8 +178,23 @@ class ChatConsumer(AsyncWebsocketConsumer):
             self.channel_name
         )
 
-        # accept the connection
-        await self.accept()
+        # messages of this socket, the user bucket is shared with the other sockets of the user
+        self.rate_limit = ratelimit.socket_bucket()
+
+        # accept the connection, with the frame format asked by the client (JSON when nothing was asked)
+        self.subprotocol = protocol.negotiate(self.scope.get('subprotocols'))
+        await self.accept(self.subprotocol)
+
+        # reconnect (?last_seq=<seq>) - messages missed while the socket was gone
+        # the socket is already in the group, so nothing stored from now on is missed
+        last_seq = get_last_seq(self.scope)
+        if last_seq is not None:
+            await self.replay_missed(self.conversation_id, last_seq)
+
+        # representative with an open socket is available for new customers
+        self.is_representative = getattr(self.scope['user'], 'user_type', None) == 'representative'
+        if self.is_representative:
+            await database_sync_to_async(representative_connected)(self.sender_id, self.channel_name)
 
 
 
@@ -63,68 +207,230 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 self.channel_name
             )
 
+        if getattr(self, 'is_representative', False):
+            await database_sync_to_async(representative_disconnected)(self.sender_id, self.channel_name)
+
+        # write behind - make sure the queued messages are in the DB before the socket is gone
+        if WRITE_BEHIND:
+            await batcher.flush()
+
 
 
     # function to receive data from the socket
-    # text_data = for text_data
-    # another parameter exists, binary_data = for binary data
-    async def receive(self, text_data):
-        text_data_json = json.loads(text_data)
-
-        conversation_id = text_data_json.get('conversation_id')
-        sender_id = text_data_json.get('sender')
-        text = text_data_json.get('text')
-
-        utc_time = datetime.now(timezone.utc)
-        iso_format_time = utc_time.isoformat()
-
-        # saving message to the DB
-        await save_message(
-            conversation_id=conversation_id,
-            sender_id=sender_id,
-            text=text
-        )
+    # text_data = for text_data (JSON)
+    # bytes_data = for binary data (msgpack)
+    # frame is {"text": "..."} or a batch {"messages": [{"text": "..."}, ...]}
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            text_data_json = protocol.decode(text_data, bytes_data)
+        except protocol.ProtocolError:
+            return
+
+        # conversation and sender come from the connection, not from the payload
+        await self.send_messages(self.conversation_id, get_texts(text_data_json))
 
 
-        # Create the final message object on the backend
-        final_message = {
-            # lot of data might we passing through websockets
-            # data like notification, alert, typing, etc data can be present in the websocket connection
-            # the purpose of this is what kind of message it just received so frontend knows how to handle it.
-            # without type label - frontend would receive blob of data and have no idea what it is or what to do with it
-            # format of the value for this key - can be anything, but a good pratice is to use namespace.action format
-            # eg.'chat.message'	A standard message sent by a user in a chat.
-            # 'user.typing.start'	A notification that a user has started typing.
-            # 'user.typing.stop'	A notification that a user has stopped typing.
-            'type': 'chat.message',
+    # rate limited publish of the messages of one frame, all of them are accepted or none
+    async def send_messages(self, conversation_id, texts):
+        if not texts:
+            return
+
+        if len(texts) > ratelimit.MAX_BATCH_MESSAGES:
+            await self.send_error('batch_too_large', conversation_id, max_messages=ratelimit.MAX_BATCH_MESSAGES)
+            return
 
-            # actual data to send 
+        retry_after = ratelimit.acquire([self.rate_limit, ratelimit.user_bucket(self.sender_id)], len(texts))
+        if retry_after:
+            await self.send_error('rate_limited', conversation_id, retry_after=round(retry_after, 3), refused=len(texts))
+            return
+
+        await publish_messages(self.channel_layer, conversation_id, self.sender_id, texts)
+
+
+    # sends the chat.message frames after last_seq and then chat.replayed with the seq the client is at now
+    # chat.resync when the gap is too large, client reloads the history instead
+    async def replay_missed(self, conversation_id, last_seq):
+        # write behind - queued messages get their seq first
+        if WRITE_BEHIND:
+            await batcher.flush()
+
+        frames, current_seq = await replay.get_missed_frames(conversation_id, last_seq)
+        if frames is None:
+            await self.send(**protocol.encode_for(self.subprotocol, {
+                'type': 'chat.resync',
+                'conversation_id': conversation_id,
+                'last_seq': current_seq,
+            }))
+            return
+
+        for message_frames in frames:
+            await self.send(**protocol.frame_for(self.subprotocol, message_frames))
+        await self.send(**protocol.encode_for(self.subprotocol, {
+            'type': 'chat.replayed',
             'conversation_id': conversation_id,
-            'sender': sender_id,
-            'text': text,
-            'timestamp': iso_format_time
-        }
+            'last_seq': max(current_seq, last_seq),
+            'count': len(frames),
+        }))
 
-        # Broadcast the new, complete message object
-        # This is not socket send, it tells channel layer to take this dict and deliver it to every consumer currently subscribed to the group
-        await self.channel_layer.group_send(
-            # group name in channels
-            self.room_group_name,
-            # this is an event dictionary
-            {
-                # This is the event name for the handler
-                # Looks for the chat_message handler on the consumer with this name
-                # if type: chat.message would also converted to chat_message
-                'type': 'chat_message', 
-                'message_data': final_message # Send the enriched message
-            }
-        )
+
+    async def send_error(self, code, conversation_id=None, **details):
+        error = {'type': 'error', 'code': code, **details}
+        if conversation_id:
+            error['conversation_id'] = conversation_id
+        await self.send(**protocol.encode_for(self.subprotocol, error))
     
     # this method invoke on all consumer in group
     # both get event dict as an argument
     # each consumer takes the message from event dict and then sends the complete message to the websocket of user (browser)
     # for each connected user this function runs
     async def chat_message(self, event):
-        message_data = event['message_data']
-        # Send the final message object to the client
-        await self.send(text_data=json.dumps(message_data))
\ No newline at end of file
+        # events without frames (message_data only) are encoded here
+        frames = event.get('frames') or protocol.encode_frames(event['message_data'])
+        # Send the final message object to the client, in the format of this socket
+        await self.send(**protocol.frame_for(self.subprotocol, frames))
+
+
+    # batch of messages published with one group_send
+    async def chat_messages(self, event):
+        for frames in event['frames']:
+            await self.send(**protocol.frame_for(self.subprotocol, frames))
+
+
+    # write behind - seq of messages broadcast before they were stored (pushed by persistence.MessageBatcher)
+    async def chat_sync(self, event):
+        await self.send(**protocol.frame_for(self.subprotocol, event['frames']))
+
+
+    # analytics job finished (pushed by analytics.jobs)
+    # analytics are only meant for the representative, customer socket ignores them
+    async def analytics_update(self, event):
+        if getattr(self.scope['user'], 'user_type', None) != 'representative':
+            return
+        await self.send(**protocol.encode_for(self.subprotocol, event['analytics_data']))
+
+
+# one socket for all the conversations of a user (ws/chat/), mainly for representatives with many customers
+# the socket is authenticated once, then conversations are joined / left with frames
+# {"action": "subscribe", "conversation_ids": [...]} (or "conversation_id"), with "last_seqs": {"<conversation_id>": <seq>}
+# to get the messages missed since a previous socket
+# {"action": "unsubscribe", "conversation_ids": [...]}
+# {"action": "message", "conversation_id": "...", "text": "..."} (or "messages": [{"text": "..."}, ...])
+# messages and analytics of all subscribed conversations come on this socket, tagged with their conversation_id
+# uses the same chat_<conversation_id> groups, so it talks with the per conversation sockets as well
+class MultiplexChatConsumer(ChatConsumer):
+
+    async def connect(self):
+        if not self.scope["user"].is_authenticated:
+            await self.close()
+            return
+
+        self.sender_id = str(self.scope['user'].id)
+        # conversation ids (str) this socket is in the group of
+        self.subscriptions = set()
+        self.rate_limit = ratelimit.socket_bucket()
+
+        self.subprotocol = protocol.negotiate(self.scope.get('subprotocols'))
+        await self.accept(self.subprotocol)
+
+        # one socket = one connection in presence, however many conversations it follows
+        self.is_representative = getattr(self.scope['user'], 'user_type', None) == 'representative'
+        if self.is_representative:
+            await database_sync_to_async(representative_connected)(self.sender_id, self.channel_name)
+
+
+    async def disconnect(self, close_code):
+        for conversation_id in getattr(self, 'subscriptions', ()):
+            await self.channel_layer.group_discard(get_group_name(conversation_id), self.channel_name)
+
+        if getattr(self, 'is_representative', False):
+            await database_sync_to_async(representative_disconnected)(self.sender_id, self.channel_name)
+
+        if WRITE_BEHIND:
+            await batcher.flush()
+
+
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            data = protocol.decode(text_data, bytes_data)
+        except protocol.ProtocolError:
+            return
+
+        action = data.get('action')
+        if action == 'subscribe':
+            last_seqs = data.get('last_seqs')
+            last_seqs = {normalize_conversation_id(key): value for key, value in last_seqs.items()} if isinstance(last_seqs, dict) else {}
+            await self.subscribe(await self.get_conversation_ids(data), last_seqs)
+        elif action == 'unsubscribe':
+            await self.unsubscribe(await self.get_conversation_ids(data))
+        elif action == 'message':
+            conversation_id = normalize_conversation_id(data.get('conversation_id'))
+            if conversation_id is None:
+                await self.send_error('invalid_conversation_id', data.get('conversation_id'))
+                return
+            if conversation_id not in self.subscriptions:
+                await self.send_error('not_subscribed', conversation_id)
+                return
+            await self.send_messages(conversation_id, get_texts(data))
+        else:
+            await self.send_error('unknown_action')
+
+
+    # normalized ids of the frame, the ones which are not UUIDs get an invalid_conversation_id error
+    async def get_conversation_ids(self, data):
+        conversation_ids = data.get('conversation_ids')
+        if not isinstance(conversation_ids, list):
+            conversation_ids = [data.get('conversation_id')]
+
+        normalized = []
+        for conversation_id in conversation_ids:
+            if not conversation_id:
+                continue
+            value = normalize_conversation_id(conversation_id)
+            if value is None:
+                await self.send_error('invalid_conversation_id', conversation_id)
+                continue
+            normalized.append(value)
+        return normalized
+
+
+    # every conversation is checked against the user, the ones they are not part of are refused
+    async def subscribe(self, conversation_ids, last_seqs=None):
+        new_ids = [conversation_id for conversation_id in dict.fromkeys(conversation_ids) if conversation_id not in self.subscriptions]
+        allowed = await get_allowed_conversations(new_ids, self.sender_id) if new_ids else set()
+
+        subscribed = []
+        for conversation_id in new_ids:
+            if conversation_id not in allowed:
+                await self.send_error('forbidden', conversation_id)
+                continue
+            if len(self.subscriptions) >= MULTIPLEX_MAX_SUBSCRIPTIONS:
+                await self.send_error('too_many_subscriptions', conversation_id)
+                continue
+            await self.channel_layer.group_add(get_group_name(conversation_id), self.channel_name)
+            self.subscriptions.add(conversation_id)
+            subscribed.append(conversation_id)
+
+        await self.send(**protocol.encode_for(self.subprotocol, {
+            'type': 'chat.subscribed',
+            'conversation_ids': subscribed,
+        }))
+
+        for conversation_id in subscribed:
+            last_seq = (last_seqs or {}).get(conversation_id)
+            if isinstance(last_seq, int) and not isinstance(last_seq, bool) and last_seq >= 0:
+                await self.replay_missed(conversation_id, last_seq)
+
+
+    async def unsubscribe(self, conversation_ids):
+        unsubscribed = []
+        for conversation_id in dict.fromkeys(conversation_ids):
+            if conversation_id not in self.subscriptions:
+                continue
+            await self.channel_layer.group_discard(get_group_name(conversation_id), self.channel_name)
+            self.subscriptions.discard(conversation_id)
+            unsubscribed.append(conversation_id)
+
+        await self.send(**protocol.encode_for(self.subprotocol, {
+            'type': 'chat.unsubscribed',
+            'conversation_ids': unsubscribed,
+        }))
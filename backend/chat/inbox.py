@@ -0,0 +1,52 @@
+# keeping InboxEntry rows in step with the stored messages
+# called by chat.persistence in the same transaction as the INSERT of the messages,
+# costs one UPDATE per conversation of the batch (both entries of the conversation at once)
+
+from collections import defaultdict
+from django.db.models import Case, When, Value, F, Q, TextField, DateTimeField, PositiveIntegerField
+from .models import Conversation, InboxEntry
+
+
+# rows are dicts with the Messages fields (conversation_id, sender_id, text, created_at)
+def record_messages(rows):
+    by_conversation = defaultdict(list)
+    for row in rows:
+        by_conversation[str(row['conversation_id'])].append(row)
+
+    for conversation_id, conversation_rows in by_conversation.items():
+        updated = _update_entries(conversation_id, conversation_rows)
+        # conversation created without its entries (e.g. admin / shell), they are created once here
+        if not updated:
+            conversation = Conversation.objects.filter(id=conversation_id).values('user1_id', 'user2_id').first()
+            if conversation:
+                InboxEntry.objects.create_for_conversation(conversation_id, conversation['user1_id'], conversation['user2_id'])
+                _update_entries(conversation_id, conversation_rows)
+
+
+def _update_entries(conversation_id, rows):
+    rows = sorted(rows, key=lambda row: row['created_at'])
+    last = rows[-1]
+
+    # sender has read everything before their own message, their unread count becomes
+    # the messages of the other user after it, the other user gets all the messages as unread
+    unread_after_own = {}
+    for row in rows:
+        sender_id = str(row['sender_id'])
+        unread_after_own[sender_id] = 0
+        for other_id in unread_after_own:
+            if other_id != sender_id:
+                unread_after_own[other_id] += 1
+
+    unread = Case(
+        *[When(owner_id=sender_id, then=Value(count)) for sender_id, count in unread_after_own.items()],
+        default=F('unread_count') + Value(len(rows)),
+        output_field=PositiveIntegerField(),
+    )
+
+    # rows stored late (write behind) must not replace a newer last message
+    is_newer = Q(last_activity_at__lte=last['created_at'])
+    return InboxEntry.objects.filter(conversation_id=conversation_id).update(
+        unread_count=unread,
+        last_message_text=Case(When(is_newer, then=Value(last['text'])), default=F('last_message_text'), output_field=TextField()),
+        last_activity_at=Case(When(is_newer, then=Value(last['created_at'])), default=F('last_activity_at'), output_field=DateTimeField()),
+    )
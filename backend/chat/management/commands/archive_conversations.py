@@ -0,0 +1,67 @@
+# moves the messages of idle conversations out of Messages into compressed ArchivedConversation rows
+# meant to run periodically (cron / scheduler), archived conversations are restored when they are opened
+#
+# python manage.py archive_conversations --idle-days 30 --limit 1000
+# python manage.py archive_conversations --dry-run
+# python manage.py archive_conversations --restore <conversation_id>
+
+import time
+import uuid
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Sum
+from chat import archive
+from chat.models import ArchivedConversation
+
+
+class Command(BaseCommand):
+    help = 'Archive the messages of conversations idle for the given number of days (zstd compressed).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--idle-days', type=float, default=archive.IDLE_DAYS, help='Conversations without messages for this many days are archived.')
+        parser.add_argument('--limit', type=int, default=None, help='Max conversations archived in this run.')
+        parser.add_argument('--dry-run', action='store_true', help='Only list the conversations which would be archived.')
+        parser.add_argument('--restore', metavar='CONVERSATION_ID', help='Move the messages of one archived conversation back instead.')
+
+    def handle(self, *args, **options):
+        if options['restore']:
+            try:
+                conversation_id = uuid.UUID(options['restore'])
+            except ValueError:
+                raise CommandError(f"Invalid conversation id {options['restore']}")
+            restored = archive.restore_conversation(conversation_id)
+            self.stdout.write(f"Restored {restored} messages of conversation {conversation_id}")
+            return
+
+        if options['idle_days'] <= 0:
+            raise CommandError('--idle-days must be positive.')
+        if options['limit'] is not None and options['limit'] < 1:
+            raise CommandError('--limit must be at least 1.')
+
+        cutoff = archive.idle_cutoff(options['idle_days'])
+        conversation_ids = archive.find_idle_conversations(cutoff, options['limit'])
+
+        if options['dry_run']:
+            for conversation_id in conversation_ids:
+                self.stdout.write(str(conversation_id))
+            self.stdout.write(f"{len(conversation_ids)} conversations idle since {cutoff.isoformat()}")
+            return
+
+        started = time.perf_counter()
+        conversations = messages = 0
+        # one transaction per conversation, an error only skips that conversation
+        for conversation_id in conversation_ids:
+            try:
+                moved = archive.archive_conversation(conversation_id, cutoff)
+            except Exception as e:
+                self.stderr.write(self.style.ERROR(f"Could not archive conversation {conversation_id}: {e}"))
+                continue
+            if moved:
+                conversations += 1
+                messages += moved
+
+        totals = ArchivedConversation.objects.aggregate(raw=Sum('raw_size'), compressed=Sum('compressed_size'))
+        ratio = (totals['raw'] or 0) / totals['compressed'] if totals['compressed'] else 0
+        self.stdout.write(
+            f"Archived {messages} messages of {conversations} conversations in {time.perf_counter() - started:.2f} s, "
+            f"archive holds {totals['compressed'] or 0} bytes ({ratio:.1f}x compression)"
+        )
@@ -0,0 +1,374 @@
+# load test of the websocket chat path
+# opens N authenticated sockets (token in the query string, through JWTAuthMiddleware) spread over M rooms,
+# every socket sends messages at a fixed rate and every socket of the room has to receive them
+# runs on a throwaway test database, results can be saved as JSON and compared with an earlier run (baseline)
+#
+# python manage.py loadtest_chat --rooms 50 --sockets 200 --messages 20 --rate 5 --output result.json
+# python manage.py loadtest_chat --rooms 50 --sockets 200 --messages 20 --rate 5 --baseline result.json
+# (a baseline is only compared with a run of the same options, see COMPARED_CONFIG)
+
+import json
+import time
+import asyncio
+import platform
+import threading
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.db.backends.signals import connection_created
+from django.test.utils import override_settings
+from channels.layers import channel_layers
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from chat import protocol
+
+
+# metrics compared with the baseline, True = higher is better
+BASELINE_METRICS = {
+    'latency_ms.p50': False,
+    'latency_ms.p95': False,
+    'latency_ms.p99': False,
+    'throughput.deliveries_per_second': True,
+    'db.writes_per_message': False,
+}
+# config values which change the workload, a baseline is only compared with a run of the same ones
+# (python version / database are informational, database is the same for every run of a checkout)
+COMPARED_CONFIG = ('rooms', 'sockets', 'messages_per_socket', 'batch', 'rate_per_socket', 'layer', 'protocol', 'write_behind')
+
+
+# counts the queries of every DB connection (the consumer runs its queries on worker threads)
+class QueryCounter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.queries = 0
+        self.writes = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        with self._lock:
+            self.queries += 1
+            if sql.lstrip().split(' ', 1)[0].upper() in ('INSERT', 'UPDATE', 'DELETE'):
+                self.writes += 1
+        return execute(sql, params, many, context)
+
+    def install(self, connection, **kwargs):
+        # signal is sent again on every reconnect of the same connection object
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+    def reset(self):
+        with self._lock:
+            self.queries = 0
+            self.writes = 0
+
+
+def percentile(values, percent):
+    if not values:
+        return None
+    values = sorted(values)
+    index = max(0, min(len(values) - 1, round(percent / 100 * len(values) + 0.5) - 1))
+    return values[index]
+
+
+def summarize(values):
+    return {
+        'p50': percentile(values, 50),
+        'p95': percentile(values, 95),
+        'p99': percentile(values, 99),
+        'max': max(values) if values else None,
+        'mean': round(sum(values) / len(values), 3) if values else None,
+    }
+
+
+def get_metric(result, name):
+    value = result
+    for part in name.split('.'):
+        if not isinstance(value, dict) or part not in value:
+            return None
+        value = value[part]
+    return value
+
+
+def run_config(options):
+    return {
+        'rooms': options['rooms'],
+        'sockets': options['sockets'],
+        'messages_per_socket': options['messages'],
+        'batch': options['batch'],
+        'rate_per_socket': options['rate'],
+        'layer': options['layer'],
+        'protocol': options['protocol'],
+        'write_behind': getattr(settings, 'CHAT_WRITE_BEHIND', False),
+        'database': connection.vendor,
+        'python': platform.python_version(),
+    }
+
+
+# list of (config value, baseline value, current value) which differ between the baseline and this run
+def config_differences(baseline, config):
+    baseline_config = baseline.get('config') or {}
+    return [
+        (name, baseline_config.get(name), config[name])
+        for name in COMPARED_CONFIG
+        if baseline_config.get(name) != config[name]
+    ]
+
+
+# list of (metric, baseline value, current value, change) which got worse by more than the tolerance
+def compare(baseline, result, tolerance):
+    regressions = []
+    for name, higher_is_better in BASELINE_METRICS.items():
+        old, new = get_metric(baseline, name), get_metric(result, name)
+        if old is None or new is None:
+            continue
+        if old == 0:
+            worse = new > 0 and not higher_is_better
+            change = None
+        else:
+            change = (new - old) / old
+            worse = change < -tolerance if higher_is_better else change > tolerance
+        if worse:
+            regressions.append((name, old, new, change))
+    return regressions
+
+
+class Command(BaseCommand):
+    help = 'Load test of the websocket chat (latency, throughput and DB writes per message).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, default=10, help='Number of conversations.')
+        parser.add_argument('--sockets', type=int, default=40, help='Total sockets, spread evenly over the rooms (at least 2 per room).')
+        parser.add_argument('--messages', type=int, default=20, help='Messages sent by every socket.')
+        parser.add_argument('--rate', type=float, default=5.0, help='Messages per second sent by every socket.')
+        parser.add_argument('--batch', type=int, default=1, help='Messages per frame (batched frames when above 1).')
+        parser.add_argument('--protocol', choices=['json', 'msgpack'], default='json', help='Frame format of the sockets.')
+        parser.add_argument('--layer', choices=['memory', 'redis'], default='memory', help='Channel layer used for the run.')
+        parser.add_argument('--redis-url', default='redis://127.0.0.1:6379/1')
+        parser.add_argument('--timeout', type=float, default=30.0, help='Seconds to wait for the last deliveries after sending.')
+        parser.add_argument('--output', help='Write the result as JSON to this file.')
+        parser.add_argument('--baseline', help='Earlier JSON result, the command fails when a metric got worse than the tolerance.')
+        parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed change against the baseline (0.2 = 20%%).')
+        parser.add_argument('--ignore-config', action='store_true', help='Compare with a baseline of a different run config (only warns).')
+
+    def handle(self, *args, **options):
+        if options['rooms'] < 1:
+            raise CommandError('--rooms must be at least 1.')
+        if options['sockets'] < 2 * options['rooms']:
+            raise CommandError('--sockets must be at least twice --rooms (customer and representative in every room).')
+        if options['rate'] <= 0:
+            raise CommandError('--rate must be positive.')
+        if options['batch'] < 1:
+            raise CommandError('--batch must be at least 1.')
+
+        # checked before the run, numbers of a different workload (e.g. msgpack against a json baseline) say nothing
+        baseline = None
+        if options['baseline']:
+            with open(options['baseline']) as file:
+                baseline = json.load(file)
+            differences = config_differences(baseline, run_config(options))
+            for name, old, new in differences:
+                self.stderr.write(self.style.WARNING(f'Baseline {name} is {old}, this run uses {new}'))
+            if differences and not options['ignore_config']:
+                raise CommandError(f'Run config differs from the baseline {options["baseline"]}, use the same options or --ignore-config.')
+
+        if options['layer'] == 'redis':
+            layers = {'default': {'BACKEND': 'channels_redis.core.RedisChannelLayer', 'CONFIG': {'hosts': [options['redis_url']]}}}
+        else:
+            layers = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+        # separate test database, created for the run and removed afterwards
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        counter = QueryCounter()
+        connection_created.connect(counter.install)
+        try:
+            for conn in connections.all():
+                counter.install(conn)
+            with override_settings(CHANNEL_LAYERS=layers):
+                channel_layers.backends = {}
+                rooms = self.create_rooms(options['rooms'])
+                result = asyncio.run(self.run(rooms, options, counter))
+        finally:
+            connection_created.disconnect(counter.install)
+            for conn in connections.all():
+                if counter in conn.execute_wrappers:
+                    conn.execute_wrappers.remove(counter)
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            channel_layers.backends = {}
+
+        self.report(result)
+
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                json.dump(result, file, indent=2)
+            self.stdout.write(f"Result written to {options['output']}")
+
+        if baseline is not None:
+            regressions = compare(baseline, result, options['tolerance'])
+            for name, old, new, change in regressions:
+                change = f'{change:+.1%}' if change is not None else 'new'
+                self.stderr.write(f'Regression {name}: {old} -> {new} ({change})')
+            if regressions:
+                raise CommandError(f'{len(regressions)} metric(s) regressed against {options["baseline"]}.')
+            self.stdout.write(self.style.SUCCESS('No regressions against the baseline.'))
+
+    # one customer + one representative per room, sockets of a room alternate between the two
+    # users are created without password hashing, they only need tokens
+    def create_rooms(self, count):
+        from authapp.models import MyUser
+        from authapp.serializers import MyTokenObtainPairSerializer
+        from chat.models import Conversation
+
+        users = []
+        for index in range(count):
+            for user_type in ('customer', 'representative'):
+                user = MyUser(email=f'loadtest-{user_type}-{index}@example.com', first_name='Load', last_name=f'Test {index}', user_type=user_type)
+                user.set_unusable_password()
+                users.append(user)
+        MyUser.objects.bulk_create(users)
+
+        rooms = []
+        for index in range(count):
+            customer, representative = users[2 * index], users[2 * index + 1]
+            conversation, _ = Conversation.objects.get_or_create_for_pair(customer.id, representative.id)
+            tokens = [str(MyTokenObtainPairSerializer.get_token(user).access_token) for user in (customer, representative)]
+            rooms.append((str(conversation.id), tokens))
+        return rooms
+
+    async def run(self, rooms, options, counter):
+        from chat.routing import websocket_urlpatterns
+        from chat.security import JWTAuthMiddleware
+        from chat.persistence import batcher
+
+        application = JWTAuthMiddleware(URLRouter(websocket_urlpatterns))
+
+        # socket i goes to room i % rooms, customer / representative token alternates
+        sockets = []
+        for index in range(options['sockets']):
+            room_index = index % len(rooms)
+            conversation_id, tokens = rooms[room_index]
+            token = tokens[(index // len(rooms)) % 2]
+            sockets.append((index, room_index, f'/ws/chat/{conversation_id}/?token={token}'))
+
+        connect_times = []
+        subprotocol = protocol.MSGPACK if options['protocol'] == 'msgpack' else protocol.JSON
+
+        async def connect(path):
+            communicator = WebsocketCommunicator(application, path, subprotocols=[subprotocol])
+            started = time.perf_counter()
+            connected, _ = await communicator.connect(timeout=options['timeout'])
+            if not connected:
+                raise CommandError(f'Socket {path.split("?")[0]} was refused.')
+            connect_times.append((time.perf_counter() - started) * 1000)
+            return communicator
+
+        communicators = await asyncio.gather(*(connect(path) for _, _, path in sockets))
+        room_sizes = [0] * len(rooms)
+        for _, room_index, _ in sockets:
+            room_sizes[room_index] += 1
+
+        # text of the message -> time it was sent
+        sent_at = {}
+        latencies = []
+        expected = sum(room_sizes[room_index] for _, room_index, _ in sockets) * options['messages']
+        received = 0
+        # frames refused by the rate limit, their messages are not expected anymore
+        rejected_frames = 0
+        rejected_messages = 0
+        all_received = asyncio.Event()
+
+        async def reader(communicator, room_size):
+            nonlocal received, expected, rejected_frames, rejected_messages
+            while True:
+                try:
+                    frame = await communicator.receive_from(timeout=3600)
+                except (asyncio.TimeoutError, asyncio.CancelledError):
+                    return
+                data = protocol.decode(bytes_data=frame) if isinstance(frame, bytes) else protocol.decode(text_data=frame)
+                now = time.perf_counter()
+                if data.get('type') == 'error' and data.get('code') == 'rate_limited':
+                    rejected_frames += 1
+                    rejected_messages += data['refused']
+                    expected -= data['refused'] * room_size
+                    if received >= expected:
+                        all_received.set()
+                    continue
+                if data.get('type') != 'chat.message' or data.get('text') not in sent_at:
+                    continue
+                latencies.append((now - sent_at[data['text']]) * 1000)
+                received += 1
+                if received >= expected:
+                    all_received.set()
+
+        async def sender(index, communicator):
+            batch = options['batch']
+            interval = batch / options['rate']
+            # spreading the start so all sockets do not send at the same moment
+            await asyncio.sleep(interval * index / len(sockets))
+            next_send = time.perf_counter()
+            for first in range(0, options['messages'], batch):
+                texts = [f'loadtest {index} {number}' for number in range(first, min(first + batch, options['messages']))]
+                now = time.perf_counter()
+                for text in texts:
+                    sent_at[text] = now
+                if batch == 1:
+                    payload = {'text': texts[0]}
+                else:
+                    payload = {'messages': [{'text': text} for text in texts]}
+                await communicator.send_to(**protocol.encode_for(subprotocol, payload))
+                next_send += interval
+                await asyncio.sleep(max(0, next_send - time.perf_counter()))
+
+        counter.reset()
+        readers = [asyncio.create_task(reader(communicator, room_sizes[room_index])) for (_, room_index, _), communicator in zip(sockets, communicators)]
+        started = time.perf_counter()
+        await asyncio.gather(*(sender(index, communicator) for (index, _, _), communicator in zip(sockets, communicators)))
+        send_duration = time.perf_counter() - started
+
+        try:
+            await asyncio.wait_for(all_received.wait(), options['timeout'])
+        except asyncio.TimeoutError:
+            pass
+        duration = time.perf_counter() - started
+
+        for task in readers:
+            task.cancel()
+        await asyncio.gather(*readers, return_exceptions=True)
+        for communicator in communicators:
+            await communicator.disconnect()
+        # write behind mode - queued rows are part of the cost of the messages
+        await batcher.flush()
+
+        sent = len(sent_at)
+        return {
+            'config': run_config(options),
+            'messages': {
+                'sent': sent,
+                'expected_deliveries': expected,
+                'delivered': received,
+                'lost': expected - received,
+                'rate_limited_frames': rejected_frames,
+                'rate_limited_messages': rejected_messages,
+            },
+            'latency_ms': {name: round(value, 3) if value is not None else None for name, value in summarize(latencies).items()},
+            'connect_ms': {name: round(value, 3) if value is not None else None for name, value in summarize(connect_times).items()},
+            'throughput': {
+                'duration_seconds': round(duration, 3),
+                'messages_per_second': round(sent / send_duration, 2) if send_duration else None,
+                'deliveries_per_second': round(received / duration, 2) if duration else None,
+            },
+            'db': {
+                'queries': counter.queries,
+                'writes': counter.writes,
+                'queries_per_message': round(counter.queries / sent, 3) if sent else None,
+                'writes_per_message': round(counter.writes / sent, 3) if sent else None,
+            },
+        }
+
+    def report(self, result):
+        config, messages = result['config'], result['messages']
+        latency, throughput, db = result['latency_ms'], result['throughput'], result['db']
+        self.stdout.write(f"{config['sockets']} sockets in {config['rooms']} rooms, {config['protocol']} frames, {config['layer']} layer, write behind {config['write_behind']}")
+        self.stdout.write(f"sent {messages['sent']}, delivered {messages['delivered']}/{messages['expected_deliveries']}, lost {messages['lost']}, rate limited {messages['rate_limited_messages']}")
+        self.stdout.write(f"latency ms p50 {latency['p50']} p95 {latency['p95']} p99 {latency['p99']} max {latency['max']}")
+        self.stdout.write(f"throughput {throughput['messages_per_second']} msg/s sent, {throughput['deliveries_per_second']} deliveries/s in {throughput['duration_seconds']} s")
+        self.stdout.write(f"db {db['writes_per_message']} writes / {db['queries_per_message']} queries per message")
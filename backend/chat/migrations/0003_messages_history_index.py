@@ -0,0 +1,19 @@
+# Generated by Django 5.2.7 on 2026-10-18 19:14
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0002_alter_messages_created_at'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='messages',
+            index=models.Index(fields=['conversation', 'created_at', 'id'], name='chat_msg_conv_created_id_idx'),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 5.2.7 on 2026-10-18 19:17
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+# conversations created before the pair was stored in a fixed order
+# rows with user1 > user2 are swapped, if the pair also exists in the other order the messages are moved to it
+def canonicalize_pairs(apps, schema_editor):
+    Conversation = apps.get_model('chat', 'Conversation')
+    Messages = apps.get_model('chat', 'Messages')
+
+    for conversation in list(Conversation.objects.filter(user1__gt=models.F('user2'))):
+        existing = Conversation.objects.filter(user1_id=conversation.user2_id, user2_id=conversation.user1_id).first()
+        if existing:
+            Messages.objects.filter(conversation=conversation).update(conversation=existing)
+            conversation.delete()
+        else:
+            conversation.user1_id, conversation.user2_id = conversation.user2_id, conversation.user1_id
+            conversation.save(update_fields=['user1', 'user2'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_messages_history_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        # duplicate conversations are deleted, so their analytics need to be in the state for the cascade
+        ('analytics', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(canonicalize_pairs, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='conversation',
+            unique_together=set(),
+        ),
+        migrations.AddConstraint(
+            model_name='conversation',
+            constraint=models.UniqueConstraint(fields=('user1', 'user2'), name='chat_conversation_unique_pair'),
+        ),
+        migrations.AddConstraint(
+            model_name='conversation',
+            constraint=models.CheckConstraint(condition=models.Q(('user1__lt', models.F('user2'))), name='chat_conversation_ordered_pair'),
+        ),
+    ]
@@ -0,0 +1,68 @@
+# Generated by Django 5.2.7 on 2026-10-18 19:32
+
+import django.db.models.deletion
+import django.utils.timezone
+import uuid
+from django.conf import settings
+from django.db import migrations, models
+
+
+# inbox entries for the conversations which existed before the inbox
+# last message is taken from the history, unread counts start at 0 as read state was never stored
+def backfill_inbox(apps, schema_editor):
+    Conversation = apps.get_model('chat', 'Conversation')
+    Messages = apps.get_model('chat', 'Messages')
+    InboxEntry = apps.get_model('chat', 'InboxEntry')
+
+    latest = Messages.objects.filter(conversation=models.OuterRef('pk')).order_by('-created_at', '-id')
+    conversations = Conversation.objects.select_related('user1', 'user2').annotate(
+        last_text=models.Subquery(latest.values('text')[:1]),
+        last_at=models.Subquery(latest.values('created_at')[:1]),
+    )
+
+    now = django.utils.timezone.now()
+    entries = []
+    for conversation in conversations.iterator(chunk_size=500):
+        for owner, other in ((conversation.user1, conversation.user2), (conversation.user2, conversation.user1)):
+            entries.append(InboxEntry(
+                owner=owner,
+                conversation=conversation,
+                other_user=other,
+                other_user_name=f"{other.first_name} {other.last_name}",
+                last_message_text=conversation.last_text or '',
+                last_activity_at=conversation.last_at or now,
+            ))
+        if len(entries) >= 1000:
+            InboxEntry.objects.bulk_create(entries, ignore_conflicts=True)
+            entries = []
+
+    InboxEntry.objects.bulk_create(entries, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_canonical_conversation_pair'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InboxEntry',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('other_user_name', models.CharField(max_length=511)),
+                ('last_message_text', models.TextField(blank=True, default='')),
+                ('last_activity_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('unread_count', models.PositiveIntegerField(default=0)),
+                ('conversation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='inbox_entries', to='chat.conversation')),
+                ('other_user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='inbox_entries', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['owner', '-last_activity_at', '-id'], name='chat_inbox_owner_activity_idx')],
+                'constraints': [models.UniqueConstraint(fields=('owner', 'conversation'), name='chat_inbox_unique_owner_conversation')],
+            },
+        ),
+        migrations.RunPython(backfill_inbox, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 5.2.7 on 2026-10-18 21:05
+
+from django.db import migrations, models
+
+
+# seq for the messages stored before sequence numbers, in history order (created_at, id) per conversation
+def backfill_seq(apps, schema_editor):
+    Conversation = apps.get_model('chat', 'Conversation')
+    Messages = apps.get_model('chat', 'Messages')
+
+    for conversation_id in Conversation.objects.values_list('id', flat=True).iterator(chunk_size=500):
+        seq = 0
+        updated = []
+        for message in Messages.objects.filter(conversation_id=conversation_id).order_by('created_at', 'id').only('id').iterator(chunk_size=1000):
+            seq += 1
+            message.seq = seq
+            updated.append(message)
+            if len(updated) >= 1000:
+                Messages.objects.bulk_update(updated, ['seq'])
+                updated = []
+        Messages.objects.bulk_update(updated, ['seq'])
+        if seq:
+            Conversation.objects.filter(id=conversation_id).update(last_seq=seq)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_inboxentry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='last_seq',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='messages',
+            name='seq',
+            field=models.PositiveBigIntegerField(blank=True, null=True),
+        ),
+        migrations.RunPython(backfill_seq, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='messages',
+            constraint=models.UniqueConstraint(fields=('conversation', 'seq'), name='chat_msg_unique_conv_seq'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.7 on 2026-10-18 19:42
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_message_seq'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedConversation',
+            fields=[
+                ('conversation', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='archive', serialize=False, to='chat.conversation')),
+                ('payload', models.BinaryField()),
+                ('message_count', models.PositiveIntegerField()),
+                ('first_message_at', models.DateTimeField()),
+                ('last_message_at', models.DateTimeField()),
+                ('raw_size', models.PositiveIntegerField()),
+                ('compressed_size', models.PositiveIntegerField()),
+                ('archived_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='archived_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.2.7 on 2026-10-18 22:10
+
+from django.db import migrations
+
+
+# GIN index for the full text search of chat.search, only on PostgreSQL
+# other databases use the in process index of chat.search, so nothing is created for them
+# same SearchVector expression as chat.search.search_postgres, else the index is not used by the query
+def get_index():
+    from django.contrib.postgres.indexes import GinIndex
+    from django.contrib.postgres.search import SearchVector
+
+    return GinIndex(SearchVector('text', config='english'), name='chat_msg_text_search_idx')
+
+
+def create_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.add_index(apps.get_model('chat', 'Messages'), get_index())
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.remove_index(apps.get_model('chat', 'Messages'), get_index())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_archived_conversation'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
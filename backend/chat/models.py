@@ -1,15 +1,46 @@
 import uuid 
 from django.db import models
+from django.utils import timezone
 from authapp.models import MyUser
 
+# Conversation is stored with its two users in a fixed order (user1 id < user2 id)
+# so a pair of users maps to exactly one row and lookup is a single probe of the unique index
+class ConversationManager(models.Manager):
+    @staticmethod
+    def canonical_pair(user_a_id, user_b_id):
+        return tuple(sorted([uuid.UUID(str(user_a_id)), uuid.UUID(str(user_b_id))]))
+
+    def get_for_pair(self, user_a_id, user_b_id):
+        user1_id, user2_id = self.canonical_pair(user_a_id, user_b_id)
+        return self.filter(user1_id=user1_id, user2_id=user2_id).first()
+
+    # get_or_create retries the lookup when a parallel request inserted the same pair first (IntegrityError)
+    # inbox entries of both users are created along with the conversation
+    def get_or_create_for_pair(self, user_a_id, user_b_id):
+        user1_id, user2_id = self.canonical_pair(user_a_id, user_b_id)
+        conversation, created = self.get_or_create(user1_id=user1_id, user2_id=user2_id)
+        if created:
+            InboxEntry.objects.create_for_conversation(conversation.id, user1_id, user2_id)
+        return conversation, created
+
+
 # Create your models here.
 class Conversation(models.Model):
     id = models.UUIDField(default=uuid.uuid4, primary_key=True, null=False, editable=False)
     user1 = models.ForeignKey(MyUser, on_delete=models.CASCADE, related_name='user1')
     user2 = models.ForeignKey(MyUser, on_delete=models.CASCADE, related_name='user2')
+    # seq of the last stored message, next messages get last_seq + 1, ... (chat.persistence)
+    last_seq = models.PositiveBigIntegerField(default=0)
+    # set while the messages are in ArchivedConversation instead of Messages (chat.archive)
+    archived_at = models.DateTimeField(null=True, blank=True)
+
+    objects = ConversationManager()
 
     class Meta:
-        unique_together = ('user1', 'user2')
+        constraints = [
+            models.UniqueConstraint(fields=['user1', 'user2'], name='chat_conversation_unique_pair'),
+            models.CheckConstraint(condition=models.Q(user1__lt=models.F('user2')), name='chat_conversation_ordered_pair'),
+        ]
 
     def __str__(self):
         return f"Conversation ID : {self.id} between {self.user1_id} and {self.user2_id}"
@@ -21,10 +52,90 @@ class Messages(models.Model):
     conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE)
     sender = models.ForeignKey(MyUser, on_delete=models.CASCADE)
     text = models.TextField()
-    created_at = models.DateTimeField(auto_now_add=True)
+    # set by the consumer when the message is received, so the stored time matches the broadcast time
+    # even when the message is written later in a batch
+    created_at = models.DateTimeField(default=timezone.now)
+    # position of the message in its conversation (1, 2, 3, ...), assigned when it is stored
+    # clients send the last seq they have on reconnect and get only the messages after it (chat.replay)
+    seq = models.PositiveBigIntegerField(null=True, blank=True)
 
     class Meta:
         ordering = ['created_at',]
+        constraints = [
+            models.UniqueConstraint(fields=['conversation', 'seq'], name='chat_msg_unique_conv_seq'),
+        ]
+        indexes = [
+            # history is read newest first per conversation with (created_at, id) as the cursor
+            models.Index(fields=['conversation', 'created_at', 'id'], name='chat_msg_conv_created_id_idx'),
+        ]
+
+    def __str__(self):
+        return "Message ID : {self.id}"
+
+
+class InboxEntryManager(models.Manager):
+    # entry of each of the two users, ignored if they already exist
+    def create_for_conversation(self, conversation_id, user1_id, user2_id, last_activity_at=None):
+        users = {user.id: user for user in MyUser.objects.filter(id__in=[user1_id, user2_id]).only('id', 'first_name', 'last_name')}
+        last_activity_at = last_activity_at or timezone.now()
+
+        entries = [
+            self.model(
+                owner_id=owner_id,
+                conversation_id=conversation_id,
+                other_user_id=other_id,
+                other_user_name=f"{users[other_id].first_name} {users[other_id].last_name}",
+                last_activity_at=last_activity_at,
+            )
+            for owner_id, other_id in ((user1_id, user2_id), (user2_id, user1_id))
+            if owner_id in users and other_id in users
+        ]
+        self.bulk_create(entries, ignore_conflicts=True)
+
+
+# inbox of a user - one row per conversation with the details shown in the conversation list
+# kept up to date when messages are stored (chat.inbox.record_messages), so the list is one
+# indexed query sorted by recent activity, instead of aggregating Messages for every conversation
+class InboxEntry(models.Model):
+    id = models.UUIDField(default=uuid.uuid4, primary_key=True, null=False, editable=False)
+    owner = models.ForeignKey(MyUser, on_delete=models.CASCADE, related_name='inbox_entries')
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='inbox_entries')
+    # other participant and their name, copied so the list needs no join
+    other_user = models.ForeignKey(MyUser, on_delete=models.CASCADE, related_name='+')
+    other_user_name = models.CharField(max_length=511)
+    last_message_text = models.TextField(blank=True, default='')
+    last_activity_at = models.DateTimeField(default=timezone.now)
+    # messages of the other user not read by the owner yet
+    unread_count = models.PositiveIntegerField(default=0)
+
+    objects = InboxEntryManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['owner', 'conversation'], name='chat_inbox_unique_owner_conversation'),
+        ]
+        indexes = [
+            # inbox is read most recent first per owner with (last_activity_at, id) as the cursor
+            models.Index(fields=['owner', '-last_activity_at', '-id'], name='chat_inbox_owner_activity_idx'),
+        ]
+
+    def __str__(self):
+        return f"Inbox of {self.owner_id} for conversation {self.conversation_id}"
+
+
+# messages of an idle conversation moved out of Messages (chat.archive.archive_conversation)
+# payload is the zstd compressed msgpack of the message rows, they are put back in Messages
+# with the same ids and seq when the conversation is opened again
+class ArchivedConversation(models.Model):
+    conversation = models.OneToOneField(Conversation, on_delete=models.CASCADE, primary_key=True, related_name='archive')
+    payload = models.BinaryField()
+    message_count = models.PositiveIntegerField()
+    first_message_at = models.DateTimeField()
+    last_message_at = models.DateTimeField()
+    # bytes before / after compression
+    raw_size = models.PositiveIntegerField()
+    compressed_size = models.PositiveIntegerField()
+    archived_at = models.DateTimeField(default=timezone.now)
 
     def __str__(self):
-        return "Message ID : {self.id}"
\ No newline at end of file
+        return f"Archive of conversation {self.conversation_id} ({self.message_count} messages)"
@@ -0,0 +1,50 @@
+# keyset (cursor) pagination helpers
+# cursor is an opaque string with the sort values of the last row of the page,
+# next page continues after it using an indexed range condition instead of OFFSET
+
+import json
+import base64
+from datetime import datetime
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+def encode_cursor(created_at, row_id):
+    raw = json.dumps([created_at.isoformat(), str(row_id)])
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+# returns (created_at, id) stored in the cursor
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode('ascii'))
+        created_at, row_id = json.loads(raw)
+        return datetime.fromisoformat(created_at), row_id
+    except (ValueError, TypeError, UnicodeError):
+        raise InvalidCursor("Invalid cursor")
+
+
+# search results are sorted by rank first, cursor keeps (rank, created_at, id)
+def encode_ranked_cursor(rank, created_at, row_id):
+    raw = json.dumps([rank, created_at.isoformat(), str(row_id)])
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def decode_ranked_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode('ascii'))
+        rank, created_at, row_id = json.loads(raw)
+        return float(rank), datetime.fromisoformat(created_at), row_id
+    except (ValueError, TypeError, UnicodeError):
+        raise InvalidCursor("Invalid cursor")
+
+
+# reading the page size from the query params, falling back to default and capping it
+def get_page_size(request, default, maximum):
+    try:
+        limit = int(request.query_params.get('limit', default))
+    except ValueError:
+        return default
+    return max(1, min(limit, maximum))
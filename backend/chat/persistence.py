@@ -0,0 +1,189 @@
+# storing chat messages in the DB
+# write through (default) - ChatConsumer inserts every message before broadcasting it
+# write behind (CHAT_WRITE_BEHIND = True) - message is broadcast first and queued,
+# MessageBatcher then inserts the queued messages in batches with bulk_create
+
+import uuid
+import atexit
+import asyncio
+from collections import defaultdict
+from django.conf import settings
+from django.db import transaction, IntegrityError, DatabaseError
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from .models import Conversation, Messages
+from .inbox import record_messages
+from .replay import recent_messages
+from . import search
+from .protocol import encode_frames
+
+
+WRITE_BEHIND = getattr(settings, 'CHAT_WRITE_BEHIND', False)
+BATCH_SIZE = getattr(settings, 'CHAT_WRITE_BEHIND_BATCH_SIZE', 100)
+FLUSH_INTERVAL = getattr(settings, 'CHAT_WRITE_BEHIND_FLUSH_INTERVAL', 0.5)
+# when the queue is full, consumers wait in add() until the DB catches up (backpressure)
+QUEUE_SIZE = getattr(settings, 'CHAT_WRITE_BEHIND_QUEUE_SIZE', 1000)
+# a batch failing with a DB error (lost connection, deadlock, ...) is tried this many times, waiting longer each time
+STORE_ATTEMPTS = getattr(settings, 'CHAT_WRITE_BEHIND_STORE_ATTEMPTS', 4)
+RETRY_BACKOFF_SECONDS = getattr(settings, 'CHAT_WRITE_BEHIND_RETRY_BACKOFF_SECONDS', 0.5)
+
+
+# per conversation sequence numbers of the rows, continuing from Conversation.last_seq
+# conversation rows are locked until the end of the transaction, so two workers storing messages
+# of the same conversation get consecutive numbers (one SELECT ... FOR UPDATE + one UPDATE per conversation)
+def assign_sequence_numbers(rows):
+    conversation_ids = sorted({str(row['conversation_id']) for row in rows})
+    last_seqs = dict(
+        (str(conversation_id), last_seq)
+        for conversation_id, last_seq in Conversation.objects.select_for_update()
+        .filter(id__in=conversation_ids).order_by('id').values_list('id', 'last_seq')
+    )
+
+    for row in sorted(rows, key=lambda row: row['created_at']):
+        conversation_id = str(row['conversation_id'])
+        if conversation_id in last_seqs:
+            last_seqs[conversation_id] += 1
+            row['seq'] = last_seqs[conversation_id]
+
+    for conversation_id, last_seq in last_seqs.items():
+        Conversation.objects.filter(id=conversation_id).update(last_seq=last_seq)
+
+
+# rows are dicts with the Messages fields (conversation_id, sender_id, text, created_at and optionally id)
+# id and seq are set on the rows, inbox entries of the conversations are updated in the same transaction
+# returns the stored rows
+def store_messages(rows):
+    for row in rows:
+        row.setdefault('id', uuid.uuid4())
+
+    try:
+        with transaction.atomic():
+            assign_sequence_numbers(rows)
+            Messages.objects.bulk_create([Messages(**row) for row in rows])
+            record_messages(rows)
+        stored = rows
+    except IntegrityError:
+        # some row points to a missing conversation / user, insert one by one so only that row is dropped
+        stored = []
+        for row in rows:
+            row.pop('seq', None)
+            try:
+                with transaction.atomic():
+                    assign_sequence_numbers([row])
+                    Messages.objects.create(**row)
+                    record_messages([row])
+                stored.append(row)
+            except IntegrityError as e:
+                row.pop('seq', None)
+                print(f"Could not save message of conversation {row.get('conversation_id')}: {e}")
+
+    recent_messages.add(stored)
+    search.index_messages(stored)
+    return stored
+
+
+class MessageBatcher:
+    def __init__(self, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL, queue_size=QUEUE_SIZE):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue_size = queue_size
+        self._loop = None
+
+    # queue, events and the worker task belong to the event loop they were created in
+    def _ensure_started(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is loop:
+            return
+
+        self._loop = loop
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._batch_ready = asyncio.Event()
+        self._write_lock = asyncio.Lock()
+        self._worker = loop.create_task(self._run())
+
+    async def add(self, row):
+        self._ensure_started()
+        await self._queue.put(row)
+        if self._queue.qsize() >= self.batch_size:
+            self._batch_ready.set()
+
+    # writes after every flush_interval or as soon as a full batch is queued
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._batch_ready.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._batch_ready.clear()
+
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"An unexpected error occurred while saving messages: {e}")
+
+    # writes everything queued so far, used on disconnect so the messages of that socket are saved
+    async def flush(self):
+        if self._loop is None:
+            return
+
+        async with self._write_lock:
+            while not self._queue.empty():
+                batch = [self._queue.get_nowait() for _ in range(min(self.batch_size, self._queue.qsize()))]
+                stored = await self._store(batch)
+                if stored:
+                    await self._announce(stored)
+
+    # IntegrityError only drops the bad rows (store_messages), other DB errors fail the whole batch so it is retried
+    # messages of a batch which keeps failing are lost, their ids are logged
+    async def _store(self, batch):
+        error = None
+        for attempt in range(STORE_ATTEMPTS):
+            if attempt:
+                await asyncio.sleep(RETRY_BACKOFF_SECONDS * 2 ** (attempt - 1))
+            try:
+                return await database_sync_to_async(store_messages)(batch)
+            except DatabaseError as e:
+                error = e
+                print(f"Saving {len(batch)} messages failed (attempt {attempt + 1} of {STORE_ATTEMPTS}): {e}")
+            except Exception as e:
+                error = e
+                break
+
+        message_ids = ', '.join(str(row.get('id')) for row in batch)
+        print(f"Could not save {len(batch)} messages, lost message ids: {message_ids}: {error}")
+        return []
+
+    # messages were broadcast without seq, sockets of the conversation get their seq now
+    # with one chat.sync frame per conversation of the batch
+    async def _announce(self, rows):
+        # consumers imports this module
+        from .consumers import get_group_name
+
+        channel_layer = get_channel_layer()
+        if channel_layer is None:
+            return
+
+        by_conversation = defaultdict(list)
+        for row in rows:
+            by_conversation[str(row['conversation_id'])].append({'id': str(row['id']), 'seq': row['seq']})
+
+        for conversation_id, messages in by_conversation.items():
+            await channel_layer.group_send(get_group_name(conversation_id), {
+                'type': 'chat_sync',
+                'frames': encode_frames({'type': 'chat.sync', 'conversation_id': conversation_id, 'messages': messages}),
+            })
+
+    # on process exit the event loop is already gone, so remaining messages are written synchronously
+    def flush_sync(self):
+        if self._loop is None:
+            return
+
+        batch = []
+        while not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        if batch:
+            store_messages(batch)
+
+
+batcher = MessageBatcher()
+atexit.register(batcher.flush_sync)
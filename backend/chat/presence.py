@@ -0,0 +1,278 @@
+# representative presence and load tracking used to assign new customers
+# a representative is available while they have at least one socket open (ChatConsumer connect / disconnect)
+# load = number of active conversations of the representative, archived ones (chat.archive) are not counted
+# it is counted from the DB when the representative comes online and then kept by the changes made
+# meanwhile (+1 assigned / restored, -1 archived), the store forgets it when their last socket closes
+# new customer goes to the available representative with the least load
+#
+# CHAT_PRESENCE_BACKEND = 'memory' keeps it in this process (single worker / dev)
+# CHAT_PRESENCE_BACKEND = 'redis' shares it between all workers using sorted sets
+
+import math
+import time
+import heapq
+import itertools
+import threading
+from django.conf import settings
+from django.db.models import Q, Count
+from authapp.models import MyUser
+from .models import Conversation
+
+
+PRESENCE_BACKEND = getattr(settings, 'CHAT_PRESENCE_BACKEND', 'memory')
+PRESENCE_REDIS_URL = getattr(settings, 'CHAT_PRESENCE_REDIS_URL', 'redis://127.0.0.1:6379/0')
+# redis store - a connection not refreshed for this many seconds (worker crashed) no longer counts,
+# every worker refreshes its connections every PRESENCE_HEARTBEAT_SECONDS
+PRESENCE_CONNECTION_TTL = getattr(settings, 'CHAT_PRESENCE_CONNECTION_TTL', 60)
+PRESENCE_HEARTBEAT_SECONDS = getattr(settings, 'CHAT_PRESENCE_HEARTBEAT_SECONDS', 20)
+
+
+class InMemoryPresenceStore:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # representative id -> ids of their open connections
+        self._connections = {}
+        self._load = {}
+        # heap of (load, counter, representative_id) for available representatives
+        # entries are not removed on change, stale ones are skipped when popped (lazy deletion)
+        self._heap = []
+        self._counter = itertools.count()
+
+    def _push(self, representative_id):
+        heapq.heappush(self._heap, (self._load[representative_id], next(self._counter), representative_id))
+
+    def has_load(self, representative_id):
+        with self._lock:
+            return representative_id in self._load
+
+    def set_load(self, representative_id, load):
+        with self._lock:
+            self._load[representative_id] = load
+            if self._connections.get(representative_id):
+                self._push(representative_id)
+
+    def connected(self, representative_id, connection_id):
+        with self._lock:
+            self._connections.setdefault(representative_id, set()).add(connection_id)
+            self._load.setdefault(representative_id, 0)
+            self._push(representative_id)
+
+    def disconnected(self, representative_id, connection_id):
+        with self._lock:
+            connections = self._connections.get(representative_id)
+            if connections is None:
+                return
+            connections.discard(connection_id)
+            if not connections:
+                del self._connections[representative_id]
+                self._load.pop(representative_id, None)
+
+    # load of a representative who is not tracked is left alone, it is counted when they connect
+    def change_load(self, representative_id, change):
+        with self._lock:
+            if representative_id not in self._load:
+                return
+            self._load[representative_id] = max(0, self._load[representative_id] + change)
+            if self._connections.get(representative_id):
+                self._push(representative_id)
+
+    def least_loaded(self):
+        with self._lock:
+            while self._heap:
+                load, _, representative_id = self._heap[0]
+                if self._connections.get(representative_id) and self._load.get(representative_id) == load:
+                    return representative_id
+                heapq.heappop(self._heap)
+            return None
+
+
+# every connection of a representative is a member of their connections sorted set scored by the time it expires
+# (a per connection key with a TTL, kept in one set so it can be counted), the worker holding the socket
+# pushes the expiry forward every PRESENCE_HEARTBEAT_SECONDS, so connections of a crashed worker run out
+# changes touching more than one key are Lua scripts, so they are atomic between workers
+# (the scripts build the connection keys themselves, fine for a single redis, not for redis cluster)
+class RedisPresenceStore:
+    CONNECTIONS_KEY_PREFIX = 'chat:presence:connections:'
+    LOAD_KEY = 'chat:presence:load'
+    # sorted set of available representatives scored by load
+    AVAILABLE_KEY = 'chat:presence:available'
+
+    # KEYS connections, load, available - ARGV representative, connection, expires at, ttl
+    CONNECT_SCRIPT = """
+        redis.call('ZADD', KEYS[1], ARGV[3], ARGV[2])
+        redis.call('EXPIRE', KEYS[1], ARGV[4])
+        redis.call('HSETNX', KEYS[2], ARGV[1], 0)
+        redis.call('ZADD', KEYS[3], redis.call('HGET', KEYS[2], ARGV[1]), ARGV[1])
+    """
+    # KEYS connections, load, available - ARGV representative, connection, now
+    DISCONNECT_SCRIPT = """
+        redis.call('ZREM', KEYS[1], ARGV[2])
+        redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[3])
+        if redis.call('ZCARD', KEYS[1]) == 0 then
+            redis.call('DEL', KEYS[1])
+            redis.call('HDEL', KEYS[2], ARGV[1])
+            redis.call('ZREM', KEYS[3], ARGV[1])
+        end
+    """
+    # KEYS load, available - ARGV representative, change
+    CHANGE_LOAD_SCRIPT = """
+        local load = redis.call('HGET', KEYS[1], ARGV[1])
+        if not load then
+            return false
+        end
+        load = math.max(0, tonumber(load) + tonumber(ARGV[2]))
+        redis.call('HSET', KEYS[1], ARGV[1], load)
+        if redis.call('ZSCORE', KEYS[2], ARGV[1]) then
+            redis.call('ZADD', KEYS[2], load, ARGV[1])
+        end
+        return load
+    """
+    # KEYS available - ARGV now, connections key prefix
+    # representatives whose connections all expired are dropped on the way
+    LEAST_LOADED_SCRIPT = """
+        while true do
+            local first = redis.call('ZRANGE', KEYS[1], 0, 0)
+            if #first == 0 then
+                return false
+            end
+            local connections = ARGV[2] .. first[1]
+            redis.call('ZREMRANGEBYSCORE', connections, '-inf', ARGV[1])
+            if redis.call('ZCARD', connections) > 0 then
+                return first[1]
+            end
+            redis.call('ZREM', KEYS[1], first[1])
+        end
+    """
+
+    def __init__(self, url):
+        import redis
+        self._redis = redis.Redis.from_url(url, decode_responses=True)
+        self._connect = self._redis.register_script(self.CONNECT_SCRIPT)
+        self._disconnect = self._redis.register_script(self.DISCONNECT_SCRIPT)
+        self._change_load = self._redis.register_script(self.CHANGE_LOAD_SCRIPT)
+        self._least_loaded = self._redis.register_script(self.LEAST_LOADED_SCRIPT)
+        # connections of this worker, connection id -> representative id, refreshed by the heartbeat
+        # lock is held across a heartbeat, so a connection closed meanwhile is not refreshed again
+        self._lock = threading.Lock()
+        self._local = {}
+        self._heartbeat = None
+
+    def _connections_key(self, representative_id):
+        return self.CONNECTIONS_KEY_PREFIX + representative_id
+
+    def _refresh(self, representative_id, connection_id, client=None):
+        self._connect(
+            keys=[self._connections_key(representative_id), self.LOAD_KEY, self.AVAILABLE_KEY],
+            args=[representative_id, connection_id, time.time() + PRESENCE_CONNECTION_TTL, math.ceil(PRESENCE_CONNECTION_TTL)],
+            client=client,
+        )
+
+    def has_load(self, representative_id):
+        return self._redis.hexists(self.LOAD_KEY, representative_id)
+
+    def set_load(self, representative_id, load):
+        self._redis.hset(self.LOAD_KEY, representative_id, load)
+        # XX - only updates the score if the representative is available
+        self._redis.zadd(self.AVAILABLE_KEY, {representative_id: load}, xx=True)
+
+    def connected(self, representative_id, connection_id):
+        with self._lock:
+            self._local[connection_id] = representative_id
+            self._refresh(representative_id, connection_id)
+            if self._heartbeat is None:
+                self._heartbeat = threading.Thread(target=self._beat, name='chat-presence-heartbeat', daemon=True)
+                self._heartbeat.start()
+
+    def disconnected(self, representative_id, connection_id):
+        with self._lock:
+            self._local.pop(connection_id, None)
+            self._disconnect(
+                keys=[self._connections_key(representative_id), self.LOAD_KEY, self.AVAILABLE_KEY],
+                args=[representative_id, connection_id, time.time()],
+            )
+
+    def change_load(self, representative_id, change):
+        self._change_load(keys=[self.LOAD_KEY, self.AVAILABLE_KEY], args=[representative_id, change])
+
+    def least_loaded(self):
+        return self._least_loaded(keys=[self.AVAILABLE_KEY], args=[time.time(), self.CONNECTIONS_KEY_PREFIX])
+
+    # refreshes the expiry of every connection of this worker (and puts the representative back in
+    # the available set if it was dropped meanwhile) in one round trip
+    def _beat(self):
+        while True:
+            time.sleep(PRESENCE_HEARTBEAT_SECONDS)
+            with self._lock:
+                if not self._local:
+                    continue
+                try:
+                    pipe = self._redis.pipeline(transaction=False)
+                    for connection_id, representative_id in self._local.items():
+                        self._refresh(representative_id, connection_id, client=pipe)
+                    pipe.execute()
+                except Exception as e:
+                    print(f"Could not refresh the presence of {len(self._local)} connections: {e}")
+
+
+def _create_store():
+    if PRESENCE_BACKEND == 'redis':
+        return RedisPresenceStore(PRESENCE_REDIS_URL)
+    return InMemoryPresenceStore()
+
+
+store = _create_store()
+
+
+# number of active conversations of the representative from the DB, used when the store does not know it yet
+def _count_conversations(representative_id):
+    return Conversation.objects.filter(
+        Q(user1_id=representative_id) | Q(user2_id=representative_id),
+        archived_at__isnull=True
+    ).count()
+
+
+# connection_id identifies the socket (its channel name), a representative is available while any of them is open
+def representative_connected(representative_id, connection_id):
+    representative_id = str(representative_id)
+    if not store.has_load(representative_id):
+        store.set_load(representative_id, _count_conversations(representative_id))
+    store.connected(representative_id, connection_id)
+
+
+def representative_disconnected(representative_id, connection_id):
+    store.disconnected(str(representative_id), connection_id)
+
+
+# new conversation or an archived one restored
+def conversation_assigned(representative_id):
+    store.change_load(str(representative_id), 1)
+
+
+# conversation archived
+def conversation_released(representative_id):
+    store.change_load(str(representative_id), -1)
+
+
+# id of the available representative with the least active conversations, None when nobody is online
+def pick_representative():
+    return store.least_loaded()
+
+
+# representative for a new customer
+# least loaded online representative, if nobody is online the least loaded one from the DB
+def choose_representative():
+    representative_id = pick_representative()
+    if representative_id:
+        representative = MyUser.objects.filter(id=representative_id, user_type='representative', is_active=True).first()
+        if representative:
+            return representative
+
+    return (
+        MyUser.objects.filter(user_type='representative', is_active=True)
+        .annotate(load=(
+            Count('user1', filter=Q(user1__archived_at__isnull=True), distinct=True) +
+            Count('user2', filter=Q(user2__archived_at__isnull=True), distinct=True)
+        ))
+        .order_by('load')
+        .first()
+    )
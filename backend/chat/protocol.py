@@ -0,0 +1,62 @@
+# frame encoding of the chat socket
+# client picks the format with the websocket subprotocol (Sec-WebSocket-Protocol header)
+# chat.json - JSON text frames (also used when the client asks for no subprotocol, e.g. the current frontend)
+# chat.msgpack - msgpack binary frames
+# a broadcast is encoded once per group_send in both formats, every socket only picks its format
+
+import orjson
+import msgpack
+
+
+JSON = 'chat.json'
+MSGPACK = 'chat.msgpack'
+SUBPROTOCOLS = (JSON, MSGPACK)
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+# first subprotocol asked by the client which the server supports, None = plain JSON without subprotocol
+def negotiate(requested):
+    for subprotocol in requested or []:
+        if subprotocol in SUBPROTOCOLS:
+            return subprotocol
+    return None
+
+
+# encoded frames of a payload for every format, put in the group event as they are
+def encode_frames(payload):
+    return {
+        'text': orjson.dumps(payload).decode('utf-8'),
+        'bytes': msgpack.packb(payload, use_bin_type=True),
+    }
+
+
+# dict received from the client, JSON text frames are accepted with any subprotocol
+def decode(text_data=None, bytes_data=None):
+    try:
+        if bytes_data is not None:
+            payload = msgpack.unpackb(bytes_data, raw=False)
+        else:
+            payload = orjson.loads(text_data or '')
+    except (orjson.JSONDecodeError, ValueError, msgpack.ExtraData, msgpack.FormatError, msgpack.StackError) as e:
+        raise ProtocolError(f'Invalid frame: {e}')
+
+    if not isinstance(payload, dict):
+        raise ProtocolError('Frame must be an object.')
+    return payload
+
+
+# send() arguments for a socket using the subprotocol
+def frame_for(subprotocol, frames):
+    if subprotocol == MSGPACK:
+        return {'bytes_data': frames['bytes']}
+    return {'text_data': frames['text']}
+
+
+# same for a payload sent to a single socket, only its own format is encoded
+def encode_for(subprotocol, payload):
+    if subprotocol == MSGPACK:
+        return {'bytes_data': msgpack.packb(payload, use_bin_type=True)}
+    return {'text_data': orjson.dumps(payload).decode('utf-8')}
@@ -0,0 +1,85 @@
+# token bucket rate limits of the chat messages
+# every socket has its own bucket and all sockets of a user share one more, a message needs a token from both
+# user buckets are kept in this worker, with several workers the user limit applies per worker
+
+import time
+import threading
+from cachetools import TTLCache
+from django.conf import settings
+
+
+# messages per second and burst size, None = no limit
+SOCKET_RATE = getattr(settings, 'CHAT_RATE_LIMIT_SOCKET_RATE', 5)
+SOCKET_BURST = getattr(settings, 'CHAT_RATE_LIMIT_SOCKET_BURST', 20)
+USER_RATE = getattr(settings, 'CHAT_RATE_LIMIT_USER_RATE', 10)
+USER_BURST = getattr(settings, 'CHAT_RATE_LIMIT_USER_BURST', 40)
+# messages allowed in one batched frame, a batch bigger than a bucket could never be accepted
+# with no batch setting and both limits off, batches are still capped at DEFAULT_MAX_BATCH_MESSAGES
+DEFAULT_MAX_BATCH_MESSAGES = 20
+MAX_BATCH_MESSAGES = min(
+    (
+        limit for limit in (
+            getattr(settings, 'CHAT_MAX_BATCH_MESSAGES', DEFAULT_MAX_BATCH_MESSAGES),
+            SOCKET_BURST if SOCKET_RATE else None,
+            USER_BURST if USER_RATE else None,
+        ) if limit
+    ),
+    default=DEFAULT_MAX_BATCH_MESSAGES,
+)
+
+
+# timer returns the current time in seconds (like the timer of cachetools caches)
+class TokenBucket:
+    def __init__(self, rate, capacity, timer=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self._timer = timer
+        self.updated = timer()
+
+    def _refill(self):
+        now = self._timer()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # seconds until count tokens are available, 0 = available now
+    def wait_time(self, count=1):
+        self._refill()
+        if self.tokens >= count:
+            return 0
+        return (count - self.tokens) / self.rate
+
+    def take(self, count=1):
+        self.tokens -= count
+
+
+_user_buckets = TTLCache(maxsize=10000, ttl=600)
+_user_lock = threading.Lock()
+
+
+def socket_bucket():
+    return TokenBucket(SOCKET_RATE, SOCKET_BURST) if SOCKET_RATE else None
+
+
+def user_bucket(user_id):
+    if not USER_RATE:
+        return None
+
+    with _user_lock:
+        bucket = _user_buckets.get(user_id)
+        if bucket is None:
+            bucket = _user_buckets[user_id] = TokenBucket(USER_RATE, USER_BURST)
+        return bucket
+
+
+# takes count tokens from every bucket (None buckets are skipped) or from none of them
+# returns 0 when allowed, else seconds to wait before trying again
+def acquire(buckets, count=1):
+    buckets = [bucket for bucket in buckets if bucket is not None]
+    with _user_lock:
+        wait = max([bucket.wait_time(count) for bucket in buckets], default=0)
+        if wait:
+            return wait
+        for bucket in buckets:
+            bucket.take(count)
+    return 0
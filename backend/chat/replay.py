@@ -0,0 +1,117 @@
+# resuming a chat socket after a reconnect
+# every stored message has a per conversation sequence number (Messages.seq, assigned in chat.persistence)
+# client connects with ?last_seq=<last seq it has> and gets only the messages after it,
+# from the recent messages kept in this worker or from the DB when the buffer does not cover the gap
+
+from collections import OrderedDict
+from threading import Lock
+from django.conf import settings
+from channels.db import database_sync_to_async
+from .models import Conversation, Messages
+from . import protocol
+
+
+# recent messages kept per conversation and number of conversations kept (least recently used are dropped)
+BUFFER_SIZE = getattr(settings, 'CHAT_REPLAY_BUFFER_SIZE', 100)
+BUFFER_CONVERSATIONS = getattr(settings, 'CHAT_REPLAY_BUFFER_CONVERSATIONS', 1000)
+# larger gaps are not replayed, client is told to reload the history instead
+MAX_REPLAY_MESSAGES = getattr(settings, 'CHAT_REPLAY_MAX_MESSAGES', 500)
+
+
+# chat.message frame payload of a stored / queued message row
+def build_message(row):
+    return {
+        # lot of data might we passing through websockets
+        # data like notification, alert, typing, etc data can be present in the websocket connection
+        # the purpose of this is what kind of message it just received so frontend knows how to handle it.
+        # without type label - frontend would receive blob of data and have no idea what it is or what to do with it
+        # format of the value for this key - can be anything, but a good pratice is to use namespace.action format
+        # eg.'chat.message'	A standard message sent by a user in a chat.
+        # 'user.typing.start'	A notification that a user has started typing.
+        # 'user.typing.stop'	A notification that a user has stopped typing.
+        'type': 'chat.message',
+
+        # actual data to send
+        'id': str(row['id']),
+        # None until the message is stored (write behind), a chat.sync frame gives it later
+        'seq': row.get('seq'),
+        'conversation_id': str(row['conversation_id']),
+        'sender': str(row['sender_id']),
+        'text': row['text'],
+        'timestamp': row['created_at'].isoformat()
+    }
+
+
+class RecentMessages:
+    def __init__(self, size=BUFFER_SIZE, conversations=BUFFER_CONVERSATIONS):
+        self.size = size
+        self.conversations = conversations
+        self._lock = Lock()
+        # conversation id -> OrderedDict seq -> encoded frames
+        self._buffers = OrderedDict()
+
+    # rows with their seq, in any order
+    def add(self, rows):
+        with self._lock:
+            for row in rows:
+                if row.get('seq') is None:
+                    continue
+                conversation_id = str(row['conversation_id'])
+                buffer = self._buffers.get(conversation_id)
+                if buffer is None:
+                    buffer = self._buffers[conversation_id] = OrderedDict()
+                    if len(self._buffers) > self.conversations:
+                        self._buffers.popitem(last=False)
+                self._buffers.move_to_end(conversation_id)
+
+                buffer[row['seq']] = protocol.encode_frames(build_message(row))
+                while len(buffer) > self.size:
+                    buffer.popitem(last=False)
+
+    # frames of seq after_seq + 1 .. upto_seq, None if any of them is missing
+    def get_range(self, conversation_id, after_seq, upto_seq):
+        with self._lock:
+            buffer = self._buffers.get(str(conversation_id))
+            if buffer is None:
+                return None
+            frames = [buffer.get(seq) for seq in range(after_seq + 1, upto_seq + 1)]
+        if any(frame is None for frame in frames):
+            return None
+        return frames
+
+    def clear(self):
+        with self._lock:
+            self._buffers.clear()
+
+
+recent_messages = RecentMessages()
+
+
+@database_sync_to_async
+def get_last_seq(conversation_id):
+    return Conversation.objects.filter(id=conversation_id).values_list('last_seq', flat=True).first() or 0
+
+
+@database_sync_to_async
+def load_gap(conversation_id, after_seq, upto_seq):
+    rows = (
+        Messages.objects.filter(conversation_id=conversation_id, seq__gt=after_seq, seq__lte=upto_seq)
+        .order_by('seq')
+        .values('id', 'seq', 'conversation_id', 'sender_id', 'text', 'created_at')
+    )
+    return [protocol.encode_frames(build_message(row)) for row in rows]
+
+
+# frames of the messages the client missed, None when the gap is too large to replay
+# must be called after the socket joined the group, anything stored later arrives as a normal message
+async def get_missed_frames(conversation_id, after_seq):
+    upto_seq = await get_last_seq(conversation_id)
+    if upto_seq <= after_seq:
+        return [], upto_seq
+    if upto_seq - after_seq > MAX_REPLAY_MESSAGES:
+        return None, upto_seq
+
+    frames = recent_messages.get_range(conversation_id, after_seq, upto_seq)
+    if frames is None:
+        frames = await load_gap(conversation_id, after_seq, upto_seq)
+    return frames, upto_seq
@@ -5,4 +5,6 @@ websocket_urlpatterns = [
     # capture request using regex
     # here it captures the room id (which is the conversation_id)between an customer and representative
     re_path(r"ws/chat/(?P<room_name>[\w-]+)/$", consumers.ChatConsumer.as_asgi()),
+    # one socket for many conversations, subscribed with frames
+    re_path(r"ws/chat/$", consumers.MultiplexChatConsumer.as_asgi()),
 ]
\ No newline at end of file
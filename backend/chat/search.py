@@ -0,0 +1,247 @@
+# full text search over the chat messages
+# postgres - GIN index on to_tsvector(text) (migration 0008), matched with websearch_to_tsquery and
+# ranked with ts_rank, the query uses the same SearchVector expression as the index so the index is used
+# other DBs (sqlite in development / tests) - InvertedIndex kept in this process, built from Messages
+# on the first search and updated by chat.persistence / chat.archive as messages are stored / moved
+
+import math
+import re
+import threading
+from collections import defaultdict
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q, FloatField
+from django.db.models.functions import Cast
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+from .models import Conversation, Messages
+
+
+# text search config of the GIN index, the index has to be created again when it changes
+SEARCH_CONFIG = 'english'
+# 'postgres' / 'memory', None = postgres on PostgreSQL and memory on anything else
+BACKEND = getattr(settings, 'CHAT_SEARCH_BACKEND', None)
+
+RESULT_FIELDS = ('id', 'conversation_id', 'sender_id', 'text', 'created_at', 'seq')
+
+
+def get_backend():
+    return BACKEND or ('postgres' if connection.vendor == 'postgresql' else 'memory')
+
+
+# conversations the user can search - their own ones, every conversation for staff (supervisors)
+# participant narrows it to the conversations of that user, None = no restriction
+def get_searchable_conversations(user, participant_id=None):
+    if user.is_staff and participant_id is None:
+        return None
+
+    conversations = Conversation.objects.all()
+    if not user.is_staff:
+        conversations = conversations.filter(Q(user1_id=user.id) | Q(user2_id=user.id))
+    if participant_id is not None:
+        conversations = conversations.filter(Q(user1_id=participant_id) | Q(user2_id=participant_id))
+    return conversations.values('id')
+
+
+# one page of messages matching the text, best rank first (newest first between equal ranks)
+# date_from inclusive, date_to exclusive, after = (rank, created_at, id) of the last result of the previous page
+# returns (rows with their rank, has_more)
+def search_messages(text, conversations=None, date_from=None, date_to=None, after=None, limit=20):
+    if get_backend() == 'postgres':
+        rows = search_postgres(text, conversations, date_from, date_to, after, limit + 1)
+    else:
+        rows = search_memory(text, conversations, date_from, date_to, after, limit + 1)
+    return rows[:limit], len(rows) > limit
+
+
+def search_postgres(text, conversations, date_from, date_to, after, limit):
+    query = SearchQuery(text, search_type='websearch', config=SEARCH_CONFIG)
+    vector = SearchVector('text', config=SEARCH_CONFIG)
+
+    messages = Messages.objects.annotate(document=vector).filter(document=query)
+    if conversations is not None:
+        messages = messages.filter(conversation_id__in=conversations)
+    if date_from:
+        messages = messages.filter(created_at__gte=date_from)
+    if date_to:
+        messages = messages.filter(created_at__lt=date_to)
+
+    # ts_rank is a real, read as a rounded float it would not compare equal to itself on the next page
+    # (the cursor would skip or repeat the rows of its rank), as double precision it round trips exactly
+    messages = messages.annotate(rank=Cast(SearchRank(vector, query), FloatField()))
+    if after:
+        rank, created_at, message_id = after
+        messages = messages.filter(
+            Q(rank__lt=rank) |
+            Q(rank=rank, created_at__lt=created_at) |
+            Q(rank=rank, created_at=created_at, id__lt=message_id)
+        )
+
+    return list(messages.order_by('-rank', '-created_at', '-id').values(*RESULT_FIELDS, 'rank')[:limit])
+
+
+def search_memory(text, conversations, date_from, date_to, after, limit):
+    conversation_ids = None
+    if conversations is not None:
+        conversation_ids = {str(conversation_id) for conversation_id in conversations.values_list('id', flat=True)}
+
+    index.ensure_built()
+    hits = index.search(text, conversation_ids, date_from, date_to, after, limit)
+
+    # rows are read from the DB, ones deleted meanwhile are left out
+    rows = {str(row['id']): row for row in Messages.objects.filter(id__in=[message_id for _, _, message_id in hits]).values(*RESULT_FIELDS)}
+    return [{**rows[message_id], 'rank': rank} for rank, _, message_id in hits if message_id in rows]
+
+
+# words which carry no meaning for search, dropped like the english config of postgres does
+STOP_WORDS = frozenset(
+    'a an and are as at be but by for from has have he her his i if in into is it its me my no not of on or our '
+    'she so than that the their them then there these they this to was we were what when where which who whom why '
+    'will with you your about after before can could did do does had how just more most only other over same some '
+    'such too very would'.split()
+)
+WORD = re.compile(r'\w+')
+
+
+# lowercase words without stop words, plural s removed (loans -> loan)
+def tokenize(text):
+    terms = []
+    for word in WORD.findall(text.lower()):
+        if word in STOP_WORDS:
+            continue
+        if len(word) > 3 and word.endswith('s') and not word.endswith('ss'):
+            word = word[:-1]
+        terms.append(word)
+    return terms
+
+
+# terms every message must have and terms none may have ("-word"), like websearch_to_tsquery without OR / phrases
+def parse_query(text):
+    required, excluded = set(), set()
+    for word in text.split():
+        target = excluded if word.startswith('-') else required
+        target.update(tokenize(word))
+    return required, excluded - required
+
+
+# inverted index of the messages of this process - term -> {message id: term frequency}, ids kept as str
+# only meant for databases without full text search (sqlite), memory grows with the number of messages
+class InvertedIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._postings = defaultdict(dict)
+        # message id -> (conversation id, created_at, {term: frequency}, length)
+        self._documents = {}
+        self._total_length = 0
+        self._built = False
+
+    # messages stored before the first search are read from the DB once
+    def ensure_built(self):
+        if self._built:
+            return
+        with self._lock:
+            if self._built:
+                return
+            for row in Messages.objects.values('id', 'conversation_id', 'text', 'created_at').iterator(chunk_size=2000):
+                self._add(row)
+            self._built = True
+
+    # rows are dicts with the Messages fields, ignored until the index is built (it reads them from the DB then)
+    # checked under the lock, rows stored while the index is being built are added after it
+    def add(self, rows):
+        with self._lock:
+            if not self._built:
+                return
+            for row in rows:
+                self._add(row)
+
+    def remove(self, message_ids):
+        with self._lock:
+            if not self._built:
+                return
+            for message_id in message_ids:
+                self._remove(str(message_id))
+
+    def _add(self, row):
+        message_id = str(row['id'])
+        self._remove(message_id)
+
+        frequencies = defaultdict(int)
+        terms = tokenize(row['text'])
+        for term in terms:
+            frequencies[term] += 1
+        for term, frequency in frequencies.items():
+            self._postings[term][message_id] = frequency
+
+        self._documents[message_id] = (str(row['conversation_id']), row['created_at'], dict(frequencies), len(terms))
+        self._total_length += len(terms)
+
+    def _remove(self, message_id):
+        document = self._documents.pop(message_id, None)
+        if document is None:
+            return
+        for term in document[2]:
+            postings = self._postings.get(term)
+            if postings is not None:
+                postings.pop(message_id, None)
+                if not postings:
+                    del self._postings[term]
+        self._total_length -= document[3]
+
+    # (rank, created_at, id) of the matching messages, same order and cursor as search_postgres
+    def search(self, text, conversation_ids, date_from, date_to, after, limit):
+        required, excluded = parse_query(text)
+        if not required:
+            return []
+
+        with self._lock:
+            postings = [self._postings.get(term, {}) for term in required]
+            # intersection starts from the rarest term
+            postings.sort(key=len)
+            candidates = set(postings[0])
+            for other in postings[1:]:
+                candidates.intersection_update(other)
+            for term in excluded:
+                candidates.difference_update(self._postings.get(term, ()))
+
+            total = len(self._documents)
+            average_length = self._total_length / total if total else 1
+            hits = []
+            for message_id in candidates:
+                conversation_id, created_at, frequencies, length = self._documents[message_id]
+                if conversation_ids is not None and conversation_id not in conversation_ids:
+                    continue
+                if (date_from and created_at < date_from) or (date_to and created_at >= date_to):
+                    continue
+                hits.append((self._rank(required, frequencies, length, total, average_length), created_at, message_id))
+
+        # best rank first, then newest first, then id (descending like the postgres query)
+        hits.sort(reverse=True)
+        if after:
+            rank, created_at, message_id = after
+            cursor = (rank, created_at, str(message_id))
+            hits = [hit for hit in hits if hit < cursor]
+        return hits[:limit]
+
+    # BM25 score of a message for the terms
+    def _rank(self, terms, frequencies, length, total, average_length):
+        score = 0.0
+        for term in terms:
+            frequency = frequencies.get(term, 0)
+            matching = len(self._postings.get(term, ()))
+            idf = math.log(1 + (total - matching + 0.5) / (matching + 0.5))
+            score += idf * frequency * 2.2 / (frequency + 1.2 * (0.25 + 0.75 * length / average_length))
+        return round(score, 6)
+
+
+index = InvertedIndex()
+
+
+# called with the rows just stored / restored and the ids just archived, nothing to do for postgres
+def index_messages(rows):
+    if get_backend() == 'memory':
+        index.add(rows)
+
+
+def forget_messages(message_ids):
+    if get_backend() == 'memory':
+        index.remove(message_ids)
@@ -1,28 +1,69 @@
 # This is like an middleware for authentication of the user in the websockets
 
+import threading
 from channels.db import database_sync_to_async
 from authapp.models import MyUser
 from django.contrib.auth.models import AnonymousUser
 from django.conf import settings
+from django.core.exceptions import ValidationError
 from urllib.parse import parse_qs
+from cachetools import TTLCache
 import jwt
 
 # Import Simple JWT's default settings
 from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.models import TokenUser
+
+
+# users authenticated recently, so a burst of reconnects does not hit the DB for every handshake
+# entries are removed when the user is saved or deleted (chat.signals), but only in the worker which saved it -
+# the other workers can still let a deactivated / deleted user open sockets for up to USER_CACHE_TTL seconds,
+# so keep it short (sockets already open are not closed on deactivation either)
+USER_CACHE_TTL = getattr(settings, 'CHAT_WS_USER_CACHE_TTL', 30)
+USER_CACHE_SIZE = getattr(settings, 'CHAT_WS_USER_CACHE_SIZE', 10000)
+# when True the user is built from the token claims (TokenUser) and the DB is not touched at all
+TRUST_TOKEN_CLAIMS = getattr(settings, 'CHAT_WS_TRUST_TOKEN_CLAIMS', False)
+
+_user_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+_user_cache_lock = threading.Lock()
+
 
 @database_sync_to_async
-def get_user(user_id):
+def load_user(user_id):
     """
     Asynchronously retrieves a user from the database.
-    Returns AnonymousUser if the user does not exist or the ID is invalid.
+    Returns None if the user does not exist or the ID is invalid.
     """
     try:
         # Your MyUser model correctly uses a UUID primary key
         return MyUser.objects.get(id=user_id)
-    except (MyUser.DoesNotExist, ValueError, TypeError):
+    except (MyUser.DoesNotExist, ValueError, TypeError, ValidationError):
         # Handles cases where user doesn't exist or ID is not a valid UUID
-        return AnonymousUser()
+        return None
+
+
+async def get_user(user_id):
+    """
+    Returns the user from the cache or the database.
+    Returns AnonymousUser if the user does not exist or is deactivated.
+    """
+    key = str(user_id)
+    with _user_cache_lock:
+        user = _user_cache.get(key)
+
+    if user is None:
+        user = await load_user(user_id)
+        if user is None or not user.is_active:
+            return AnonymousUser()
+        with _user_cache_lock:
+            _user_cache[key] = user
+
+    return user
+
 
+def invalidate_user(user_id):
+    with _user_cache_lock:
+        _user_cache.pop(str(user_id), None)
 
 
 class JWTAuthMiddleware:
@@ -55,7 +96,10 @@ class JWTAuthMiddleware:
                 user_id = payload.get(user_id_claim)
 
                 # check if user with the id in the token exists or not
-                if user_id:
+                if user_id and TRUST_TOKEN_CLAIMS:
+                    # user principal from the claims (id, user_type), no DB lookup
+                    scope['user'] = TokenUser(payload)
+                elif user_id:
                     scope['user'] = await get_user(user_id)
                 else:
                     scope['user'] = AnonymousUser()
@@ -0,0 +1,24 @@
+# keeping the websocket user cache (chat.security) and the inbox names in sync with the users table
+
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from authapp.models import MyUser
+from .models import InboxEntry
+from .security import invalidate_user
+
+
+# any change (including deactivation) removes the cached user, next handshake loads it again
+@receiver(post_save, sender=MyUser)
+@receiver(post_delete, sender=MyUser)
+def remove_cached_user(sender, instance, **kwargs):
+    invalidate_user(instance.id)
+
+
+# name of the user is copied in the inbox entries of the other participants
+@receiver(post_save, sender=MyUser)
+def update_inbox_names(sender, instance, created, update_fields=None, **kwargs):
+    # new users have no conversations yet, and saves like last_login on login do not touch the name
+    if created or (update_fields and not {'first_name', 'last_name'} & set(update_fields)):
+        return
+    name = f"{instance.first_name} {instance.last_name}"
+    InboxEntry.objects.filter(other_user=instance).exclude(other_user_name=name).update(other_user_name=name)
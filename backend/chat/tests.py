@@ -1,3 +1,760 @@
-from django.test import TestCase
+import json
+import uuid
+import asyncio
+from unittest import skipUnless
+from contextlib import asynccontextmanager
+from unittest import mock
+from asgiref.sync import sync_to_async
+from cachetools import TTLCache
+from django.contrib.auth.models import AnonymousUser
+from django.db import OperationalError, connection
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from io import StringIO
+from django.core.management import call_command, CommandError
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+from rest_framework_simplejwt.tokens import AccessToken
+from rest_framework.test import APITestCase
+from authapp.models import MyUser
+from datetime import timedelta
+from django.utils import timezone
+from .models import Conversation, Messages, InboxEntry, ArchivedConversation
+from .persistence import store_messages
+from .routing import websocket_urlpatterns
+from .security import JWTAuthMiddleware
+import msgpack
+from . import persistence, presence, security, replay, archive, search, protocol, ratelimit
+from .management.commands import loadtest_chat
 
-# Create your tests here.
+
+def create_user(email, user_type='customer', **extra_fields):
+    return MyUser.objects.create_user(email, 'password', first_name='Test', last_name='User', user_type=user_type, **extra_fields)
+
+
+@mock.patch.object(persistence, 'RETRY_BACKOFF_SECONDS', 0)
+class MessageBatcherTests(SimpleTestCase):
+    def setUp(self):
+        self.batcher = persistence.MessageBatcher(batch_size=10, flush_interval=60)
+        self.announced = []
+        patch = mock.patch.object(self.batcher, '_announce', self.announce)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    async def announce(self, rows):
+        self.announced.extend(rows)
+
+    async def test_db_error_retries_the_batch(self):
+        attempts = []
+
+        def store(rows):
+            attempts.append(len(rows))
+            if len(attempts) < 3:
+                raise OperationalError("connection lost")
+            return rows
+
+        with mock.patch.object(persistence, 'store_messages', store):
+            await self.batcher.add({'id': 'first'})
+            await self.batcher.add({'id': 'second'})
+            await self.batcher.flush()
+
+        self.assertEqual(attempts, [2, 2, 2])
+        self.assertEqual([row['id'] for row in self.announced], ['first', 'second'])
+
+    async def test_lost_messages_are_logged(self):
+        store = mock.Mock(side_effect=OperationalError("connection lost"))
+
+        with mock.patch.object(persistence, 'store_messages', store), mock.patch('builtins.print') as log:
+            await self.batcher.add({'id': 'first'})
+            await self.batcher.flush()
+
+        self.assertEqual(store.call_count, persistence.STORE_ATTEMPTS)
+        self.assertEqual(self.announced, [])
+        self.assertIn('lost message ids: first', log.call_args.args[0])
+        # failed batch is not left in the queue
+        self.assertTrue(self.batcher._queue.empty())
+
+
+# get_user reads through database_sync_to_async, which closes the connection inside the TestCase transaction
+class UserCacheTests(TransactionTestCase):
+    def setUp(self):
+        self.now = 0
+        patch = mock.patch.object(security, '_user_cache', TTLCache(maxsize=10, ttl=security.USER_CACHE_TTL, timer=lambda: self.now))
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.user = create_user('customer@example.com')
+
+    async def test_saved_user_is_removed_from_cache(self):
+        self.assertEqual((await security.get_user(self.user.id)).id, self.user.id)
+
+        self.user.is_active = False
+        await self.user.asave()
+        self.assertIsInstance(await security.get_user(self.user.id), AnonymousUser)
+
+    # change made by another worker - only the TTL bounds how long the cached user is used
+    async def test_cached_user_expires(self):
+        await security.get_user(self.user.id)
+        await MyUser.objects.filter(id=self.user.id).aupdate(is_active=False)
+
+        self.assertEqual((await security.get_user(self.user.id)).id, self.user.id)
+        self.now += security.USER_CACHE_TTL + 1
+        self.assertIsInstance(await security.get_user(self.user.id), AnonymousUser)
+
+
+class TokenBucketTests(SimpleTestCase):
+    def setUp(self):
+        self.now = 0
+        self.bucket = ratelimit.TokenBucket(rate=2, capacity=4, timer=lambda: self.now)
+
+    def test_burst_then_refill(self):
+        self.assertEqual(ratelimit.acquire([self.bucket], 4), 0)
+        self.assertEqual(ratelimit.acquire([self.bucket]), 0.5)
+
+        self.now += 0.5
+        self.assertEqual(ratelimit.acquire([self.bucket]), 0)
+        self.assertEqual(ratelimit.acquire([self.bucket], 3), 1.5)
+
+    def test_refill_stops_at_capacity(self):
+        self.now += 100
+        self.assertEqual(ratelimit.acquire([self.bucket], 4), 0)
+        self.assertEqual(ratelimit.acquire([self.bucket]), 0.5)
+
+    # a frame takes its tokens from every bucket or from none of them
+    def test_all_buckets_or_none(self):
+        other = ratelimit.TokenBucket(rate=1, capacity=1, timer=lambda: self.now)
+        self.assertEqual(ratelimit.acquire([self.bucket, other, None], 2), 1)
+        self.assertEqual(self.bucket.tokens, 4)
+        self.assertEqual(ratelimit.acquire([self.bucket, None]), 0)
+        self.assertEqual(ratelimit.acquire([None]), 0)
+
+
+class InMemoryPresenceStoreTests(SimpleTestCase):
+    def setUp(self):
+        self.store = presence.InMemoryPresenceStore()
+
+    def test_available_while_any_connection_is_open(self):
+        self.store.connected('representative', 'socket-1')
+        self.store.connected('representative', 'socket-2')
+        self.store.disconnected('representative', 'socket-1')
+        self.assertEqual(self.store.least_loaded(), 'representative')
+
+        # closing the same socket twice does not drop the other one
+        self.store.disconnected('representative', 'socket-1')
+        self.assertEqual(self.store.least_loaded(), 'representative')
+
+        self.store.disconnected('representative', 'socket-2')
+        self.assertIsNone(self.store.least_loaded())
+
+    def test_least_loaded_representative(self):
+        self.store.set_load('busy', 3)
+        self.store.set_load('idle', 1)
+        self.store.connected('busy', 'socket-1')
+        self.store.connected('idle', 'socket-2')
+        self.assertEqual(self.store.least_loaded(), 'idle')
+
+        self.store.change_load('idle', 3)
+        self.assertEqual(self.store.least_loaded(), 'busy')
+        self.store.change_load('idle', -2)
+        self.assertEqual(self.store.least_loaded(), 'idle')
+
+    def test_load_does_not_go_below_zero(self):
+        self.store.connected('representative', 'socket-1')
+        self.store.change_load('representative', -1)
+        self.store.change_load('representative', 1)
+        self.assertEqual(self.store._load['representative'], 1)
+
+    # load is counted again from the DB the next time the representative connects
+    def test_load_is_forgotten_when_last_socket_closes(self):
+        self.store.set_load('representative', 2)
+        self.store.connected('representative', 'socket-1')
+        self.store.disconnected('representative', 'socket-1')
+        self.assertFalse(self.store.has_load('representative'))
+
+        self.store.change_load('representative', 1)
+        self.assertFalse(self.store.has_load('representative'))
+
+
+class LoadtestBaselineTests(SimpleTestCase):
+    OPTIONS = {'rooms': 5, 'sockets': 10, 'messages': 10, 'batch': 1, 'rate': 20.0, 'layer': 'memory', 'protocol': 'json'}
+
+    def test_same_config(self):
+        config = loadtest_chat.run_config(self.OPTIONS)
+        self.assertEqual(loadtest_chat.config_differences({'config': {**config, 'python': '3.0'}}, config), [])
+
+    def test_different_config(self):
+        baseline = {'config': loadtest_chat.run_config(self.OPTIONS)}
+        config = loadtest_chat.run_config({**self.OPTIONS, 'protocol': 'msgpack', 'batch': 5})
+        self.assertEqual(loadtest_chat.config_differences(baseline, config), [('batch', 1, 5), ('protocol', 'json', 'msgpack')])
+        # result saved without its config
+        self.assertEqual(len(loadtest_chat.config_differences({}, config)), len(loadtest_chat.COMPARED_CONFIG))
+
+    def test_compare(self):
+        baseline = {'latency_ms': {'p50': 10}, 'throughput': {'deliveries_per_second': 100}}
+        result = {'latency_ms': {'p50': 13}, 'throughput': {'deliveries_per_second': 90}}
+        self.assertEqual([name for name, *_ in loadtest_chat.compare(baseline, result, 0.2)], ['latency_ms.p50'])
+
+
+class GetConversationIdTests(APITestCase):
+    def setUp(self):
+        self.customer = create_user('customer@example.com')
+        self.representative = create_user('representative@example.com', 'representative')
+
+    def test_customer_keeps_their_conversation(self):
+        self.client.force_authenticate(self.customer)
+        first = self.client.get(f'/chat/get_conversation_id/{self.customer.id}/')
+        self.assertEqual(first.status_code, 200)
+        conversation = Conversation.objects.get(id=first.data['conversation_id'])
+        self.assertEqual({conversation.user1_id, conversation.user2_id}, {self.customer.id, self.representative.id})
+
+        # a less loaded representative does not take over an existing conversation
+        create_user('other@example.com', 'representative')
+        second = self.client.get(f'/chat/get_conversation_id/{self.customer.id}/')
+        self.assertEqual(second.data['conversation_id'], first.data['conversation_id'])
+        self.assertEqual(Conversation.objects.count(), 1)
+
+    def test_requires_authentication(self):
+        response = self.client.get(f'/chat/get_conversation_id/{self.customer.id}/')
+        self.assertEqual(response.status_code, 401)
+
+    def test_other_customer(self):
+        self.client.force_authenticate(create_user('other@example.com'))
+        response = self.client.get(f'/chat/get_conversation_id/{self.customer.id}/')
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(Conversation.objects.exists())
+
+    # the representative would be assigned to themselves, which the ordered pair constraint rejects
+    def test_representative_as_customer(self):
+        self.client.force_authenticate(self.representative)
+        response = self.client.get(f'/chat/get_conversation_id/{self.representative.id}/')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Conversation.objects.exists())
+
+
+class InboxTests(APITestCase):
+    def setUp(self):
+        self.customer = create_user('customer@example.com')
+        self.representative = create_user('representative@example.com', 'representative')
+        self.conversation, _ = Conversation.objects.get_or_create_for_pair(self.customer.id, self.representative.id)
+
+    def send(self, sender, *texts, created_at=None):
+        created_at = created_at or timezone.now()
+        store_messages([
+            {'conversation_id': self.conversation.id, 'sender_id': sender.id, 'text': text, 'created_at': created_at + timedelta(microseconds=index)}
+            for index, text in enumerate(texts)
+        ])
+
+    def entry(self, owner):
+        return InboxEntry.objects.get(owner=owner, conversation=self.conversation)
+
+    def test_entries_created_with_conversation(self):
+        self.assertEqual(self.entry(self.representative).other_user_id, self.customer.id)
+        self.assertEqual(self.entry(self.customer).other_user_id, self.representative.id)
+
+    def test_unread_counts(self):
+        self.send(self.customer, 'Hello', 'I need a home loan')
+        self.assertEqual(self.entry(self.representative).unread_count, 2)
+        self.assertEqual(self.entry(self.customer).unread_count, 0)
+
+        # replying reads everything before the reply
+        self.send(self.representative, 'Sure')
+        self.assertEqual(self.entry(self.representative).unread_count, 0)
+        self.assertEqual(self.entry(self.customer).unread_count, 1)
+
+        # both in one batch - only the messages after the own last one stay unread
+        self.send(self.customer, 'Thanks')
+        self.send(self.representative, 'Welcome')
+        self.send(self.customer, 'Bye')
+        self.assertEqual(self.entry(self.customer).unread_count, 0)
+        self.assertEqual(self.entry(self.representative).unread_count, 1)
+
+    def test_mark_read(self):
+        self.send(self.customer, 'Hello')
+        self.client.force_authenticate(self.representative)
+        response = self.client.post(f'/chat/inbox/{self.conversation.id}/read/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.entry(self.representative).unread_count, 0)
+
+        self.client.force_authenticate(create_user('other@example.com'))
+        self.assertEqual(self.client.post(f'/chat/inbox/{self.conversation.id}/read/').status_code, 404)
+
+    def test_last_message(self):
+        self.send(self.customer, 'Hello', 'I need a home loan')
+        entry = self.entry(self.representative)
+        self.assertEqual(entry.last_message_text, 'I need a home loan')
+
+        # message stored late (write behind) does not replace a newer one
+        self.send(self.representative, 'Late', created_at=entry.last_activity_at - timedelta(seconds=1))
+        self.assertEqual(self.entry(self.representative).last_message_text, 'I need a home loan')
+        self.assertEqual(self.entry(self.representative).last_activity_at, entry.last_activity_at)
+
+    def test_name_change_updates_entries(self):
+        self.customer.first_name = 'Renamed'
+        self.customer.save()
+        self.assertEqual(self.entry(self.representative).other_user_name, 'Renamed User')
+
+    def test_connected_users(self):
+        self.send(self.customer, 'Hello')
+        url = f'/chat/get_connected_users/{self.representative.id}/'
+        self.assertEqual(self.client.get(url).status_code, 401)
+
+        self.client.force_authenticate(create_user('other@example.com', 'representative'))
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+        self.client.force_authenticate(self.representative)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['results'], [{
+            'conversation_id': str(self.conversation.id),
+            'user_name': 'Test User',
+            'last_message': 'Hello',
+            'last_activity_at': self.entry(self.representative).last_activity_at.isoformat(),
+            'unread_count': 1,
+        }])
+
+class MessageHistoryTests(APITestCase):
+    def setUp(self):
+        self.customer = create_user('customer@example.com')
+        self.representative = create_user('representative@example.com', 'representative')
+        self.conversation, _ = Conversation.objects.get_or_create_for_pair(self.customer.id, self.representative.id)
+        # three messages on every timestamp, so pages end in the middle of equal created_at
+        now = timezone.now()
+        store_messages([
+            {'conversation_id': self.conversation.id, 'sender_id': self.customer.id, 'text': f'message {number}', 'created_at': now + timedelta(seconds=number // 3)}
+            for number in range(10)
+        ])
+        self.client.force_authenticate(self.customer)
+
+    def get_pages(self, limit):
+        pages, cursor = [], None
+        while True:
+            params = {'limit': limit, **({'before': cursor} if cursor else {})}
+            response = self.client.get(f'/chat/history/{self.conversation.id}/', params)
+            self.assertEqual(response.status_code, 200)
+            pages.append(response.data['messages'])
+            cursor = response.data['next_cursor']
+            if not cursor:
+                return pages
+
+    def test_pages_cover_every_message_once_in_order(self):
+        expected = [
+            str(message_id) for message_id in
+            Messages.objects.filter(conversation=self.conversation).order_by('created_at', 'id').values_list('id', flat=True)
+        ]
+        for limit in (1, 2, 4, 10, 50):
+            pages = self.get_pages(limit)
+            self.assertEqual(len(pages), -(-10 // limit))
+            # newest page first, every page oldest first
+            self.assertEqual([message['id'] for page in reversed(pages) for message in page], expected)
+
+    def test_invalid_cursor(self):
+        response = self.client.get(f'/chat/history/{self.conversation.id}/', {'before': 'not a cursor'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_non_participant_gets_not_found(self):
+        self.client.force_authenticate(create_user('other@example.com'))
+        self.assertEqual(self.client.get(f'/chat/history/{self.conversation.id}/').status_code, 404)
+
+    def test_requires_authentication(self):
+        self.client.force_authenticate(None)
+        self.assertEqual(self.client.get(f'/chat/history/{self.conversation.id}/').status_code, 401)
+
+
+class ArchiveTests(APITestCase):
+    def setUp(self):
+        self.customer = create_user('customer@example.com')
+        self.representative = create_user('representative@example.com', 'representative')
+        self.conversation, _ = Conversation.objects.get_or_create_for_pair(self.customer.id, self.representative.id)
+        old = timezone.now() - timedelta(days=60)
+        store_messages([
+            {'conversation_id': self.conversation.id, 'sender_id': self.customer.id, 'text': f'message {number}', 'created_at': old + timedelta(seconds=number)}
+            for number in range(5)
+        ])
+
+    def stored(self):
+        return list(Messages.objects.filter(conversation=self.conversation).order_by('seq').values('id', 'seq', 'sender_id', 'text', 'created_at'))
+
+    def run_command(self, *args):
+        out, err = StringIO(), StringIO()
+        call_command('archive_conversations', *args, stdout=out, stderr=err)
+        return out.getvalue(), err.getvalue()
+
+    def test_archive_and_restore(self):
+        before = self.stored()
+        out, _ = self.run_command('--idle-days', '30')
+        self.assertIn('Archived 5 messages of 1 conversations', out)
+        self.assertEqual(self.stored(), [])
+        self.assertEqual(ArchivedConversation.objects.get().message_count, 5)
+
+        # opening the conversation puts the same rows back
+        self.client.force_authenticate(self.customer)
+        response = self.client.get(f'/chat/history/{self.conversation.id}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.stored(), before)
+        self.assertFalse(ArchivedConversation.objects.exists())
+
+    def test_active_conversation_is_kept(self):
+        store_messages([{'conversation_id': self.conversation.id, 'sender_id': self.customer.id, 'text': 'new', 'created_at': timezone.now()}])
+        self.assertEqual(archive.archive_conversation(self.conversation.id, archive.idle_cutoff(30)), 0)
+        self.assertEqual(len(self.stored()), 6)
+
+    def test_restore_option(self):
+        self.run_command('--idle-days', '30')
+        out, _ = self.run_command('--restore', str(self.conversation.id))
+        self.assertIn('Restored 5 messages', out)
+        self.assertEqual(len(self.stored()), 5)
+
+    def test_archived_conversation_leaves_the_load(self):
+        store = presence.InMemoryPresenceStore()
+        with mock.patch.object(presence, 'store', store):
+            presence.representative_connected(self.representative.id, 'socket-1')
+            self.assertEqual(store._load[str(self.representative.id)], 1)
+
+            self.run_command('--idle-days', '30')
+            self.assertEqual(store._load[str(self.representative.id)], 0)
+            # archiving again (nothing new to move) does not count twice
+            self.run_command('--idle-days', '30')
+            self.assertEqual(store._load[str(self.representative.id)], 0)
+
+            archive.restore_conversation(self.conversation.id)
+            self.assertEqual(store._load[str(self.representative.id)], 1)
+
+            # load counted from the DB leaves out archived conversations
+            archive.archive_conversation(self.conversation.id, archive.idle_cutoff(30))
+            presence.representative_disconnected(self.representative.id, 'socket-1')
+            presence.representative_connected(self.representative.id, 'socket-2')
+            self.assertEqual(store._load[str(self.representative.id)], 0)
+
+    def test_restore_invalid_id(self):
+        with self.assertRaisesMessage(CommandError, 'Invalid conversation id'):
+            self.run_command('--restore', 'not-a-uuid')
+
+    def test_failed_conversation_is_reported(self):
+        with mock.patch.object(archive, 'archive_conversation', side_effect=RuntimeError('disk full')):
+            out, err = self.run_command('--idle-days', '30')
+        self.assertIn(f'Could not archive conversation {self.conversation.id}: disk full', err)
+        self.assertIn('Archived 0 messages', out)
+
+
+class SearchTests(APITestCase):
+    backend = 'memory'
+
+    def setUp(self):
+        patches = [mock.patch.object(search, 'BACKEND', self.backend), mock.patch.object(search, 'index', search.InvertedIndex())]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        self.customer = create_user('customer@example.com')
+        self.representative = create_user('representative@example.com', 'representative')
+        self.conversation, _ = Conversation.objects.get_or_create_for_pair(self.customer.id, self.representative.id)
+        now = timezone.now()
+        # equal ranks (same text, some at the same time) and different ones
+        texts = ['home loan rates'] * 4 + ['home loan', 'loan for a home with home insurance', 'car loan']
+        store_messages([
+            {'conversation_id': self.conversation.id, 'sender_id': self.customer.id, 'text': text, 'created_at': now - timedelta(seconds=number // 2)}
+            for number, text in enumerate(texts)
+        ])
+        self.client.force_authenticate(self.customer)
+
+    def search_pages(self, text, limit):
+        pages, cursor = [], None
+        while True:
+            params = {'q': text, 'limit': limit, **({'cursor': cursor} if cursor else {})}
+            response = self.client.get('/chat/search/', params)
+            self.assertEqual(response.status_code, 200)
+            pages.append(response.data['results'])
+            cursor = response.data['next_cursor']
+            if not cursor:
+                return pages
+
+    def test_pages_cover_every_match_once(self):
+        everything = self.search_pages('home loan', 100)[0]
+        self.assertEqual(len(everything), 6)
+        ranks = [row['rank'] for row in everything]
+        self.assertEqual(ranks, sorted(ranks, reverse=True))
+
+        for limit in (1, 2, 4):
+            pages = self.search_pages('home loan', limit)
+            self.assertEqual([row['id'] for page in pages for row in page], [row['id'] for row in everything])
+
+    def test_other_users_conversations_are_not_searched(self):
+        self.client.force_authenticate(create_user('other@example.com'))
+        self.assertEqual(self.search_pages('loan', 100), [[]])
+
+
+@skipUnless(connection.vendor == 'postgresql', 'ts_rank needs PostgreSQL')
+class PostgresSearchTests(SearchTests):
+    backend = 'postgres'
+
+
+# sockets go through the same middleware as backend.asgi, with the in memory channel layer
+# consumers use database_sync_to_async, so no TestCase transaction
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class SocketTestCase(TransactionTestCase):
+    def setUp(self):
+        self.application = JWTAuthMiddleware(URLRouter(websocket_urlpatterns))
+        self.customer = create_user('customer@example.com')
+        self.representative = create_user('representative@example.com', 'representative')
+        self.conversation, _ = Conversation.objects.get_or_create_for_pair(self.customer.id, self.representative.id)
+        self.conversation_id = str(self.conversation.id)
+
+    # subprotocols = frame formats asked by the client, the one accepted is kept in communicator.subprotocol
+    @asynccontextmanager
+    async def connect(self, user, path='ws/chat/', query='', subprotocols=None):
+        communicator = WebsocketCommunicator(self.application, f'/{path}?token={AccessToken.for_user(user)}{query}', subprotocols=subprotocols)
+        connected, communicator.subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        try:
+            yield communicator
+        finally:
+            await communicator.disconnect()
+
+    # frames until one of the given type, returns all of them
+    async def receive_until(self, communicator, frame_type):
+        frames = []
+        while not frames or frames[-1]['type'] != frame_type:
+            frames.append(await communicator.receive_json_from(timeout=5))
+        return frames
+
+    async def receive_messages(self, communicator, count):
+        return [await communicator.receive_json_from(timeout=5) for _ in range(count)]
+
+    # messages stored through a socket, returns their frames as seen by the sender
+    async def send_texts(self, user, *texts):
+        async with self.connect(user, f'ws/chat/{self.conversation_id}/') as socket:
+            for text in texts:
+                await socket.send_json_to({'text': text})
+            return await self.receive_messages(socket, len(texts))
+
+
+class ChatSocketTests(SocketTestCase):
+    async def test_concurrent_sends_get_unique_seq(self):
+        path = f'ws/chat/{self.conversation_id}/'
+        async with self.connect(self.customer, path) as customer, self.connect(self.representative, path) as representative:
+            async def send(socket, prefix):
+                for number in range(10):
+                    await socket.send_json_to({'text': f'{prefix} {number}'})
+
+            await asyncio.gather(send(customer, 'customer'), send(representative, 'representative'))
+            frames = await self.receive_messages(representative, 20)
+
+        seqs = [frame['seq'] for frame in frames]
+        self.assertEqual(sorted(seqs), list(range(1, 21)))
+        # messages of one socket keep the order they were sent in
+        for prefix in ('customer', 'representative'):
+            sent = [frame for frame in frames if frame['text'].startswith(prefix)]
+            self.assertEqual([frame['text'] for frame in sent], [f'{prefix} {number}' for number in range(10)])
+            self.assertEqual([frame['seq'] for frame in sent], sorted(frame['seq'] for frame in sent))
+
+        stored = await sync_to_async(list)(Messages.objects.filter(conversation=self.conversation).order_by('seq').values_list('seq', flat=True))
+        self.assertEqual(stored, list(range(1, 21)))
+        await sync_to_async(self.conversation.refresh_from_db)()
+        self.assertEqual(self.conversation.last_seq, 20)
+
+    async def test_resume_from_last_seq(self):
+        await self.send_texts(self.customer, 'one', 'two', 'three')
+
+        async with self.connect(self.representative, f'ws/chat/{self.conversation_id}/', '&last_seq=1') as socket:
+            frames = await self.receive_until(socket, 'chat.replayed')
+
+        self.assertEqual([(frame['seq'], frame['text']) for frame in frames[:-1]], [(2, 'two'), (3, 'three')])
+        self.assertEqual(frames[-1], {'type': 'chat.replayed', 'conversation_id': self.conversation_id, 'last_seq': 3, 'count': 2})
+
+    async def test_resume_reads_gap_from_db(self):
+        await self.send_texts(self.customer, 'one', 'two')
+        # other worker / restart - nothing in the replay buffer
+        replay.recent_messages.clear()
+
+        async with self.connect(self.representative, f'ws/chat/{self.conversation_id}/', '&last_seq=0') as socket:
+            frames = await self.receive_until(socket, 'chat.replayed')
+        self.assertEqual([frame['text'] for frame in frames[:-1]], ['one', 'two'])
+
+    async def test_resync_when_gap_is_too_large(self):
+        await self.send_texts(self.customer, 'one', 'two', 'three')
+        replay.recent_messages.clear()
+
+        with mock.patch.object(replay, 'MAX_REPLAY_MESSAGES', 2):
+            async with self.connect(self.representative, f'ws/chat/{self.conversation_id}/', '&last_seq=0') as socket:
+                frame = await socket.receive_json_from(timeout=5)
+        self.assertEqual(frame, {'type': 'chat.resync', 'conversation_id': self.conversation_id, 'last_seq': 3})
+
+    async def test_up_to_date_client_gets_nothing_replayed(self):
+        await self.send_texts(self.customer, 'one')
+
+        async with self.connect(self.representative, f'ws/chat/{self.conversation_id}/', '&last_seq=1') as socket:
+            frame = await socket.receive_json_from(timeout=5)
+        self.assertEqual(frame['count'], 0)
+
+    async def test_multiplex_resume(self):
+        await self.send_texts(self.customer, 'one', 'two')
+
+        async with self.connect(self.representative) as socket:
+            await socket.send_json_to({'action': 'subscribe', 'conversation_ids': [self.conversation_id], 'last_seqs': {self.conversation_id: 1}})
+            frames = await self.receive_until(socket, 'chat.replayed')
+        self.assertEqual([frame['type'] for frame in frames], ['chat.subscribed', 'chat.message', 'chat.replayed'])
+        self.assertEqual(frames[1]['seq'], 2)
+
+
+# slow refill, so only the burst of every bucket is available during a test
+@mock.patch.object(ratelimit, 'SOCKET_RATE', 0.001)
+@mock.patch.object(ratelimit, 'SOCKET_BURST', 3)
+@mock.patch.object(ratelimit, 'USER_RATE', 0.001)
+@mock.patch.object(ratelimit, 'USER_BURST', 5)
+@mock.patch.object(ratelimit, 'MAX_BATCH_MESSAGES', 3)
+class RateLimitSocketTests(SocketTestCase):
+    def setUp(self):
+        super().setUp()
+        patch = mock.patch.object(ratelimit, '_user_buckets', TTLCache(maxsize=10, ttl=600))
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    async def test_socket_limit(self):
+        async with self.connect(self.customer, f'ws/chat/{self.conversation_id}/') as socket:
+            await socket.send_json_to({'messages': [{'text': 'one'}, {'text': 'two'}]})
+            await socket.send_json_to({'messages': [{'text': 'three'}, {'text': 'four'}]})
+            frames = await self.receive_messages(socket, 3)
+
+        self.assertEqual([frame.get('text') for frame in frames[:2]], ['one', 'two'])
+        error = frames[2]
+        self.assertEqual((error['type'], error['code'], error['refused'], error['conversation_id']), ('error', 'rate_limited', 2, self.conversation_id))
+        self.assertGreater(error['retry_after'], 0)
+        # refused batch is not stored at all
+        self.assertEqual(await Messages.objects.filter(conversation=self.conversation).acount(), 2)
+
+    # sockets of a user share the user bucket
+    async def test_user_limit(self):
+        path = f'ws/chat/{self.conversation_id}/'
+        async with self.connect(self.customer, path) as first, self.connect(self.customer, path) as second:
+            for text in ('one', 'two', 'three'):
+                await first.send_json_to({'text': text})
+            await self.receive_messages(first, 3)
+            await self.receive_messages(second, 3)
+
+            await second.send_json_to({'messages': [{'text': 'four'}, {'text': 'five'}]})
+            await second.send_json_to({'text': 'six'})
+            frames = await self.receive_messages(second, 3)
+
+        self.assertEqual([frame.get('text') for frame in frames[:2]], ['four', 'five'])
+        self.assertEqual((frames[2]['code'], frames[2]['refused']), ('rate_limited', 1))
+
+    async def test_batch_too_large(self):
+        async with self.connect(self.customer, f'ws/chat/{self.conversation_id}/') as socket:
+            await socket.send_json_to({'messages': [{'text': str(number)} for number in range(4)]})
+            error = await socket.receive_json_from(timeout=5)
+            self.assertEqual(error, {'type': 'error', 'code': 'batch_too_large', 'max_messages': 3, 'conversation_id': self.conversation_id})
+
+            # the batch took no tokens
+            await socket.send_json_to({'messages': [{'text': str(number)} for number in range(3)]})
+            self.assertEqual([frame['text'] for frame in await self.receive_messages(socket, 3)], ['0', '1', '2'])
+
+
+class ProtocolTests(SimpleTestCase):
+    def test_negotiate(self):
+        self.assertEqual(protocol.negotiate(['other', protocol.MSGPACK, protocol.JSON]), protocol.MSGPACK)
+        self.assertIsNone(protocol.negotiate(['other']))
+        self.assertIsNone(protocol.negotiate([]))
+        self.assertIsNone(protocol.negotiate(None))
+
+    def test_decode(self):
+        self.assertEqual(protocol.decode(text_data='{"text": "hi"}'), {'text': 'hi'})
+        self.assertEqual(protocol.decode(bytes_data=msgpack.packb({'text': 'hi'})), {'text': 'hi'})
+
+    def test_decode_invalid_frames(self):
+        frames = [
+            {'text_data': 'not json'},
+            {'text_data': ''},
+            {'text_data': '["text"]'},
+            {'text_data': '"text"'},
+            {'bytes_data': b'\xc1'},
+            {'bytes_data': msgpack.packb({'text': 'hi'}) + b'extra'},
+            {'bytes_data': msgpack.packb([1, 2])},
+        ]
+        for frame in frames:
+            with self.subTest(frame=frame), self.assertRaises(protocol.ProtocolError):
+                protocol.decode(**frame)
+
+    def test_encode_for(self):
+        payload = {'type': 'chat.message', 'text': 'hi'}
+        self.assertEqual(msgpack.unpackb(protocol.encode_for(protocol.MSGPACK, payload)['bytes_data']), payload)
+        self.assertEqual(json.loads(protocol.encode_for(protocol.JSON, payload)['text_data']), payload)
+        self.assertEqual(json.loads(protocol.encode_for(None, payload)['text_data']), payload)
+
+
+class ProtocolSocketTests(SocketTestCase):
+    async def test_msgpack_socket(self):
+        path = f'ws/chat/{self.conversation_id}/'
+        async with self.connect(self.customer, path, subprotocols=[protocol.MSGPACK]) as customer, self.connect(self.representative, path) as representative:
+            self.assertEqual(customer.subprotocol, protocol.MSGPACK)
+            self.assertIsNone(representative.subprotocol)
+
+            await customer.send_to(bytes_data=msgpack.packb({'text': 'from msgpack'}))
+            own = msgpack.unpackb(await customer.receive_from(timeout=5))
+            self.assertEqual((own['type'], own['text'], own['seq']), ('chat.message', 'from msgpack', 1))
+            # same broadcast in the format of the other socket
+            self.assertEqual(await representative.receive_json_from(timeout=5), own)
+
+            await representative.send_json_to({'text': 'from json'})
+            self.assertEqual(msgpack.unpackb(await customer.receive_from(timeout=5))['text'], 'from json')
+            self.assertEqual((await representative.receive_json_from(timeout=5))['text'], 'from json')
+
+    async def test_json_subprotocol(self):
+        async with self.connect(self.customer, f'ws/chat/{self.conversation_id}/', subprotocols=['other', protocol.JSON]) as socket:
+            self.assertEqual(socket.subprotocol, protocol.JSON)
+            await socket.send_json_to({'text': 'hello'})
+            self.assertEqual((await socket.receive_json_from(timeout=5))['text'], 'hello')
+
+    async def test_msgpack_multiplex_socket(self):
+        async with self.connect(self.customer, subprotocols=[protocol.MSGPACK]) as socket:
+            await socket.send_to(bytes_data=msgpack.packb({'action': 'subscribe', 'conversation_ids': [self.conversation_id]}))
+            self.assertEqual(msgpack.unpackb(await socket.receive_from(timeout=5))['type'], 'chat.subscribed')
+            await socket.send_to(bytes_data=msgpack.packb({'action': 'message', 'conversation_id': self.conversation_id, 'text': 'hello'}))
+            frame = msgpack.unpackb(await socket.receive_from(timeout=5))
+            self.assertEqual((frame['type'], frame['conversation_id'], frame['text']), ('chat.message', self.conversation_id, 'hello'))
+
+    # frames which are not objects are dropped, the socket keeps working
+    async def test_invalid_frames_are_ignored(self):
+        async with self.connect(self.customer, f'ws/chat/{self.conversation_id}/', subprotocols=[protocol.MSGPACK]) as socket:
+            await socket.send_to(bytes_data=msgpack.packb(['not', 'an', 'object']))
+            await socket.send_to(bytes_data=b'\xc1')
+            await socket.send_to(text_data='not json')
+            await socket.send_to(bytes_data=msgpack.packb({'text': 'after'}))
+            self.assertEqual(msgpack.unpackb(await socket.receive_from(timeout=5))['text'], 'after')
+            self.assertTrue(await socket.receive_nothing())
+
+        stored = await sync_to_async(list)(Messages.objects.filter(conversation=self.conversation).values_list('text', flat=True))
+        self.assertEqual(stored, ['after'])
+
+
+class MultiplexSocketTests(SocketTestCase):
+    async def test_conversation_ids_are_normalized(self):
+        async with self.connect(self.customer) as socket:
+            await socket.send_json_to({'action': 'subscribe', 'conversation_ids': [self.conversation_id.upper()]})
+            subscribed = await socket.receive_json_from()
+            self.assertEqual(subscribed['conversation_ids'], [self.conversation_id])
+
+            # same conversation in another spelling is already subscribed
+            await socket.send_json_to({'action': 'subscribe', 'conversation_ids': [self.conversation.id.hex]})
+            self.assertEqual((await socket.receive_json_from())['conversation_ids'], [])
+
+            await socket.send_json_to({'action': 'message', 'conversation_id': self.conversation_id.upper(), 'text': 'hello'})
+            message = await socket.receive_json_from()
+            self.assertEqual(message['type'], 'chat.message')
+            self.assertEqual(message['conversation_id'], self.conversation_id)
+
+            await socket.send_json_to({'action': 'unsubscribe', 'conversation_id': self.conversation.id.hex})
+            self.assertEqual((await socket.receive_json_from())['conversation_ids'], [self.conversation_id])
+
+    async def test_invalid_conversation_id(self):
+        async with self.connect(self.customer) as socket:
+            await socket.send_json_to({'action': 'subscribe', 'conversation_ids': ['not-a-uuid', self.conversation_id]})
+            error = await socket.receive_json_from()
+            self.assertEqual(error, {'type': 'error', 'code': 'invalid_conversation_id', 'conversation_id': 'not-a-uuid'})
+            self.assertEqual((await socket.receive_json_from())['conversation_ids'], [self.conversation_id])
+
+            await socket.send_json_to({'action': 'message', 'conversation_id': 'not-a-uuid', 'text': 'hello'})
+            self.assertEqual((await socket.receive_json_from())['code'], 'invalid_conversation_id')
+
+    async def test_other_users_conversation_is_forbidden(self):
+        async with self.connect(await sync_to_async(create_user)('other@example.com')) as socket:
+            await socket.send_json_to({'action': 'subscribe', 'conversation_ids': [self.conversation_id]})
+            self.assertEqual((await socket.receive_json_from())['code'], 'forbidden')
+            self.assertEqual((await socket.receive_json_from())['conversation_ids'], [])
@@ -1,9 +1,15 @@
 from django.urls import path
-from .views import GetConversationIdAPIView, GetConnectedUsers
+from .views import GetConversationIdAPIView, GetConnectedUsers, GetMessageHistory, MarkConversationRead, SearchMessages
 
 urlpatterns = [
     # used by customer - to get the representative to connect to
     path('get_conversation_id/<uuid:customer_id>/', GetConversationIdAPIView.as_view()),
     # used by representative - to get the customer with whom the representative has conversation id
     path('get_connected_users/<uuid:representative_id>/', GetConnectedUsers.as_view()),
+    # used by both - to load earlier messages of the conversation page by page
+    path('history/<uuid:conversation_id>/', GetMessageHistory.as_view()),
+    # used by both - conversation opened, its unread count is reset
+    path('inbox/<uuid:conversation_id>/read/', MarkConversationRead.as_view()),
+    # used by both - full text search of the messages (own conversations, all of them for staff)
+    path('search/', SearchMessages.as_view()),
 ]
\ No newline at end of file
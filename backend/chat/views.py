@@ -1,42 +1,62 @@
+import uuid
 from django.shortcuts import render
 from authapp.models import MyUser
 from rest_framework import status
 from rest_framework.response import Response
 from rest_framework import generics 
-from .models import Conversation
+from rest_framework.permissions import IsAuthenticated
+from .models import Conversation, Messages, InboxEntry
+from .presence import choose_representative, conversation_assigned
+from . import archive
+from . import search
+from .pagination import encode_cursor, decode_cursor, encode_ranked_cursor, decode_ranked_cursor, get_page_size, InvalidCursor
+from datetime import datetime, time, timedelta
+from django.db import transaction
 from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
 
 
 # FOR CUSTOMER VIEW
 # View to get the representative id
 # if conversation_id present return it, else create new one
+# customers only get their own conversation
 class GetConversationIdAPIView(generics.RetrieveAPIView):
+    permission_classes = [IsAuthenticated]
+
     def get(self, request, customer_id):
-        print(customer_id)
+        if customer_id != request.user.id:
+            return Response({"error": "Not allowed"}, status=status.HTTP_403_FORBIDDEN)
+        if request.user.user_type != 'customer':
+            return Response({"error": "Only customers can start a conversation"}, status=status.HTTP_400_BAD_REQUEST)
 
-        # customer object
-        customer = MyUser.objects.filter(id=customer_id).first()
-        print(customer)
+        # whole lookup + assignment runs with the customer row locked, so simultaneous
+        # first requests of a customer wait for each other instead of creating two conversations
+        with transaction.atomic():
+            # customer object
+            customer = MyUser.objects.select_for_update().filter(id=customer_id).first()
 
-        if not customer:
-            return Response({"error": "Customer not found"}, status=status.HTTP_404_NOT_FOUND)
+            if not customer:
+                return Response({"error": "Customer not found"}, status=status.HTTP_404_NOT_FOUND)
 
-        # get the online reprsentative
-        representative = MyUser.objects.filter(user_type='representative').first()
-        print(representative)
+            # customer already has a conversation - keep them with the same representative
+            # their representative comes from the customer's inbox (owner index), the conversation from the pair index
+            entry = InboxEntry.objects.filter(owner=customer).order_by('-last_activity_at', '-id').values('other_user_id').first()
+            conversation = Conversation.objects.get_for_pair(customer.id, entry['other_user_id']) if entry else None
+            if conversation:
+                return Response({'conversation_id': str(conversation.id)}, status=status.HTTP_200_OK)
 
-        if not representative:
-            return Response({"error": "No Representative available"}, status=status.HTTP_404_NOT_FOUND)
+            # get the online reprsentative with the least conversations
+            representative = choose_representative()
 
-        # create conversation_id for them, if already present that is returned
-        conversation = Conversation.objects.filter(
-            Q(user1=customer, user2=representative) | 
-            Q(user1=representative, user2=customer)).first()
+            if not representative:
+                return Response({"error": "No Representative available"}, status=status.HTTP_404_NOT_FOUND)
 
-        if not conversation:
-            conversation = Conversation.objects.create(user1=customer, user2=representative)
+            # single probe of the (user1, user2) unique index, safe if the pair gets inserted in parallel
+            conversation, created = Conversation.objects.get_or_create_for_pair(customer.id, representative.id)
 
-        # create id 
+        if created:
+            conversation_assigned(representative.id)
 
         return Response({'conversation_id': str(conversation.id)}, status=status.HTTP_200_OK)
 
@@ -45,30 +65,198 @@ class GetConversationIdAPIView(generics.RetrieveAPIView):
 # FOR REPRESENTATIVE VIEW
 # take representative ---> take all convid in which he is present ---> get all the connected users ----> return the customer name + conversation id which will then be rendered
 # then based on which user clicke by representative --> chat occurs between them
+# read from the inbox entries of the representative, most recent activity first, ?before=<cursor> for the next page
 class GetConnectedUsers(generics.RetrieveAPIView):
+    permission_classes = [IsAuthenticated]
+
     def get(self, request, representative_id):
-        # 1. Getting the representative obj
-        representative = MyUser.objects.filter(id=representative_id, user_type='representative').first()
-        if not representative:
+        # representatives only read their own inbox
+        if representative_id != request.user.id:
+            return Response({"error": "Not allowed"}, status=status.HTTP_403_FORBIDDEN)
+        if request.user.user_type != 'representative':
             return Response({"error": "Representative not found"}, status=status.HTTP_404_NOT_FOUND)
 
-        # 2. Get all conversations where this representative is either user1 or user2
-        conversations = Conversation.objects.filter(
-            Q(user1=representative) | Q(user2=representative)
-        ).select_related('user1', 'user2')
+        limit = get_page_size(request, default=50, maximum=200)
+        entries = InboxEntry.objects.filter(owner_id=representative_id)
+
+        before = request.query_params.get('before')
+        if before:
+            try:
+                last_activity_at, entry_id = decode_cursor(before)
+                entry_id = uuid.UUID(entry_id)
+            except (InvalidCursor, ValueError):
+                return Response({"error": "Invalid cursor"}, status=status.HTTP_400_BAD_REQUEST)
+            entries = entries.filter(
+                Q(last_activity_at__lt=last_activity_at) |
+                Q(last_activity_at=last_activity_at, id__lt=entry_id)
+            )
+
+        # one extra row tells if there is a next page
+        page = list(
+            entries.order_by('-last_activity_at', '-id')
+            .values('id', 'conversation_id', 'other_user_name', 'last_message_text', 'last_activity_at', 'unread_count')[:limit + 1]
+        )
+
+        has_more = len(page) > limit
+        page = page[:limit]
+        next_cursor = encode_cursor(page[-1]['last_activity_at'], page[-1]['id']) if has_more else None
+
+        results = [
+            {
+                "conversation_id": str(entry['conversation_id']),
+                "user_name": entry['other_user_name'],
+                "last_message": entry['last_message_text'],
+                "last_activity_at": entry['last_activity_at'].isoformat(),
+                "unread_count": entry['unread_count'],
+            }
+            for entry in page
+        ]
+
+        return Response({"results": results, "next_cursor": next_cursor}, status=status.HTTP_200_OK)
+
+
+
+# FOR BOTH VIEWS
+# conversation opened by the user - unread count of their inbox entry goes back to 0
+class MarkConversationRead(generics.GenericAPIView):
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, conversation_id):
+        updated = InboxEntry.objects.filter(owner=request.user, conversation_id=conversation_id).update(unread_count=0)
+        if not updated:
+            return Response({"error": "Conversation not found"}, status=status.HTTP_404_NOT_FOUND)
+        return Response({"conversation_id": str(conversation_id), "unread_count": 0}, status=status.HTTP_200_OK)
+
+
+
+# FOR BOTH VIEWS
+# message history of a conversation, newest page first
+# ?before=<cursor> gives the page older than the cursor, pagination uses the
+# (conversation, created_at, id) index so every page costs the same irrespective of chat length
+class GetMessageHistory(generics.RetrieveAPIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, conversation_id):
+        # only participants of the conversation can read it
+        conversation = Conversation.objects.filter(
+            Q(user1=request.user) | Q(user2=request.user),
+            id=conversation_id
+        ).only('id', 'archived_at').first()
+        if not conversation:
+            return Response({"error": "Conversation not found"}, status=status.HTTP_404_NOT_FOUND)
+
+        # archived conversation opened again, its messages are moved back first
+        archive.ensure_restored(conversation)
+
+        limit = get_page_size(request, default=50, maximum=200)
+        messages = Messages.objects.filter(conversation_id=conversation_id)
+
+        before = request.query_params.get('before')
+        if before:
+            try:
+                created_at, message_id = decode_cursor(before)
+                message_id = uuid.UUID(message_id)
+            except (InvalidCursor, ValueError):
+                return Response({"error": "Invalid cursor"}, status=status.HTTP_400_BAD_REQUEST)
+            messages = messages.filter(
+                Q(created_at__lt=created_at) |
+                Q(created_at=created_at, id__lt=message_id)
+            )
+
+        # one extra row tells if there is an older page
+        page = list(
+            messages.order_by('-created_at', '-id')
+            .values('id', 'seq', 'sender_id', 'text', 'created_at')[:limit + 1]
+        )
+        has_more = len(page) > limit
+        page = page[:limit]
+
+        next_cursor = encode_cursor(page[-1]['created_at'], page[-1]['id']) if has_more else None
+
+        # returned oldest first, same order in which the chat is rendered
+        data = [
+            {
+                "id": str(message['id']),
+                # client reconnects with the highest seq it has (?last_seq=)
+                "seq": message['seq'],
+                "sender": str(message['sender_id']),
+                "text": message['text'],
+                "timestamp": message['created_at'].isoformat(),
+            }
+            for message in reversed(page)
+        ]
+
+        return Response({"messages": data, "next_cursor": next_cursor}, status=status.HTTP_200_OK)
+
+
+
+# start of the range for ?from= and end of the range (exclusive) for ?to=, date or datetime
+# a date in ?to= includes that whole day
+def parse_date_param(value, end=False):
+    moment = parse_datetime(value)
+    if moment is None:
+        day = parse_date(value)
+        if day is None:
+            raise ValueError(f"Invalid date {value}")
+        moment = datetime.combine(day + timedelta(days=1) if end else day, time.min)
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+# FOR BOTH VIEWS
+# full text search of the messages, best match first - ?q=home loans&participant=<user id>&from=2026-10-01&to=2026-10-07
+# users search their own conversations, staff (supervisors) search all of them
+# participant = only conversations of that user, ?cursor=<next_cursor> for the next page
+class SearchMessages(generics.RetrieveAPIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        text = request.query_params.get('q', '').strip()
+        if not text:
+            return Response({"error": "Search text (q) is required"}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            participant = request.query_params.get('participant')
+            participant_id = uuid.UUID(participant) if participant else None
+            date_from = request.query_params.get('from')
+            date_from = parse_date_param(date_from) if date_from else None
+            date_to = request.query_params.get('to')
+            date_to = parse_date_param(date_to, end=True) if date_to else None
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
-        if not conversations.exists():
-            return Response({"message" : "No conversations found"}, status=status.HTTP_200_OK)
+        after = None
+        cursor = request.query_params.get('cursor')
+        if cursor:
+            try:
+                rank, created_at, message_id = decode_ranked_cursor(cursor)
+                after = (rank, created_at, uuid.UUID(message_id))
+            except (InvalidCursor, ValueError):
+                return Response({"error": "Invalid cursor"}, status=status.HTTP_400_BAD_REQUEST)
 
-        # 3. Data
-        conversation_data = []
-        for conv in conversations:
-            other_user = conv.user2 if conv.user1.user_type == "representative" else conv.user1
-            user_name = f"{other_user.first_name} {other_user.last_name}"
+        limit = get_page_size(request, default=20, maximum=100)
+        rows, has_more = search.search_messages(
+            text,
+            conversations=search.get_searchable_conversations(request.user, participant_id),
+            date_from=date_from,
+            date_to=date_to,
+            after=after,
+            limit=limit,
+        )
 
-            conversation_data.append({
-                "conversation_id": str(conv.id),
-                "user_name": user_name
-            })
+        next_cursor = encode_ranked_cursor(rows[-1]['rank'], rows[-1]['created_at'], rows[-1]['id']) if has_more and rows else None
+        results = [
+            {
+                "id": str(row['id']),
+                "conversation_id": str(row['conversation_id']),
+                "seq": row['seq'],
+                "sender": str(row['sender_id']),
+                "text": row['text'],
+                "timestamp": row['created_at'].isoformat(),
+                "rank": row['rank'],
+            }
+            for row in rows
+        ]
 
-        return Response(conversation_data, status=status.HTTP_200_OK)
\ No newline at end of file
+        return Response({"results": results, "next_cursor": next_cursor}, status=status.HTTP_200_OK)
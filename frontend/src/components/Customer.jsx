@@ -6,7 +6,7 @@ import useAuthStore from "../../store/authStore";
 
 const Customer = () => {
   const { messages, addMessage, activeConversationId, setActiveConversation } = useChatStore();
-  const { connect, sendMessage, connectionStatus, getConversationID } = useSocketStore();
+  const { connect, sendMessage, connectionStatus, getConversationID, getHistory } = useSocketStore();
   const {user, accessToken} = useAuthStore()
   const [text, setText] = useState("");
   const messageEndRef = useRef(null);
@@ -24,6 +24,8 @@ const Customer = () => {
           if (convId) {
             // Once we have the ID, set it in our local state.
             setActiveConversation(convId);
+            // load earlier messages of the chat
+            await getHistory(convId).catch(error => console.error("Error fetching history:", error));
             // NOW, connect to the websocket with the guaranteed ID.
             connect(convId, accessToken);
           } else {
@@ -36,7 +38,7 @@ const Customer = () => {
       initializeChat();
     }
     // This effect should only re-run if the user or token changes.
-  }, [user?.user_id, accessToken, getConversationID, connect]);
+  }, [user?.user_id, accessToken, getConversationID, getHistory, connect]);
 
 
   // Auto-scroll to bottom when messages change
@@ -6,8 +6,8 @@ import useAuthStore from "../../store/authStore";
 import api from "../utils/api";
 
 const Representative = () => {
-  const { messages, activeConversationId, setActiveConversation } = useChatStore();
-  const { connect, sendMessage, connectionStatus, getConnectedUsers } = useSocketStore();
+  const { messages, activeConversationId, setActiveConversation, analytics: conversationAnalytics, setAnalytics } = useChatStore();
+  const { connect, sendMessage, connectionStatus, getConnectedUsers, getHistory, markRead } = useSocketStore();
   const { user, accessToken } = useAuthStore();
 
   const [activeConversations, setActiveConversations] = useState([]);
@@ -15,13 +15,14 @@ const Representative = () => {
   const [text, setText] = useState("");
   const messageEndRef = useRef(null);
 
-  const [analytics, setAnalytics] = useState({
+  // analytics are pushed over the socket (analytics.update) and kept per conversation in the chat store
+  const analytics = (activeConversationId && conversationAnalytics[activeConversationId]) || {
     "summary": null,
     "sentiment": null,
     "loan_type": null,
     "lead_type": null,
     "rationale": null
-  })
+  };
 
 
   // Fetch connected users when the component mounts
@@ -29,8 +30,8 @@ const Representative = () => {
     if (user?.user_id) {
       getConnectedUsers(user.user_id)
         .then(data => {
-          if (Array.isArray(data)) {
-            setActiveConversations(data);
+          if (Array.isArray(data?.results)) {
+            setActiveConversations(data.results);
           }
         })
         .catch(error => console.error("Error fetching connected users:", error));
@@ -57,35 +58,80 @@ const Representative = () => {
           headers: {
             "Content-Type": "application/json", 
           },
-          body: JSON.stringify({messages: messages[conversationId] || []})
+          // server keeps the earlier analytics and only analyses the new messages
+          // async - request returns a job id, result comes later as analytics.update on the socket
+          body: JSON.stringify({conversation_id: conversationId, async: true})
       });
       const data = await response.json();
-      setAnalytics({
-        summary: data.summary,
-        sentiment: data.sentiment,
-        loan_type: data.loan_type,
-        lead_type: data.lead_type,
-        rationale: data.rationale,
-      });
+      // sync response (or server without async support) contains the analytics directly
+      if (response.status === 200) {
+        setAnalytics(conversationId, {
+          summary: data.summary,
+          sentiment: data.sentiment,
+          loan_type: data.loan_type,
+          lead_type: data.lead_type,
+          rationale: data.rationale,
+        });
+      }
     } catch (error) {
       console.error("Error fetching analytics:", error);
-      setAnalytics({
-        summary: null,
-        sentiment: null,
-        loan_type: null,
-        lead_type: null,
-        rationale: null,
-      });
     }
   };
 
+  // streaming analytics (server sent events) - fields show up while the LLM is still generating
+  // EventSource cannot send the auth header, so a short lived stream token goes in the url
+  const streamAnalytics = async (conversationId) => {
+    const response = await api(`/analytics/stream/${conversationId}/ticket/`, { method: "POST" });
+    if (!response.ok) {
+      console.error("Could not open analytics stream:", response.status);
+      return;
+    }
+    const { token } = await response.json();
+
+    const source = new EventSource(`/analytics/stream/${conversationId}/?token=${encodeURIComponent(token)}`);
+    let current = { summary: "", sentiment: null, loan_type: null, lead_type: null, rationale: "" };
+
+    // sentiment / lead_type / loan_type once decided
+    source.addEventListener("field", (event) => {
+      current = { ...current, ...JSON.parse(event.data) };
+      setAnalytics(conversationId, current);
+    });
+    // next piece of summary / rationale text
+    source.addEventListener("delta", (event) => {
+      const { field, text } = JSON.parse(event.data);
+      current = { ...current, [field]: (current[field] || "") + text };
+      setAnalytics(conversationId, current);
+    });
+    source.addEventListener("done", (event) => {
+      const data = JSON.parse(event.data);
+      if (data) setAnalytics(conversationId, data);
+      source.close();
+    });
+    // closing on error as well, else EventSource keeps reconnecting
+    source.addEventListener("error", () => source.close());
+  };
+
   // Its only job is to update state. The useEffect above will handle the connection.
   const handleSelectChat = async (chat) => {
     setSelectedChat(chat);
     setActiveConversation(chat.conversation_id);
 
+    // opened chat has no unread messages anymore
+    if (chat.unread_count) {
+      setActiveConversations(conversations => conversations.map(conversation =>
+        conversation.conversation_id === chat.conversation_id ? { ...conversation, unread_count: 0 } : conversation
+      ));
+    }
+    markRead(chat.conversation_id)
+      .catch(error => console.error("Error marking chat as read:", error));
+
+    // load earlier messages of the chat
+    getHistory(chat.conversation_id)
+      .catch(error => console.error("Error fetching history:", error));
+
     // to get analytics when re-loading previous chats
-    // await fetchAnalytics(chat.conversation_id)
+    streamAnalytics(chat.conversation_id)
+      .catch(error => console.error("Error streaming analytics:", error));
   };
 
   // Send message
@@ -134,7 +180,17 @@ const Representative = () => {
                   : "border-l-4 border-transparent"
                 }`}
             >
-              <p className="font-semibold text-gray-800">{chat.user_name}</p>
+              <div className="flex justify-between items-center">
+                <p className="font-semibold text-gray-800">{chat.user_name}</p>
+                {chat.unread_count > 0 && (
+                  <span className="text-xs font-semibold text-white bg-indigo-600 rounded-full px-2 py-0.5">
+                    {chat.unread_count}
+                  </span>
+                )}
+              </div>
+              {chat.last_message && (
+                <p className="text-sm text-gray-500 truncate">{chat.last_message}</p>
+              )}
             </div>
           ))}
         </div>
@@ -2,6 +2,9 @@
 // and when refresh token expires - redirect to login
 import useAuthStore from "../../store/authStore";
 
+// a 401 from these means wrong credentials / expired refresh token, refreshing would not help
+const AUTH_TOKEN_URLS = ['/auth/token/', '/auth/token/refresh/'];
+
 const api = async (url, options = {}) => {
     // Get current state outside React component
     const authStore = useAuthStore.getState(); 
@@ -19,9 +22,9 @@ const api = async (url, options = {}) => {
 
     let response = await fetch(url, options);
 
-    // If the response is 401 Unauthorized, it's not a token refresh endpoint itself,
+    // If the response is 401 Unauthorized, it's not one of the auth token endpoints (login / refresh),
     // and it's not already a retry attempt.
-    if (response.status === 401 && !url.includes('/token/') && !options._isRetry) {
+    if (response.status === 401 && !AUTH_TOKEN_URLS.some(path => url.startsWith(path)) && !options._isRetry) {
         try {
             console.log("Access token expired. Attempting to refresh...");
             const newAccessToken = await authStore.getNewAccessToken(); // Try to get a new token
@@ -4,13 +4,16 @@ export const useChatStore = create((set, get) => ({
 
   activeConversationId: null,
   messages: {}, // { conversationId: [msg1, msg2, ...] }
+  analytics: {}, // { conversationId: {summary, sentiment, loan_type, lead_type, rationale} }
 
   // Set active conversation
   setActiveConversation: (conversationId) => set({ activeConversationId: conversationId }),
 
   // Add messages to a conversation
+  // messages replayed after a reconnect can already be there, they are skipped (same id)
   addMessage: (conversationId, message) => {
     const prevMessages = get().messages[conversationId] || [];
+    if (message.id && prevMessages.some((m) => m.id === message.id)) return;
     set({
       messages: {
         ...get().messages,
@@ -19,6 +22,24 @@ export const useChatStore = create((set, get) => ({
     });
   },
 
+  // seq of messages sent before they were stored on the server (chat.sync), synced = [{id, seq}]
+  applySync: (conversationId, synced) => {
+    const seqs = Object.fromEntries(synced.map((m) => [m.id, m.seq]));
+    const prevMessages = get().messages[conversationId] || [];
+    set({
+      messages: {
+        ...get().messages,
+        [conversationId]: prevMessages.map((m) => (m.id in seqs ? { ...m, seq: seqs[m.id] } : m)),
+      },
+    });
+  },
+
+  // highest seq of the conversation we have, sent on reconnect to get only the missed messages
+  getLastSeq: (conversationId) => {
+    const seqs = (get().messages[conversationId] || []).map((m) => m.seq).filter((seq) => seq != null);
+    return seqs.length ? Math.max(...seqs) : null;
+  },
+
   // Load full message history for a conversation
   setMessages: (conversationId, messages) =>
     set({
@@ -28,6 +49,15 @@ export const useChatStore = create((set, get) => ({
       },
     }),
 
+  // Store latest analytics of a conversation (pushed over the socket or returned by the api)
+  setAnalytics: (conversationId, analytics) =>
+    set({
+      analytics: {
+        ...get().analytics,
+        [conversationId]: analytics,
+      },
+    }),
+
   // Clear all chat data (useful on logout)
-  clearChat: () => set({ activeConversationId: null, messages: {} }),
+  clearChat: () => set({ activeConversationId: null, messages: {}, analytics: {} }),
 }));
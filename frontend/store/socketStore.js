@@ -3,6 +3,8 @@ import { useChatStore } from "./chatStore";
 import api from '../src/utils/api';
 
 let socketRef = { current: null };
+// reconnect timer of a dropped socket
+let reconnectRef = { current: null, attempts: 0 };
 
 export const useSocketStore = create((set, get) => ({
   connectionStatus: "disconnected",
@@ -17,13 +19,36 @@ export const useSocketStore = create((set, get) => ({
   },
 
   // getting the list of users with whom the current reprsentative had conversation
-  getConnectedUsers: async (representative_id) => {
-    const url = `/chat/get_connected_users/${representative_id}/`;
+  // conversations of the representative, most recent activity first
+  // returns { results, next_cursor }, before = cursor of the previous page
+  getConnectedUsers: async (representative_id, before = null) => {
+    const query = before ? `?before=${encodeURIComponent(before)}` : "";
+    const url = `/chat/get_connected_users/${representative_id}/${query}`;
     const response = await api(url, { method: "GET" });
     const data = await response.json();
     return data;
   },
 
+  // conversation opened - its unread count goes back to 0 on the server
+  markRead: async (conversationId) => {
+    const url = `/chat/inbox/${conversationId}/read/`;
+    await api(url, { method: "POST" });
+  },
+
+  // loading the latest page of the conversation history into the chat store
+  // before = cursor returned by the previous page, to load older messages
+  getHistory: async (conversationId, before = null) => {
+    const query = before ? `?before=${encodeURIComponent(before)}` : "";
+    const url = `/chat/history/${conversationId}/${query}`;
+    const response = await api(url, { method: "GET" });
+    if (!response.ok) return null;
+    const data = await response.json();
+    const chatStore = useChatStore.getState();
+    const current = chatStore.messages[conversationId] || [];
+    chatStore.setMessages(conversationId, before ? [...data.messages, ...current] : data.messages);
+    return data.next_cursor;
+  },
+
   // make the socket connection
   connect: (room_id, accessToken) => {
     if (!room_id) {
@@ -33,22 +58,35 @@ export const useSocketStore = create((set, get) => ({
 
     // This is the key to allowing the representative to switch between chats.
     // Close earlier connections to start new ones for chatting with new users
+    clearTimeout(reconnectRef.current);
     if (socketRef.current) {
-      socketRef.current.close();
+      const previous = socketRef.current;
+      socketRef.current = null;
+      previous.close();
     }
 
-    const wsUrl = `ws://${window.location.host}/ws/chat/${room_id}/?token=${accessToken}`;
+    // last seq we have of the conversation, server sends only the messages after it
+    const lastSeq = useChatStore.getState().getLastSeq(room_id);
+    const seqQuery = lastSeq != null ? `&last_seq=${lastSeq}` : "";
+    const wsUrl = `ws://${window.location.host}/ws/chat/${room_id}/?token=${accessToken}${seqQuery}`;
     const socket = new WebSocket(wsUrl);
     socketRef.current = socket;
 
     socket.onopen = () => {
       console.log(`✅ WebSocket connected to room: ${room_id}`);
+      reconnectRef.attempts = 0;
       set({ connectionStatus: "connected" });
     };
 
     socket.onclose = () => {
       console.log("❌ WebSocket disconnected");
       set({ connectionStatus: "disconnected" });
+      // dropped (not closed by us) - reconnect with backoff and resume from the last seq
+      if (socketRef.current === socket) {
+        const delay = Math.min(1000 * 2 ** reconnectRef.attempts, 30000);
+        reconnectRef.attempts += 1;
+        reconnectRef.current = setTimeout(() => get().connect(room_id, accessToken), delay);
+      }
     };
 
     socket.onerror = (err) => {
@@ -64,11 +102,25 @@ export const useSocketStore = create((set, get) => ({
         // so handle it appropriately by storing it in the chatstore
         if (data.type === "chat.message") {
           useChatStore.getState().addMessage(data.conversation_id, {
+            id: data.id,
+            seq: data.seq,
             sender: data.sender,
             text: data.text,
             timestamp: data.timestamp,
           });
         }
+        // messages stored after they were sent (write behind on the server), now with their seq
+        if (data.type === "chat.sync") {
+          useChatStore.getState().applySync(data.conversation_id, data.messages);
+        }
+        // missed too many messages while disconnected - reload the latest history
+        if (data.type === "chat.resync") {
+          get().getHistory(data.conversation_id);
+        }
+        // analytics job finished on the server
+        if (data.type === "analytics.update" && data.status === "done" && data.analytics) {
+          useChatStore.getState().setAnalytics(data.conversation_id, data.analytics);
+        }
       } catch (err) {
         console.error("Error parsing message:", err);
       }
@@ -92,9 +144,11 @@ export const useSocketStore = create((set, get) => ({
   },
 
   disconnect: () => {
+    clearTimeout(reconnectRef.current);
     if (socketRef.current) {
-      socketRef.current.close();
+      const socket = socketRef.current;
       socketRef.current = null;
+      socket.close();
     }
     set({ connectionStatus: "disconnected" });
   },